@@ -2,15 +2,17 @@
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from google.cloud import bigquery
 import configparser
-from google.cloud import bigquery_storage
 import os, sys
 import datetime
 import pickle
 import plotly.express as px
 import kaleido
 from scipy import stats
+sys.path.append(os.path.join(sys.path[0], '..'))
+from utils.bq import run_query
+from utils.query_cache import get_cached_data
+from utils.bq_executor import run_concurrently
 
 pd.set_option('display.max_columns', None)
 pd.set_option('display.width', 1000)
@@ -20,44 +22,37 @@ config = configparser.ConfigParser()
 config.read(config_path)
 
 project_id = "freestar-157323"
-client = bigquery.Client(project=project_id)
-bqstorageclient = bigquery_storage.BigQueryReadClient()
 
 def get_bq_data(query, replacement_dict={}):
     for k, v in replacement_dict.items():
         query = query.replace("{"+k+"}", f'{v}')
-    return client.query(query).result().to_dataframe(bqstorage_client=bqstorageclient, progress_bar_type='tqdm')
+    return run_query(project_id, query)
 
-def get_data(last_date=datetime.date.today() - datetime.timedelta(days=1), days=30, force_recalc=False):
+def query_day(query, repl_dict):
+    # the two queries for a day depend on each other, but different days are independent
+    print(f'processing date: {repl_dict['processing_date']}')
+
+    query_rtt = open(os.path.join(sys.path[0], "query_rtt_with_numbers.sql"), "r").read()
+    get_bq_data(query_rtt, repl_dict)
+    return get_bq_data(query, repl_dict)
 
-    data_cache_filename = f'data_cache/DAS_bidder_investigation_{last_date}_{days}.pkl'
+def get_day_data(repl_dict, force_recalc=False):
+    # cached per day rather than per window, so moving the window forward only queries the new day
+    query = open(os.path.join(sys.path[0], "bidder_avg_rps.sql"), "r").read()
+    return get_cached_data(query, repl_dict, query_day, force_requery=force_recalc,
+                           name=f'DAS_bidder_investigation_{repl_dict["processing_date"]}')
 
-    if not force_recalc and os.path.exists(data_cache_filename):
-        print(f'found existing data file, loading {data_cache_filename}')
-        with open(data_cache_filename, 'rb') as f:
-            df = pickle.load(f)
-        return df
+def get_data(last_date=datetime.date.today() - datetime.timedelta(days=1), days=30, force_recalc=False):
 
     repl_dict = {'day_interval': 2,
                  'perc': 0.01,
                  'fallback_rps_perc': 10}
 
-    df_list = []
-    for d in range(days):
-        repl_dict['processing_date'] = (last_date - datetime.timedelta(days=d)).strftime("%Y-%m-%d")
-        print(f'processing date: {repl_dict['processing_date']}')
-
-        query = open(os.path.join(sys.path[0], "query_rtt_with_numbers.sql"), "r").read()
-        get_bq_data(query, repl_dict)
-
-        query = open(os.path.join(sys.path[0], "bidder_avg_rps.sql"), "r").read()
-        df_day = get_bq_data(query, repl_dict)
-        df_list.append(df_day)
-
-    df = pd.concat(df_list)
-    with open(data_cache_filename, 'wb') as f:
-        pickle.dump(df, f)
-    return df
+    processing_dates = [(last_date - datetime.timedelta(days=d)).strftime("%Y-%m-%d") for d in range(days)]
+    df_list = run_concurrently(lambda processing_date: get_day_data(dict(repl_dict, processing_date=processing_date),
+                                                                    force_recalc),
+                               processing_dates, names=processing_dates)
+    return pd.concat(df_list)
 
 def main(last_date=datetime.date.today() - datetime.timedelta(days=1), days=30, force_recalc=False):
     client_rank_limit = 8
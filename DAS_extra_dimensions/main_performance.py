@@ -1,8 +1,6 @@
 import pandas as pd
 import matplotlib.pyplot as plt
-from google.cloud import bigquery
 import configparser
-from google.cloud import bigquery_storage
 import os, sys
 import numpy as np
 import datetime
@@ -10,6 +8,8 @@ import pickle
 import plotly.express as px
 import kaleido
 from scipy.stats import linregress
+sys.path.append(os.path.join(sys.path[0], '..'))
+from utils.bq import run_query
 
 pd.set_option('display.max_columns', None)
 pd.set_option('display.width', 1000)
@@ -19,14 +19,12 @@ config = configparser.ConfigParser()
 config.read(config_path)
 
 project_id = "freestar-157323"
-client = bigquery.Client(project=project_id)
-bqstorageclient = bigquery_storage.BigQueryReadClient()
 
 
 def get_bq_data(query, replacement_dict={}):
     for k, v in replacement_dict.items():
         query = query.replace("{" + k + "}", str(v))
-    return client.query(query).result().to_dataframe(bqstorage_client=bqstorageclient, progress_bar_type='tqdm')
+    return run_query(project_id, query)
 def main():
     for rolling_days in [1, 7, 14]:
 
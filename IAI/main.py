@@ -1,14 +1,15 @@
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from google.cloud import bigquery
 import configparser
-from google.cloud import bigquery_storage
 import os, sys
 import datetime
 import pickle
 import scipy
 from matplotlib.backends.backend_pdf import PdfPages
+sys.path.append(os.path.join(sys.path[0], '..'))
+from utils.bq import run_query
+from utils.query_cache import get_cached_data
 
 pd.set_option('display.max_columns', None)
 pd.set_option('display.width', 1000)
@@ -18,29 +19,15 @@ config = configparser.ConfigParser()
 config.read(config_path)
 
 project_id = "streamamp-qa-239417"
-client = bigquery.Client(project=project_id)
-bqstorageclient = bigquery_storage.BigQueryReadClient()
 
 def get_bq_data(query, replacement_dict={}):
     for k, v in replacement_dict.items():
         query = query.replace("{"+k+"}", f'{v}')
-    return client.query(query).result().to_dataframe(bqstorage_client=bqstorageclient, progress_bar_type='tqdm')
+    return run_query(project_id, query)
 
 def get_data(query_filename, data_cache_filename, force_requery=False, repl_dict = {}):
-    data_cache_filename_full = f'data_cache/{data_cache_filename}.pkl'
-
-    if not force_requery and os.path.exists(data_cache_filename_full):
-        print(f'found existing data file, loading {data_cache_filename_full}')
-        with open(data_cache_filename_full, 'rb') as f:
-            df = pickle.load(f)
-        return df
-
     query = open(os.path.join(sys.path[0], f"queries/{query_filename}.sql"), "r").read()
-    df = get_bq_data(query, repl_dict)
-
-    with open(data_cache_filename_full, 'wb') as f:
-        pickle.dump(df, f)
-    return df
+    return get_cached_data(query, repl_dict, get_bq_data, force_requery=force_requery, name=data_cache_filename)
 
 
 def main_raw_dtf_data():
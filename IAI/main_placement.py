@@ -1,14 +1,16 @@
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from google.cloud import bigquery
 import configparser
-from google.cloud import bigquery_storage
 import os, sys
 import datetime
 import pickle
 import scipy
 from matplotlib.backends.backend_pdf import PdfPages
+sys.path.append(os.path.join(sys.path[0], '..'))
+from utils.bq import run_query, stream_query
+from utils.stream_reducers import Moments, QuantileSketch, reduce_batches
+from utils.query_cache import get_cached_data
 
 pd.set_option('display.max_columns', None)
 pd.set_option('display.width', 1000)
@@ -18,29 +20,15 @@ config = configparser.ConfigParser()
 config.read(config_path)
 
 project_id = "streamamp-qa-239417"
-client = bigquery.Client(project=project_id)
-bqstorageclient = bigquery_storage.BigQueryReadClient()
 
 def get_bq_data(query, replacement_dict={}):
     for k, v in replacement_dict.items():
         query = query.replace("{"+k+"}", f'{v}')
-    return client.query(query).result().to_dataframe(bqstorage_client=bqstorageclient, progress_bar_type='tqdm')
+    return run_query(project_id, query)
 
 def get_data(query_filename, data_cache_filename, force_requery=False, repl_dict = {}):
-    data_cache_filename_full = f'data_cache/{data_cache_filename}.pkl'
-
-    if not force_requery and os.path.exists(data_cache_filename_full):
-        print(f'found existing data file, loading {data_cache_filename_full}')
-        with open(data_cache_filename_full, 'rb') as f:
-            df = pickle.load(f)
-        return df
-
     query = open(os.path.join(sys.path[0], f"queries/{query_filename}.sql"), "r").read()
-    df = get_bq_data(query, repl_dict)
-
-    with open(data_cache_filename_full, 'wb') as f:
-        pickle.dump(df, f)
-    return df
+    return get_cached_data(query, repl_dict, get_bq_data, force_requery=force_requery, name=data_cache_filename)
 
 
 def main_raw_dtf_data():
@@ -52,6 +40,29 @@ def main_raw_dtf_data():
     query = open(os.path.join(sys.path[0], f"queries/raw_dtf_session_data_all_data.sql"), "r").read()
     get_bq_data(query, repl_dict)
 
+def main_raw_dtf_data_stats():
+
+    repl_dict = {'start_date': '2024-12-19',
+                 'end_date': '2025-1-5'}
+
+    # the session level table made by main_raw_dtf_data is reduced as it streams in rather than downloaded
+    query = ("select date, all_revenue, flying_carpet_revenue from "
+             f"`streamamp-qa-239417.DAS_increment.IAI_dtf_session_data_new_all_data_{repl_dict['start_date']}_{repl_dict['end_date']}`")
+    moments = Moments(['all_revenue', 'flying_carpet_revenue'], by=['date'])
+    revenue_sketch = QuantileSketch('all_revenue')
+    reduce_batches(stream_query(project_id, query), [moments, revenue_sketch])
+
+    df_stats = moments.result()
+    print(df_stats)
+    quantiles = [0.5, 0.9, 0.99, 0.999]
+    print(pd.Series(revenue_sketch.quantiles(quantiles), index=quantiles, name='session all_revenue quantiles'))
+
+    fig, ax = plt.subplots(figsize=(12, 9), nrows=2)
+    fig.suptitle(f'Session rps from {repl_dict["start_date"]} to {repl_dict["end_date"]}')
+    for i, col in enumerate(['all_revenue', 'flying_carpet_revenue']):
+        (df_stats['mean'][col] * 1000).plot(yerr=df_stats['mean_uncertainty'][col] * 1000, ax=ax[i], ylabel=f'{col} rps')
+    fig.savefig(f'plots/session_rps_{repl_dict["start_date"]}_{repl_dict["end_date"]}.png')
+
 def main_process_data():
 
     repl_dict = {'start_date': '2024-12-19',
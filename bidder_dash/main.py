@@ -1,13 +1,15 @@
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from google.cloud import bigquery
 import configparser
-from google.cloud import bigquery_storage
 import os, sys
 import datetime
 import pickle
 from matplotlib.backends.backend_pdf import PdfPages
+sys.path.append(os.path.join(sys.path[0], '..'))
+from utils.bq import run_query
+from utils.query_cache import get_cached_data
+from utils.day_partitions import create_window_table
 
 pd.set_option('display.max_columns', None)
 pd.set_option('display.width', 1000)
@@ -17,32 +19,19 @@ config = configparser.ConfigParser()
 config.read(config_path)
 
 project_id = "streamamp-qa-239417"
-client = bigquery.Client(project=project_id)
-bqstorageclient = bigquery_storage.BigQueryReadClient()
 
 fixed_bidders = ['ix', 'rise', 'appnexus', 'rubicon', 'triplelift', 'pubmatic']
 
-def get_bq_data(query, replacement_dict={}):
+def get_bq_data(query, replacement_dict={}, result_type='dataframe', compact=False):
     for k, v in replacement_dict.items():
         query = query.replace("{"+k+"}", f'{v}')
-    return client.query(query).result().to_dataframe(bqstorage_client=bqstorageclient, progress_bar_type='tqdm')
+    return run_query(project_id, query, result_type, compact)
 
 
 def get_data_using_query(query, filename, index=None, force_calc=False, repl_dict={}):
-    data_cache_filename = f'data_cache/wb_{filename}.pkl'
-    if not force_calc and os.path.exists(data_cache_filename):
-        print(f'found existing data file, loading: {data_cache_filename}')
-    else:
-        print(f'{datetime.datetime.now()}: querying to create file: {data_cache_filename}')
-        df = get_bq_data(query, repl_dict)
-        if index is not None:
-            df = df.set_index(index)
-
-        with open(data_cache_filename, 'wb') as f:
-            pickle.dump(df, f)
-
-    with open(data_cache_filename, 'rb') as f:
-        df = pickle.load(f)
+    df = get_cached_data(query, repl_dict, get_bq_data, force_requery=force_calc, name=filename)
+    if index is not None:
+        df = df.set_index(index)
     return df
 
 
@@ -56,7 +45,7 @@ def main_create_bidder_session_data_raw(last_date=datetime.date(2024, 9, 3), day
                  'aer_to_bwr_join_type': 'join'}
 
     query = open(os.path.join(sys.path[0], 'queries/query_bidder_session_data_raw_domain_day.sql'), "r").read()
-    get_bq_data(query, repl_dict)
+    create_window_table(project_id, query, repl_dict, get_bq_data)
 
     # queries = open(os.path.join(sys.path[0], 'queries/query_bidder_session_data_raw.sql'), "r").read()
     # get_bq_data(queries, repl_dict)
@@ -1,14 +1,15 @@
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from google.cloud import bigquery
 import configparser
-from google.cloud import bigquery_storage
 import os, sys
 import datetime
 import pickle
 from matplotlib.backends.backend_pdf import PdfPages
 from sklearn.linear_model import LinearRegression
+sys.path.append(os.path.join(sys.path[0], '..'))
+from utils.bq import run_query
+from utils.query_cache import get_cached_data
 
 pd.set_option('display.max_columns', None)
 pd.set_option('display.width', 1000)
@@ -18,15 +19,16 @@ config = configparser.ConfigParser()
 config.read(config_path)
 
 project_id = "streamamp-qa-239417"
-client = bigquery.Client(project=project_id)
-bqstorageclient = bigquery_storage.BigQueryReadClient()
 
 fixed_bidders = ['ix', 'rise', 'appnexus', 'rubicon', 'triplelift', 'pubmatic']
 
-def get_bq_data(query, replacement_dict={}):
+def get_bq_data(query, replacement_dict={}, result_type='dataframe', compact=False):
     for k, v in replacement_dict.items():
         query = query.replace("{"+k+"}", f'{v}')
-    df = client.query(query).result().to_dataframe(bqstorage_client=bqstorageclient, progress_bar_type='tqdm')
+    df = run_query(project_id, query, result_type, compact)
+
+    if result_type == 'arrow':
+        return df
 
     for col in ['date', 'date_hour']:
         if col in df.columns:
@@ -34,22 +36,11 @@ def get_bq_data(query, replacement_dict={}):
 
     return df
 
-def get_data_using_query(query, filename, index=None, force_calc=False, repl_dict={}, quiet=False):
-    data_cache_filename = f'data_cache/{filename}.pkl'
-    if not force_calc and os.path.exists(data_cache_filename):
-        if not quiet:
-            print(f'found existing data file, loading: {data_cache_filename}')
-    else:
-        print(f'{datetime.datetime.now()}: querying to create file: {data_cache_filename}')
-        df = get_bq_data(query, repl_dict)
-        if index is not None:
-            df = df.set_index(index)
-
-        with open(data_cache_filename, 'wb') as f:
-            pickle.dump(df, f)
-
-    with open(data_cache_filename, 'rb') as f:
-        df = pickle.load(f)
+def get_data_using_query(query, filename, index=None, force_calc=False, repl_dict={}, quiet=False, compact=False):
+    df = get_cached_data(query, repl_dict, lambda q, r: get_bq_data(q, r, compact=compact), force_requery=force_calc,
+                         name=filename, quiet=quiet)
+    if index is not None:
+        df = df.set_index(index)
     return df
 
 
@@ -72,7 +63,7 @@ def main_prediction():
     }
     query = open(os.path.join(sys.path[0], f'queries/{query_name}.sql'), "r").read()
 
-    df_all = get_data_using_query(query, 'bidder_rps_1', 'date', force_calc=False, repl_dict=repl_dict, quiet=True)
+    df_all = get_data_using_query(query, 'bidder_rps_1', 'date', force_calc=False, repl_dict=repl_dict, quiet=True, compact=True)
 
     # with PdfPages(f'plots/predictions_rps.pdf') as pdf:
     #     stats = main_prediction_country(queries, repl_dict, pdf=pdf)
@@ -118,7 +109,7 @@ def main_prediction_country(query, repl_dict, country_code='US', device_category
     df_dict = {}
     for N in N_vals:
         repl_dict['N_days_preceding'] = N
-        df_all = get_data_using_query(query, f'bidder_rps_{N}', 'date', force_calc=False, repl_dict=repl_dict, quiet=True)
+        df_all = get_data_using_query(query, f'bidder_rps_{N}', 'date', force_calc=False, repl_dict=repl_dict, quiet=True, compact=True)
         df_cc_dc = df_all[(df_all['country_code'] == country_code) & (df_all['device_category'] == device_category)]
         df_dict[N] = df_cc_dc.pivot(columns='bidder', values=['rps', 'session_count', 'rps_std'])
 
@@ -1,15 +1,16 @@
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from google.cloud import bigquery
 import configparser
-from google.cloud import bigquery_storage
 import os, sys
 import datetime
 import pickle
 import plotly.express as px
 import kaleido
 from scipy import stats
+sys.path.append(os.path.join(sys.path[0], '..'))
+from utils.bq import run_query
+from utils.query_cache import get_cached_data
 
 pd.set_option('display.max_columns', None)
 pd.set_option('display.width', 1000)
@@ -19,13 +20,11 @@ config = configparser.ConfigParser()
 config.read(config_path)
 
 project_id = "freestar-157323"
-client = bigquery.Client(project=project_id)
-bqstorageclient = bigquery_storage.BigQueryReadClient()
 
 def get_bq_data(query, replacement_dict={}):
     for k, v in replacement_dict.items():
         query = query.replace(f"<{k}>", v)
-    return client.query(query).result().to_dataframe(bqstorage_client=bqstorageclient, progress_bar_type='tqdm')
+    return run_query(project_id, query)
 
 def main_browsi_1(query_file="browsi_query_1_US_desktop", force_recalc=False, hist_bins=50, nbinsx=50, nbinsy=100,
                   max_cpma=4, max_price_prediction=1, domain='all', pp_col='price_prediction', N_buckets=5):
@@ -35,19 +34,9 @@ def main_browsi_1(query_file="browsi_query_1_US_desktop", force_recalc=False, hi
     ddate = "2024-6-18"
     ddate_end = "2024-6-30"
 
-    if 'first' in query_file:
-        data_cache_filename = f'data_cache/{query_file}_{ddate}_{ddate_end}.pkl'
-    else:
-        data_cache_filename = f'data_cache/{query_file}_{ddate}.pkl'
-
-    if force_recalc or not os.path.exists(data_cache_filename):
-        query = open(os.path.join(sys.path[0], f"{query_file}.sql"), "r").read()
-        df = get_bq_data(query, {'DDATE': ddate, 'DDATE_START': ddate, 'DDATE_END': ddate_end})
-        with open(data_cache_filename, 'wb') as f:
-            pickle.dump(df, f)
-
-    with open(data_cache_filename, 'rb') as f:
-        df = pickle.load(f)
+    query = open(os.path.join(sys.path[0], f"{query_file}.sql"), "r").read()
+    df = get_cached_data(query, {'DDATE': ddate, 'DDATE_START': ddate, 'DDATE_END': ddate_end}, get_bq_data,
+                         force_requery=force_recalc, name=query_file, placeholder='<>')
 
     df['price_prediction'] = [float(x) for x in df[pp_col].values]
 
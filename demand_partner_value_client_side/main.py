@@ -1,13 +1,14 @@
 import pandas as pd
 import matplotlib.pyplot as plt
-from google.cloud import bigquery
 import configparser
-from google.cloud import bigquery_storage
 import os, sys
 import datetime
 import pickle
 import plotly.express as px
 import kaleido
+sys.path.append(os.path.join(sys.path[0], '..'))
+from utils.bq import run_query
+from utils.bq_executor import run_concurrently
 
 pd.set_option('display.max_columns', None)
 pd.set_option('display.width', 1000)
@@ -17,13 +18,17 @@ config = configparser.ConfigParser()
 config.read(config_path)
 
 project_id = "freestar-157323"
-client = bigquery.Client(project=project_id)
-bqstorageclient = bigquery_storage.BigQueryReadClient()
 
 def get_bq_data(query, replacement_dict={}):
     for k, v in replacement_dict.items():
         query = query.replace(f"<{k}>", str(v))
-    return client.query(query).result().to_dataframe(bqstorage_client=bqstorageclient, progress_bar_type='tqdm')
+    return run_query(project_id, query)
+
+def query_demand_partner(query, rep_dict, data_cache_filename):
+    print(f"doing: {rep_dict['DEMAND_PARTNER']}, {datetime.datetime.now()}")
+    df = get_bq_data(query, rep_dict)
+    with open(data_cache_filename, 'wb') as f:
+        pickle.dump((df), f)
 
 def main_bidsresponse_analysis(dt_end, data_hours=1, force_recalc=False):
     bins = 200
@@ -43,18 +48,15 @@ def main_bidsresponse_analysis(dt_end, data_hours=1, force_recalc=False):
     with open(data_cache_filename, 'rb') as f:
         (demand_partners) = pickle.load(f)
 
-    fig, ax = plt.subplots(figsize=(12, 9))
-    for i, dp in enumerate(demand_partners):
-        data_cache_filename = f'data_cache/bidsresponse_{dp}_{rep_dict['START_UNIX_TIME_MS']}_{rep_dict['END_UNIX_TIME_MS']}.pkl'
-        if force_recalc or not os.path.exists(data_cache_filename):
-            now = datetime.datetime.now()
-            rep_dict["DEMAND_PARTNER"] = dp
-            print(f"doing: {dp}, {now}")
-
-            df = get_bq_data(open(os.path.join(sys.path[0], "bidsresponse_query.sql"), "r").read(), rep_dict)
-            with open(data_cache_filename, 'wb') as f:
-                pickle.dump((df), f)
+    data_cache_filenames = [f'data_cache/bidsresponse_{dp}_{rep_dict['START_UNIX_TIME_MS']}_{rep_dict['END_UNIX_TIME_MS']}.pkl' for dp in demand_partners]
+    query = open(os.path.join(sys.path[0], "bidsresponse_query.sql"), "r").read()
+    missing = [(dp, data_cache_filename) for dp, data_cache_filename in zip(demand_partners, data_cache_filenames)
+               if force_recalc or not os.path.exists(data_cache_filename)]
+    run_concurrently(lambda dp, data_cache_filename: query_demand_partner(query, dict(rep_dict, DEMAND_PARTNER=dp), data_cache_filename),
+                     missing, names=[dp for dp, _ in missing])
 
+    fig, ax = plt.subplots(figsize=(12, 9))
+    for i, (dp, data_cache_filename) in enumerate(zip(demand_partners, data_cache_filenames)):
         with open(data_cache_filename, 'rb') as f:
             (df) = pickle.load(f)
 
@@ -96,18 +98,15 @@ def main_bidswon_analysis(dt_end, data_hours=1, force_recalc=False):
     with open(data_cache_filename, 'rb') as f:
         (demand_partners) = pickle.load(f)
 
-    fig, ax = plt.subplots(figsize=(12, 9))
-    for i, dp in enumerate(demand_partners):
-        data_cache_filename = f'data_cache/bidswon_{dp}_{rep_dict['START_UNIX_TIME_MS']}_{rep_dict['END_UNIX_TIME_MS']}.pkl'
-        if force_recalc or not os.path.exists(data_cache_filename):
-            now = datetime.datetime.now()
-            rep_dict["DEMAND_PARTNER"] = dp
-            print(f"doing: {dp}, {now}")
-
-            df = get_bq_data(open(os.path.join(sys.path[0], "bidswon_query.sql"), "r").read(), rep_dict)
-            with open(data_cache_filename, 'wb') as f:
-                pickle.dump((df), f)
+    data_cache_filenames = [f'data_cache/bidswon_{dp}_{rep_dict['START_UNIX_TIME_MS']}_{rep_dict['END_UNIX_TIME_MS']}.pkl' for dp in demand_partners]
+    query = open(os.path.join(sys.path[0], "bidswon_query.sql"), "r").read()
+    missing = [(dp, data_cache_filename) for dp, data_cache_filename in zip(demand_partners, data_cache_filenames)
+               if force_recalc or not os.path.exists(data_cache_filename)]
+    run_concurrently(lambda dp, data_cache_filename: query_demand_partner(query, dict(rep_dict, DEMAND_PARTNER=dp), data_cache_filename),
+                     missing, names=[dp for dp, _ in missing])
 
+    fig, ax = plt.subplots(figsize=(12, 9))
+    for i, (dp, data_cache_filename) in enumerate(zip(demand_partners, data_cache_filenames)):
         with open(data_cache_filename, 'rb') as f:
             (df) = pickle.load(f)
 
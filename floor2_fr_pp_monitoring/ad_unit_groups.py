@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+
+# the query_direct_targetting_multiple data sorted once by ad unit and floor price, so each ad unit is a
+# contiguous block of rows, offsets[i]:offsets[i + 1], instead of a df_all[df_all['ad_unit_name'] == name] scan:
+#   units = AdUnitGroups(df_all[df_all['fill_rate'] > 0])
+#   units = units.filter(units.cum_requests_prop < 0.975)
+#   for i, (ad_unit_name, df) in enumerate(units):
+#       ...
+# prefix sums of requests, cpma and cpma * floor_price per unit answer the threshold questions for every
+# unit and any number of thresholds with a binary search each:
+#   units.floor_price_at_request_prop([0.9, 0.95, 0.975])     (units x 3)
+#   units.cpma_weighted_floor_price(floor_price_limits)       (one limit per unit, units x 1)
+
+
+class AdUnitGroups:
+    def __init__(self, df, key='ad_unit_name', sort_col='floor_price', presorted=False):
+        if not presorted:
+            df = df.sort_values([key, sort_col], kind='stable')
+        self.df = df.reset_index(drop=True)
+        self.key = key
+        self.sort_col = sort_col
+
+        keys = self.df[key].values
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) > 0 else np.zeros(0, dtype=np.int64)
+        self.names = keys[starts]
+        self.offsets = np.r_[starts, len(keys)].astype(np.int64)
+        self.sizes = np.diff(self.offsets)
+        self.codes = np.repeat(np.arange(len(self.names)), self.sizes)
+
+        # requests summed up to and including each row within its ad unit, and as a proportion of the unit's total
+        requests = self.df['requests'].values.astype(np.float64)
+        cum = np.cumsum(requests)
+        unit_start_cum = cum[starts] - requests[starts]
+        self.cum_requests = cum - np.repeat(unit_start_cum, self.sizes)
+        self.total_requests = self.cum_requests[self.offsets[1:] - 1] if len(keys) > 0 else np.zeros(0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.cum_requests_prop = self.cum_requests / self.total_requests[self.codes]
+        self.prefix_sums = {}
+
+    def group_cumsum(self, values):
+        return pd.Series(values).groupby(self.codes).cumsum().values
+
+    def prefix_sum(self, col):
+        # cumulative sum of a column (or of cpma * floor_price for 'cpma*floor_price') within each unit, cached
+        if col not in self.prefix_sums:
+            if col.endswith('*floor_price'):
+                values = self.df[col.split('*')[0]].values * self.df['floor_price'].values
+            else:
+                values = self.df[col].values
+            self.prefix_sums[col] = self.group_cumsum(values.astype(np.float64))
+        return self.prefix_sums[col]
+
+    def broadcast_queries(self, queries, per_unit):
+        # per_unit: one value, or one row of k values, per unit. otherwise a scalar or k values shared by every unit
+        queries = np.asarray(queries, dtype=np.float64)
+        if per_unit:
+            return queries.reshape(len(self), -1)
+        return np.broadcast_to(queries.reshape(1, -1), (len(self), queries.size))
+
+    def searchsorted(self, values, queries, side='left', per_unit=False):
+        # np.searchsorted within each unit's block of values (sorted within the unit), for a (units, k)
+        # array of queries at once: a vectorised binary search over every block in parallel
+        queries = self.broadcast_queries(queries, per_unit)
+        k = queries.shape[1]
+        lo = np.repeat(self.offsets[:-1], k)
+        hi = np.repeat(self.offsets[1:], k)
+        q = queries.ravel()
+        while True:
+            active = lo < hi
+            if not active.any():
+                break
+            mid = np.minimum((lo + hi) // 2, len(values) - 1)
+            v = values[mid]
+            go_right = active & ((v < q) if side == 'left' else (v <= q))
+            lo = np.where(go_right, mid + 1, lo)
+            hi = np.where(active & ~go_right, mid, hi)
+        return lo.reshape(len(self), k)
+
+    def floor_price_at_request_prop(self, thresholds):
+        # the highest floor price with requests.cumsum() / requests.sum() < threshold, nan if there is none.
+        # thresholds are shared by every unit, the result is (units, thresholds)
+        cum_prop = np.nan_to_num(self.cum_requests_prop, nan=np.inf)
+        pos = self.searchsorted(cum_prop, thresholds, side='left')
+        floor_price = self.df['floor_price'].values
+        found = pos > self.offsets[:-1, None]
+        return np.where(found, floor_price[np.maximum(pos - 1, 0)], np.nan)
+
+    def cpma_weighted_floor_price(self, floor_price_limits, cpma_col='cpma'):
+        # calculate_target_floor_price for every unit: the cpma weighted mean floor price up to the limit.
+        # floor_price_limits has one limit (or one row of limits) per unit, the result is (units, limits)
+        pos = self.searchsorted(self.df['floor_price'].values, floor_price_limits, side='right', per_unit=True)
+        found = pos > self.offsets[:-1, None]
+        last = np.maximum(pos - 1, 0)
+        cpma = np.where(found, self.prefix_sum(cpma_col)[last], 0)
+        cpma_floor_price = np.where(found, self.prefix_sum(f'{cpma_col}*floor_price')[last], 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(cpma == 0, np.nan, cpma_floor_price / cpma)
+
+    def __len__(self):
+        return len(self.names)
+
+    def rows(self, i):
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+    def unit(self, i):
+        # a slice of the sorted frame, which pandas returns without copying the data
+        return self.df.iloc[self.rows(i)]
+
+    def __iter__(self):
+        for i, name in enumerate(self.names):
+            yield name, self.unit(i)
+
+    def filter(self, mask):
+        # rows where mask (over self.df) is true, still sorted, with the cumulative requests recomputed
+        return AdUnitGroups(self.df[np.asarray(mask)], self.key, self.sort_col, presorted=True)
+
+    def below_request_prop(self, threshold):
+        # each unit's floor prices up to threshold of its requests, the requests.cumsum() / requests.sum() < threshold filter
+        return self.filter(self.cum_requests_prop < threshold)
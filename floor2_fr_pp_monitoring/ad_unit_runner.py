@@ -0,0 +1,102 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from ad_unit_groups import AdUnitGroups
+
+# runs a per unit pipeline over shards of an AdUnitGroups in a process pool. the numeric columns (the only ones
+# the workers see, besides the unit key) are put in
+# shared memory once, and each worker maps the rows of its shard from there instead of being sent a pickled
+# DataFrame. shard_fn(units, first_unit, shard, **kwargs) gets its shard as an AdUnitGroups (first_unit is
+# the shard's first unit's position in the whole set, for numbering plots) and returns a DataFrame; the
+# shards' results are concatenated in unit order, so the output doesn't depend on the number of workers:
+#   df = run_ad_unit_shards(units, shard_fn, workers=8, align=8, target_fill_rate=0.7)
+
+
+def share_columns(df):
+    # numeric columns to shared memory blocks, returns the blocks (to unlink later) and how to find them
+    blocks = []
+    spec = {}
+    for col in df.columns:
+        if not pd.api.types.is_numeric_dtype(df[col]):
+            continue
+        values = df[col].to_numpy()
+        if values.dtype == object:
+            # nullable integer columns
+            values = df[col].to_numpy(dtype=np.float64, na_value=np.nan)
+        block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[:] = values
+        blocks.append(block)
+        spec[col] = (block.name, values.dtype.str, values.shape)
+    return blocks, spec
+
+
+def attach_shard(spec, key, names, offsets, unit_lo, unit_hi):
+    # the rows of units unit_lo..unit_hi-1 as a DataFrame, read from the shared blocks
+    row_lo, row_hi = offsets[unit_lo], offsets[unit_hi]
+    blocks = []
+    columns = {key: np.repeat(np.asarray(names[unit_lo:unit_hi], dtype=object), np.diff(offsets[unit_lo:unit_hi + 1]))}
+    for col, (name, dtype, shape) in spec.items():
+        block = shared_memory.SharedMemory(name=name)
+        blocks.append(block)
+        columns[col] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)[row_lo:row_hi].copy()
+    for block in blocks:
+        block.close()
+    return pd.DataFrame(columns)
+
+
+def run_shard(spec, key, names, offsets, shard, unit_lo, unit_hi, shard_fn, kwargs):
+    start = time.time()
+    units = AdUnitGroups(attach_shard(spec, key, names, offsets, unit_lo, unit_hi), key=key, presorted=True)
+    attach_s = time.time() - start
+    result = shard_fn(units, unit_lo, shard, **kwargs)
+    return result, {'shard': shard, 'units': unit_hi - unit_lo, 'rows': int(offsets[unit_hi] - offsets[unit_lo]),
+                    'attach_s': attach_s, 'seconds': time.time() - start}
+
+
+def shard_bounds(units, shard_count, align=1):
+    # contiguous shards of about the same number of rows, each starting on a multiple of align units
+    cum_rows = units.offsets[1:]
+    bounds = [0]
+    for k in range(1, shard_count):
+        u = int(np.searchsorted(cum_rows, cum_rows[-1] * k / shard_count))
+        u = (u // align) * align
+        if u > bounds[-1]:
+            bounds.append(u)
+    bounds.append(len(units))
+    return [(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+
+
+def run_ad_unit_shards(units, shard_fn, workers=1, align=1, shards_per_worker=1, report=True, **kwargs):
+    start = time.time()
+    if workers <= 1:
+        result, timing = shard_fn(units, 0, 0, **kwargs), {'shard': 0, 'units': len(units), 'rows': len(units.df),
+                                                           'attach_s': 0.0}
+        timing['seconds'] = time.time() - start
+        results_and_timings = [(result, timing)]
+    else:
+        bounds = shard_bounds(units, workers * shards_per_worker, align)
+        blocks, spec = share_columns(units.df.drop(columns=[units.key]))
+        try:
+            with ProcessPoolExecutor(max_workers=min(workers, len(bounds))) as executor:
+                futures = [executor.submit(run_shard, spec, units.key, units.names, units.offsets, shard, lo, hi, shard_fn, kwargs)
+                           for shard, (lo, hi) in enumerate(bounds)]
+                results_and_timings = [future.result() for future in futures]
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+    wall_s = time.time() - start
+
+    if report:
+        print_shard_timings(pd.DataFrame([t for _, t in results_and_timings]), wall_s, workers)
+    return pd.concat([r for r, _ in results_and_timings], ignore_index=True)
+
+
+def print_shard_timings(df_timings, wall_s, workers):
+    print(df_timings.to_string(index=False, float_format='{:0.2f}'.format))
+    print(f'{len(df_timings)} shards on {max(workers, 1)} workers in {wall_s:0.1f}s wall time, '
+          f'{df_timings["seconds"].sum():0.1f}s summed shard time, slowest shard {df_timings["seconds"].max():0.1f}s')
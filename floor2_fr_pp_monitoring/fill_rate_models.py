@@ -0,0 +1,155 @@
+import os, sys
+import numpy as np
+import pandas as pd
+sys.path.append(os.path.join(sys.path[0], '..'))
+from utils.batched_regression import batched_wls, batched_predict
+
+# the fill rate and cpm models of main_direct_targetting, each a linear fit of a transformed data column on
+# signed features of the floor price. the features and targets are shared between the families, so a dataset's
+# are computed once however many families are fitted to it:
+#   register_family('fill_rate_power_law', [('log_floor_price', -1)], 'log_fill_rate')
+#   preds = fit_families(units.df, units.codes, len(units), True, 'request_limit')
+
+# feature of the floor price, and back to the floor price from it
+shared_features = {
+    'floor_price': (lambda fp: fp, lambda x: x),
+    'log_floor_price': (np.log, np.exp),
+}
+
+# (data column, transform of the column, back from the linear predictor to the column)
+shared_targets = {
+    'cpm': ('cpm', lambda y: y, lambda eta: eta),
+    'log_fill_rate': ('fill_rate', np.log, np.exp),
+    'log_neg_log_fill_rate': ('fill_rate', lambda fr: np.log(-np.log(fr)), lambda eta: np.exp(-np.exp(eta))),
+}
+
+model_families = {}
+
+
+def register_family(name, features, target):
+    # features are (shared feature, sign) pairs, the sign chosen so the positive fit's coefficients are >= 0
+    model_families[name] = {'features': features, 'target': target}
+
+
+register_family('cpm_model', [('floor_price', 1)], 'cpm')
+register_family('fill_rate_exp', [('floor_price', -1)], 'log_fill_rate')
+register_family('fill_rate_power_law', [('log_floor_price', -1)], 'log_fill_rate')
+register_family('fill_rate_combined_exp_power_law', [('log_floor_price', -1), ('floor_price', -1)], 'log_fill_rate')
+register_family('fill_rate_exp_of_power_law', [('log_floor_price', 1)], 'log_neg_log_fill_rate')
+
+
+def family_column(family):
+    return shared_targets[model_families[family]['target']][0]
+
+
+def family_features(family, floor_prices, design=None):
+    # the family's design matrix (rows, p), from the shared features when they have been computed
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.stack([sign * (design[feature] if design is not None else shared_features[feature][0](floor_prices))
+                         for feature, sign in model_families[family]['features']], axis=1)
+
+
+def shared_design(df, families):
+    # every feature and target the families use, each computed once
+    floor_prices = df['floor_price'].values.astype(np.float64)
+    design = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for family in families:
+            for feature, sign in model_families[family]['features']:
+                if feature not in design:
+                    design[feature] = shared_features[feature][0](floor_prices)
+            target = model_families[family]['target']
+            if target not in design:
+                col, transform, link = shared_targets[target]
+                design[target] = transform(df[col].values.astype(np.float64))
+    return design
+
+
+def fit_all(df, codes, n_groups, fit_intercept, fit_method, families=None, positive=True):
+    # coef (n_groups, p), intercept (n_groups,) and the predictions of each family. the families with the same
+    # number of features are stacked, as n_groups groups each, into a single batched fit
+    assert fit_method in ['weighted', 'request_limit']
+    families = list(model_families.keys()) if families is None else families
+    design = shared_design(df, families)
+    w = df['requests'].values.astype(np.float64) if fit_method == 'weighted' else np.ones(len(df))
+
+    fits = {}
+    for p in sorted(set(len(model_families[family]['features']) for family in families)):
+        stacked = [family for family in families if len(model_families[family]['features']) == p]
+        X = np.concatenate([family_features(family, None, design) for family in stacked])
+        y = np.concatenate([design[model_families[family]['target']] for family in stacked])
+        stacked_codes = np.concatenate([codes + k * n_groups for k in range(len(stacked))])
+        coef, intercept = batched_wls(X, y, np.tile(w, len(stacked)), stacked_codes, n_groups * len(stacked),
+                                      fit_intercept=fit_intercept, positive=positive)
+        for k, family in enumerate(stacked):
+            group_slice = slice(k * n_groups, (k + 1) * n_groups)
+            link = shared_targets[model_families[family]['target']][2]
+            with np.errstate(over='ignore', invalid='ignore'):
+                pred = link(batched_predict(X[k * len(df):(k + 1) * len(df)], coef[group_slice], intercept[group_slice], codes))
+            fits[family] = (coef[group_slice], intercept[group_slice], pred)
+    return {family: fits[family] for family in families}
+
+
+def fit_family(df, codes, n_groups, family, fit_intercept, fit_method, positive=True):
+    # one model family fitted to every ad unit in df at once, as fit_model does for one ad unit.
+    # returns the per unit coef (n_groups, p) and intercept (n_groups,) and the predictions for every row
+    return fit_all(df, codes, n_groups, fit_intercept, fit_method, [family], positive)[family]
+
+
+def fit_families(df, codes, n_groups, fit_intercept, fit_method, families=None, positive=True):
+    # the predictions of each family, in model_families order
+    return {family: pred for family, (coef, intercept, pred) in fit_all(df, codes, n_groups, fit_intercept, fit_method, families, positive).items()}
+
+
+def family_errors(df, codes, names, cols):
+    # mean absolute error of each fitted fill rate column per unit, and normalised by the column's mean
+    df_error = df[cols].sub(df['fill_rate'], axis=0)
+    mae = np.abs(df_error).groupby(codes).mean().set_axis(names)
+    mae_norm = mae / df[cols].groupby(codes).mean().set_axis(names)
+    return pd.concat([mae.add_suffix('_mae'), mae_norm.add_suffix('_mae_norm')], axis=1)
+
+
+def predict_family(family, coef, intercept, floor_prices):
+    # the fitted column of each unit at a (units, k) array of floor prices
+    link = shared_targets[model_families[family]['target']][2]
+    codes = np.repeat(np.arange(len(coef)), floor_prices.shape[1])
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        return link(batched_predict(family_features(family, floor_prices.ravel()), coef, intercept, codes)).reshape(floor_prices.shape)
+
+
+def bisect_floor_prices(family, coef, intercept, targets, floor_price_min, floor_price_max, iterations):
+    # bisection on log floor price for every unit and target at once, the fitted fill rates decreasing with floor price
+    lo = np.log(np.broadcast_to(floor_price_min, targets.shape))
+    hi = np.log(np.broadcast_to(floor_price_max, targets.shape))
+    for _ in range(iterations):
+        mid = (lo + hi) / 2
+        above = predict_family(family, coef, intercept, np.exp(mid)) > targets
+        lo = np.where(above, mid, lo)
+        hi = np.where(above, hi, mid)
+    return np.exp((lo + hi) / 2)
+
+
+def target_floor_prices(family, coef, intercept, target_fill_rates, floor_price_min, floor_price_max, iterations=60):
+    # target_floor_price_from_fill_rate for every unit and every target fill rate, on the fitted curves rather
+    # than the floor price grid: (units, targets), 0 where the fill rate is below the target at floor_price_min,
+    # nan where it is above the target at floor_price_max (floor_price_min/max per unit, e.g. its data's range)
+    col, transform, link = shared_targets[model_families[family]['target']]
+    assert col == 'fill_rate'
+    targets = np.broadcast_to(np.asarray(target_fill_rates, dtype=np.float64).reshape(1, -1), (len(coef), np.size(target_fill_rates)))
+    floor_price_min = np.asarray(floor_price_min, dtype=np.float64).reshape(-1, 1)
+    floor_price_max = np.asarray(floor_price_max, dtype=np.float64).reshape(-1, 1)
+
+    if len(model_families[family]['features']) == 1:
+        # a single feature inverts in closed form
+        (feature, sign), = model_families[family]['features']
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            floor_prices = shared_features[feature][1]((transform(targets) - intercept[:, None]) / (sign * coef[:, [0]]))
+    else:
+        floor_prices = bisect_floor_prices(family, coef, intercept, targets, floor_price_min, floor_price_max, iterations)
+
+    fill_rate_min = predict_family(family, coef, intercept, floor_price_min)
+    fill_rate_max = predict_family(family, coef, intercept, floor_price_max)
+    floor_prices = np.where(fill_rate_max > targets, np.nan, floor_prices)
+    floor_prices = np.where(fill_rate_min < targets, 0, floor_prices)
+    floor_prices[~np.isfinite(intercept)] = np.nan
+    return floor_prices
@@ -1,15 +1,22 @@
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from google.cloud import bigquery
 import configparser
-from google.cloud import bigquery_storage
+import argparse
 import os, sys
 import datetime
 import pickle
 import scipy
 from matplotlib.backends.backend_pdf import PdfPages
 from sklearn.linear_model import LinearRegression
+sys.path.append(os.path.join(sys.path[0], '..'))
+from utils.bq import run_query
+from utils.query_cache import get_cached_data, get_cached_keyed_data
+from utils.ecdf import merged_ecdf
+from fill_rate_models import model_families, shared_targets, family_features, family_column, fit_family, fit_families, family_errors, target_floor_prices
+from ad_unit_groups import AdUnitGroups
+from ad_unit_runner import run_ad_unit_shards
+from model_store import unit_fingerprints, params_key, load_model_store, save_model_store, units_to_refit, update_model_store
 
 pd.set_option('display.max_columns', None)
 pd.set_option('display.width', 1000)
@@ -19,35 +26,30 @@ config = configparser.ConfigParser()
 config.read(config_path)
 
 project_id = "streamamp-qa-239417"
-client = bigquery.Client(project=project_id)
-bqstorageclient = bigquery_storage.BigQueryReadClient()
 
 
 def get_bq_data(query, replacement_dict={}):
     for k, v in replacement_dict.items():
         query = query.replace("{" + k + "}", f'{v}')
 
-    result = client.query(query).result()
-    if result is None:
-        return
-
-    return result.to_dataframe(bqstorage_client=bqstorageclient)
-
-def get_data(query_filename, data_cache_filename, force_requery=False, repl_dict = {}):
-    data_cache_filename_full = f'data_cache/{data_cache_filename}.pkl'
-
-    if not force_requery and os.path.exists(data_cache_filename_full):
-        print(f'found existing data_cache file, loading {data_cache_filename_full}')
-        with open(data_cache_filename_full, 'rb') as f:
-            df = pickle.load(f)
-        return df
+    return run_query(project_id, query, progress_bar_type=None)
 
+def get_data(query_filename, data_cache_filename, force_requery=False, repl_dict = {}, columns=None, filters=None):
     query = open(os.path.join(sys.path[0], f"queries/{query_filename}.sql"), "r").read()
-    df = get_bq_data(query, repl_dict)
+    return get_cached_data(query, repl_dict, get_bq_data, force_requery=force_requery, name=data_cache_filename,
+                           columns=columns, filters=filters)
+
+def get_ad_unit_data(ad_unit_names, force_requery=False, max_age_hours=24):
+    # query_direct_targetting for many ad units in one query, cached together, only the ad units not cached yet are queried.
+    # the whole entry is requeried once it is older than max_age_hours, as floors_ad_unit_base is rebuilt
+    query = open(os.path.join(sys.path[0], "queries/query_direct_targetting_ad_units.sql"), "r").read()
+    return get_cached_keyed_data(query, {}, get_bq_data, 'ad_unit_name', ad_unit_names, 'ad_unit_filter',
+                                 force_requery=force_requery, name='direct_targetting_ad_units', max_age_hours=max_age_hours)
 
-    with open(data_cache_filename_full, 'wb') as f:
-        pickle.dump(df, f)
-    return df
+def ad_unit_slices(df_all):
+    # the rows of each ad unit without the ad_unit_name column, as query_direct_targetting returns them
+    return {ad_unit_name: df.drop(columns='ad_unit_name').reset_index(drop=True)
+            for ad_unit_name, df in df_all.groupby('ad_unit_name', sort=False)}
 
 def main_base():
 
@@ -96,7 +98,7 @@ def main_ad_unit_filter(ad_unit_filter):
     fig.savefig(f'plots_direct/plot_base_{sp2}.png')
 
 
-def main_ad_unit_multiple():
+def main_ad_unit_multiple(force_requery=True):
 
     target_fill_rate = 0.7
     N = 40
@@ -111,6 +113,7 @@ def main_ad_unit_multiple():
 
     query = f'select ad_unit_name from `streamamp-qa-239417.Floors_2_0.floors_ad_unit_dash` group by 1 order by sum(requests) desc limit {N}'
     df_ad_unit_name = get_bq_data(query)
+    df_ad_units = ad_unit_slices(get_ad_unit_data(df_ad_unit_name['ad_unit_name'].tolist(), force_requery=force_requery))
 
     n_p = 0
     nn_p = 0
@@ -120,10 +123,8 @@ def main_ad_unit_multiple():
             if n_p==0:
                 fig, ax = plt.subplots(figsize=(25, 20), nrows=N_p, ncols=len(plot_specs))
 
-            repl_dict = {'ad_unit_filter': f'ad_unit_name = "{ad_unit_name}"'}
-            query_file = 'query_direct_targetting'
-            print(f'doing: {query_file} for: {repl_dict["ad_unit_filter"]}, {i} of {N}')
-            df = get_data(query_file, ad_unit_name.replace('/', '_'), repl_dict=repl_dict, force_requery=True)
+            print(f'doing: {ad_unit_name}, {i} of {N}')
+            df = df_ad_units[ad_unit_name]
             df = df.set_index('floor_price')
             df = df[df['optimised_requests'] > 0]
 
@@ -172,7 +173,27 @@ def calculate_target_floor_price(df, floor_price_limit, cpma_col_name='optimised
 
     return (df_limit[cpma_col_name] * df_limit.index).sum() / df_limit[cpma_col_name].sum()
 
-def main_ad_unit_multiple_price_pressure():
+def exp_model_target_floor_prices(units, lamb, F0, alpha, beta, target_fill_rate, limit_fill_rate, ad_request_cum_prop_threshold):
+    # the target floor prices of the fill_rate = F0 * exp(-lamb * floor_price), cpm = alpha + beta * floor_price
+    # models for every unit at once, capped at the unit's highest floor price. nan where lamb is 0
+    X_max = units.df['floor_price'].values[units.offsets[1:] - 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        max_cpma = np.where(beta == 0, 0, np.clip(np.minimum(1 / lamb - alpha / beta, X_max), 0, None))
+        target_floor_price = np.clip(np.minimum(-np.log(target_fill_rate / F0) / lamb, X_max), 0, None)
+        floor_price_limit_fill_rate = np.clip(np.minimum(-np.log(limit_fill_rate / F0) / lamb, X_max), 0, None)
+    limit_fill_rate_floor_price = np.minimum(units.cpma_weighted_floor_price(floor_price_limit_fill_rate)[:, 0], X_max)
+
+    floor_price_limit_ad_request_threshold = units.floor_price_at_request_prop(ad_request_cum_prop_threshold)[:, 0]
+    ad_request_threshold_floor_price = np.minimum(units.cpma_weighted_floor_price(floor_price_limit_ad_request_threshold)[:, 0], X_max)
+
+    no_fit = lamb == 0
+    return pd.DataFrame({'ad_unit_name': units.names,
+                         'cpma_weighted_limit_fill_rate': np.where(no_fit, np.nan, limit_fill_rate_floor_price),
+                         'cpma_weighted_limit_ad_request_threshold': ad_request_threshold_floor_price,
+                         'max_cpma_dual_model': np.where(no_fit, np.nan, max_cpma),
+                         'target_fill_rate': np.where(no_fit, np.nan, target_floor_price)})
+
+def main_ad_unit_multiple_price_pressure(force_requery=False):
 
     ad_request_cum_prop_threshold = 0.975
     plots_name = 'price_pressure'
@@ -190,6 +211,7 @@ def main_ad_unit_multiple_price_pressure():
 
     query = f'select ad_unit_name from `streamamp-qa-239417.Floors_2_0.floors_ad_unit_dash` group by 1 order by sum(requests) desc limit {N}'
     df_ad_unit_name = get_bq_data(query)
+    df_ad_units = ad_unit_slices(get_ad_unit_data(df_ad_unit_name['ad_unit_name'].tolist(), force_requery=force_requery))
 
     n_p = 0
     nn_p = 0
@@ -200,10 +222,8 @@ def main_ad_unit_multiple_price_pressure():
             if n_p == 0:
                 fig, ax = plt.subplots(figsize=(25, 20), nrows=N_p, ncols=len(plot_specs))
 
-            repl_dict = {'ad_unit_filter': f'ad_unit_name = "{ad_unit_name}"'}
-            query_file = 'query_direct_targetting'
-            print(f'doing: {query_file} for: {repl_dict["ad_unit_filter"]}, {i} of {N}')
-            df = get_data(query_file, ad_unit_name.replace('/', '_'), repl_dict=repl_dict, force_requery=False)
+            print(f'doing: {ad_unit_name}, {i} of {N}')
+            df = df_ad_units[ad_unit_name]
 
             df_baseline = df[df['baseline_requests'] > 0]
             assert(len(df_baseline)==1)
@@ -280,58 +300,20 @@ def main_ad_unit_compare():
 
     print(f'doing: {query_file}')
     df_all = get_data(query_file, f'compare_multiple_{ad_unit_count}', repl_dict=repl_dict, force_requery=True)
-    ad_unit_names = df_all['ad_unit_name'].unique()
+    units = AdUnitGroups(df_all[df_all['fill_rate'] > 0])
+
+    lamb, _, units.df['pred_fill_rate'] = fit_family(units.df, units.codes, len(units), 'fill_rate_exp', False, 'weighted')
+    beta, alpha, units.df['pred_cpm'] = fit_family(units.df, units.codes, len(units), 'cpm_model', True, 'weighted')
+    df_target_floor_price = exp_model_target_floor_prices(units, lamb[:, 0], 1, alpha, beta[:, 0], target_fill_rate,
+                                                          limit_fill_rate, ad_request_cum_prop_threshold)
 
     if do_plots:
         pdf = PdfPages(f'plots_direct/compare_pdf.pdf')
-    target_floor_price_list = []
-    for ad_unit_name in ad_unit_names:
-        df = df_all[df_all['ad_unit_name'] == ad_unit_name]
-        df = df[df['fill_rate'] > 0]
-        if len(df) == 0:
-            continue
-
-        X = -df[['floor_price']]
-        X_max = (-X).max().max()
-        y = np.log(df['fill_rate'])
-        fill_rate_regressor = LinearRegression(fit_intercept=False, positive=True).fit(X, y, sample_weight=df['requests'])
-        lamb = fill_rate_regressor.coef_[0]
-
-        X_cpm = df[['floor_price']]
-        y = df['cpm']
-        cpm_regressor = LinearRegression(fit_intercept=True, positive=True).fit(X_cpm, y, sample_weight=df['requests'])
-        alpha = cpm_regressor.intercept_
-        beta = cpm_regressor.coef_[0]
-
-        df = df.set_index('floor_price')
-
-        if lamb == 0:
-            target_floor_price = np.nan
-            target_floor_price_limit_fill_rate = np.nan
-        else:
-            if beta == 0:
-                target_floor_price_max_cpma = 0
-            else:
-                target_floor_price_max_cpma = max(min(1 / lamb - alpha / beta, X_max), 0)
-            target_floor_price = min(-np.log(target_fill_rate) / lamb, X_max)
-            floor_price_limit_fill_rate = min(-np.log(limit_fill_rate) / lamb, X_max)
-            target_floor_price_limit_fill_rate = min(calculate_target_floor_price(df, floor_price_limit_fill_rate, 'cpma'), X_max)
-
-        floor_price_limit_ad_request_threshold = df[df['requests'].cumsum() / df['requests'].sum() < ad_request_cum_prop_threshold].index.max()
-        target_floor_price_limit_ad_request_threshold = min(calculate_target_floor_price(df, floor_price_limit_ad_request_threshold, 'cpma'), X_max)
-
-        target_floor_price_list.append({'ad_unit_name': ad_unit_name,
-                                        'cpma_weighted_limit_fill_rate': target_floor_price_limit_fill_rate,
-                                        'cpma_weighted_limit_ad_request_threshold': target_floor_price_limit_ad_request_threshold,
-                                        'max_cpma_dual_model': target_floor_price_max_cpma,
-                                        'target_fill_rate': target_floor_price})
-
-        if do_plots:
+        for i, (ad_unit_name, df) in enumerate(units):
+            target_floor_price_limit_fill_rate, target_floor_price_limit_ad_request_threshold, target_floor_price_max_cpma, target_floor_price = \
+                df_target_floor_price.iloc[i][['cpma_weighted_limit_fill_rate', 'cpma_weighted_limit_ad_request_threshold', 'max_cpma_dual_model', 'target_fill_rate']]
             fig, ax = plt.subplots(figsize=(16, 12), nrows=2)
-            df_plot = df.copy()
-
-            df_plot['pred_fill_rate'] = np.exp(fill_rate_regressor.predict(X))
-            df_plot['pred_cpm'] = cpm_regressor.predict(X_cpm)
+            df_plot = df.set_index('floor_price')
             df_plot['pred_cpma'] = df_plot['pred_cpm'] * df_plot['pred_fill_rate']
 
             y_max = 1
@@ -364,12 +346,8 @@ def main_ad_unit_compare():
             ax[1].set_xlim([0, x_max])
             ax[1].set_ylim([0, y_max])
             pdf.savefig()
-
-
-    if do_plots:
         pdf.close()
 
-    df_target_floor_price = pd.DataFrame(target_floor_price_list)
     df_target_floor_price.to_csv(f'plots_direct/df_target_floor_price_{ad_unit_count}.csv')
 
 def main_ad_unit_compare_do_plots(filename, x_col='cpma_weighted_limit_ad_request_threshold', y_cols=['cpma_weighted_limit_fill_rate', 'target_fill_rate', 'max_cpma_dual_model']):
@@ -400,6 +378,7 @@ def main_ad_unit_compare_do_plots(filename, x_col='cpma_weighted_limit_ad_reques
 
         fig.savefig(f'plots_direct/{filename}_scatterplot_{y_col}.png')
 
+    cum_plot(df[[x_col] + list(y_cols)], f'{filename}_cum_plot')
 
 
 def main_ad_unit_compare_limit_fill_rate():
@@ -412,37 +391,23 @@ def main_ad_unit_compare_limit_fill_rate():
 
     print(f'doing: {query_file}')
     df_all = get_data(query_file, f'compare_multiple_{repl_dict["ad_unit_count"]}', repl_dict=repl_dict, force_requery=False)
-    ad_unit_names = df_all['ad_unit_name'].unique()
-
-    results_list = []
-    for ad_unit_name in ad_unit_names:
-        df = df_all[df_all['ad_unit_name'] == ad_unit_name]
-        df = df[df['fill_rate'] > 0]
-        if len(df) == 0:
-            continue
-
-        X = -df[['floor_price']]
-        X_max = (-X).max().max()
-        y = np.log(df['fill_rate'])
-        regressor = LinearRegression(fit_intercept=False, positive=True).fit(X, y, sample_weight=df['requests'])
-
-        df = df.set_index('floor_price')
-        floor_price_limit_ad_request_threshold = df[df['requests'].cumsum() / df['requests'].sum() < ad_request_cum_prop_threshold].index.max()
-        target_floor_price_limit_ad_request_threshold = min(calculate_target_floor_price(df, floor_price_limit_ad_request_threshold, 'cpma'), X_max)
-
-        if regressor.coef_[0] == 0:
-            continue
-
-        results = {'ad_unit_name': ad_unit_name,
-                   'target_floor_price_limit_ad_request_threshold': target_floor_price_limit_ad_request_threshold}
-
-        for limit_fill_rate in limit_fill_rates:
-            floor_price_limit_fill_rate = min(-np.log(limit_fill_rate) / regressor.coef_[0], X_max)
-            target_floor_price_limit_fill_rate = min(calculate_target_floor_price(df, floor_price_limit_fill_rate, 'cpma'), X_max)
-            results[f'cpma_weighted_limit_fill_rate_{limit_fill_rate*100:0.0f}'] = target_floor_price_limit_fill_rate
-        results_list.append(results)
-
-    df = pd.DataFrame(results_list)
+    units = AdUnitGroups(df_all[df_all['fill_rate'] > 0])
+
+    lamb = fit_family(units.df, units.codes, len(units), 'fill_rate_exp', False, 'weighted')[0][:, 0]
+    X_max = units.df['floor_price'].values[units.offsets[1:] - 1]
+
+    floor_price_limit_ad_request_threshold = units.floor_price_at_request_prop(ad_request_cum_prop_threshold)[:, 0]
+    results = {'ad_unit_name': units.names,
+               'target_floor_price_limit_ad_request_threshold':
+                   np.minimum(units.cpma_weighted_floor_price(floor_price_limit_ad_request_threshold)[:, 0], X_max)}
+
+    # every limit fill rate for every unit in one lookup
+    with np.errstate(divide='ignore'):
+        floor_price_limit_fill_rate = np.minimum(-np.log(limit_fill_rates)[None, :] / lamb[:, None], X_max[:, None])
+    target_floor_price_limit_fill_rate = np.minimum(units.cpma_weighted_floor_price(floor_price_limit_fill_rate), X_max[:, None])
+    for k, limit_fill_rate in enumerate(limit_fill_rates):
+        results[f'cpma_weighted_limit_fill_rate_{limit_fill_rate*100:0.0f}'] = target_floor_price_limit_fill_rate[:, k]
+    df = pd.DataFrame(results)[lamb != 0].reset_index(drop=True)
     df.to_csv(f'plots_direct/df_target_floor_price_limit_fill_rate_{repl_dict["ad_unit_count"]}.csv')
 
 def main_ad_unit_compare_limit_fill_rate_do_table(ad_unit_count=10000):
@@ -482,61 +447,29 @@ def main_ad_unit_cpm_model():
 
     print(f'doing: {query_file}')
     df_all = get_data(query_file, f'compare_multiple_{ad_unit_count}', repl_dict=repl_dict, force_requery=True)
-    ad_unit_names = df_all['ad_unit_name'].unique()
+    units = AdUnitGroups(df_all[df_all['fill_rate'] > 0])
 
     N_i = 0
     N_p_i = 0
     NN_p = 0
     if do_plots:
         pdf = PdfPages(f'plots_direct/compare_cpm_model_pdf.pdf')
-    target_floor_price_list = []
-    for ad_unit_name in ad_unit_names:
-        df = df_all[df_all['ad_unit_name'] == ad_unit_name]
-        df = df[df['fill_rate'] > 0]
-        if len(df) == 0:
-            continue
-
-        X = -df[['floor_price']]
-        X_max = (-X).max().max()
-        y = np.log(df['fill_rate'])
-        fill_rate_regressor = LinearRegression(fit_intercept=False, positive=True).fit(X, y, sample_weight=df['requests'])
-        lamb = fill_rate_regressor.coef_[0]
-
-        X_cpm = df[['floor_price']]
-        y = df['cpm']
-        cpm_regressor = LinearRegression(fit_intercept=True, positive=True).fit(X_cpm, y, sample_weight=df['requests'])
-        alpha = cpm_regressor.intercept_
-        beta = cpm_regressor.coef_[0]
 
-        df = df.set_index('floor_price')
+    lamb, _, units.df['pred_fill_rate'] = fit_family(units.df, units.codes, len(units), 'fill_rate_exp', False, 'weighted')
+    beta, alpha, units.df['pred_cpm'] = fit_family(units.df, units.codes, len(units), 'cpm_model', True, 'weighted')
+    df_target_floor_price = exp_model_target_floor_prices(units, lamb[:, 0], 1, alpha, beta[:, 0], target_fill_rate,
+                                                          limit_fill_rate, ad_request_cum_prop_threshold)
 
-        if lamb == 0:
-            target_floor_price = np.nan
-            target_floor_price_limit_fill_rate = np.nan
-        else:
-            target_floor_price_max_cpma = max(min(1 / lamb - alpha / beta, X_max), 0)
-            target_floor_price = min(-np.log(target_fill_rate) / lamb, X_max)
-            floor_price_limit_fill_rate = min(-np.log(limit_fill_rate) / lamb, X_max)
-            target_floor_price_limit_fill_rate = min(
-                calculate_target_floor_price(df, floor_price_limit_fill_rate, 'cpma'), X_max)
-
-        floor_price_limit_ad_request_threshold = df[
-            df['requests'].cumsum() / df['requests'].sum() < ad_request_cum_prop_threshold].index.max()
-        target_floor_price_limit_ad_request_threshold = min(
-            calculate_target_floor_price(df, floor_price_limit_ad_request_threshold, 'cpma'), X_max)
-
-        target_floor_price_list.append({'ad_unit_name': ad_unit_name,
-                                        'cpma_weighted_limit_fill_rate': target_floor_price_limit_fill_rate,
-                                        'cpma_weighted_limit_ad_request_threshold': target_floor_price_limit_ad_request_threshold,
-                                        'target_fill_rate': target_floor_price})
+    for i, (ad_unit_name, df) in enumerate(units):
+        df = df.set_index('floor_price')
+        target_floor_price_limit_fill_rate, target_floor_price_limit_ad_request_threshold, target_floor_price_max_cpma, target_floor_price = \
+            df_target_floor_price.iloc[i][['cpma_weighted_limit_fill_rate', 'cpma_weighted_limit_ad_request_threshold', 'max_cpma_dual_model', 'target_fill_rate']]
 
         if do_plots and (N_i < N):
             if N_p_i == 0:
                 fig, ax = plt.subplots(figsize=(20, 16), ncols=2, nrows=N_p)
 
             df_plot = df.copy()
-            df_plot['pred_fill_rate'] = np.exp(fill_rate_regressor.predict(X))
-            df_plot['pred_cpm'] = cpm_regressor.predict(X_cpm)
             df_plot['pred_cpma'] = df_plot['pred_cpm'] * df_plot['pred_fill_rate']
 
             y_max = 1
@@ -596,87 +529,38 @@ def main_ad_unit_combined_model():
 
     print(f'doing: {query_file}')
     df_all = get_data(query_file, f'compare_multiple_{ad_unit_count}', repl_dict=repl_dict, force_requery=False)
-    ad_unit_names = df_all['ad_unit_name'].unique()
 
     N_i = 0
     N_p_i = 0
     NN_p = 0
     if do_plots:
         pdf = PdfPages(f'plots_direct/{plotname}_pdf.pdf')
-    target_floor_price_list = []
-    for ad_unit_name in ad_unit_names:
-        df = df_all[df_all['ad_unit_name'] == ad_unit_name]
-        df = df[df['fill_rate'] > 0]
-        if len(df) == 0:
-            continue
-
-        df = df[df['floor_price'] <= 18]
-
-        X = -df[['floor_price']]
-        X_max = (-X).max().max()
-        y = np.log(df['fill_rate'])
-        fill_rate_regressor = LinearRegression(fit_intercept=True, positive=True).fit(X, y, sample_weight=df['requests'])
-        lamb = fill_rate_regressor.coef_[0]
-        F0 = np.exp(fill_rate_regressor.intercept_)
-
-        X_cpm = df[['floor_price']]
-        y_cpm = df['cpm']
-        cpm_regressor = LinearRegression(fit_intercept=True, positive=True).fit(X_cpm, y_cpm, sample_weight=df['requests'])
-        alpha = cpm_regressor.intercept_
-        beta = cpm_regressor.coef_[0]
-
-        y_ln = np.log(df['fill_rate'])
-        X_ln = -np.log(df[['floor_price']])
-        pow_fill_rate_regressor = LinearRegression(fit_intercept=True, positive=True).fit(X_ln, y_ln, sample_weight=df['requests'])
-        alpha_ln_ln = pow_fill_rate_regressor.intercept_
-        beta_ln_ln = pow_fill_rate_regressor.coef_[0]
-
-        y_ln = np.log(df['fill_rate'])
-        X_ln_n = -pd.concat([np.log(df[['floor_price']]), df[['floor_price']]], axis=1)
-        pow_exp_fill_rate_regressor = LinearRegression(fit_intercept=False, positive=True).fit(X_ln_n, y_ln, sample_weight=df['requests'])
-
-        y_ln_ln = np.log(-np.log(df['fill_rate']))
-        X_ln_ln = np.log(df[['floor_price']])
-        exp_pow_fill_rate_regressor = LinearRegression(fit_intercept=True, positive=True).fit(X_ln_ln, y_ln_ln, sample_weight=df['requests'])
-
-        y_ln_ln = np.log(-np.log(df['fill_rate']))
-        X_ln_ln = np.log(df[['floor_price']])
-        exp_pow_2_fill_rate_regressor = LinearRegression(fit_intercept=False, positive=True).fit(X_ln_ln, y_ln_ln, sample_weight=df['requests'])
 
-        df = df.set_index('floor_price')
+    units = AdUnitGroups(df_all[df_all['fill_rate'] > 0])
+    units = units.filter(units.df['floor_price'] <= 18)
+    df_fit = units.df
+    fit = lambda family, fit_intercept: fit_family(df_fit, units.codes, len(units), family, fit_intercept, 'weighted')
+
+    lamb, log_F0, df_fit['pred_fill_rate'] = fit('fill_rate_exp', True)
+    beta, alpha, df_fit['pred_cpm'] = fit('cpm_model', True)
+    df_fit['pred_fill_rate_pow'] = fit('fill_rate_power_law', True)[2]
+    df_fit['pred_fill_rate_pow_exp'] = fit('fill_rate_combined_exp_power_law', False)[2]
+    df_fit['pred_fill_rate_exp_pow'] = fit('fill_rate_exp_of_power_law', True)[2]
+    df_fit['pred_fill_rate_exp_pow_2'] = fit('fill_rate_exp_of_power_law', False)[2]
 
-        if lamb == 0:
-            target_floor_price = np.nan
-            target_floor_price_limit_fill_rate = np.nan
-        else:
-            target_floor_price_max_cpma = max(min(1 / lamb - alpha / beta, X_max), 0)
-            target_floor_price = max(0, min(-np.log(target_fill_rate / F0) / lamb, X_max))
-            floor_price_limit_fill_rate = max(0, min(-np.log(limit_fill_rate / F0) / lamb, X_max))
-            target_floor_price_limit_fill_rate = min(
-                calculate_target_floor_price(df, floor_price_limit_fill_rate, 'cpma'), X_max)
-
-        floor_price_limit_ad_request_threshold = df[
-            df['requests'].cumsum() / df['requests'].sum() < ad_request_cum_prop_threshold].index.max()
-        target_floor_price_limit_ad_request_threshold = min(
-            calculate_target_floor_price(df, floor_price_limit_ad_request_threshold, 'cpma'), X_max)
-
-        target_floor_price_list.append({'ad_unit_name': ad_unit_name,
-                                        'cpma_weighted_limit_fill_rate': target_floor_price_limit_fill_rate,
-                                        'cpma_weighted_limit_ad_request_threshold': target_floor_price_limit_ad_request_threshold,
-                                        'target_fill_rate': target_floor_price})
+    df_target_floor_price = exp_model_target_floor_prices(units, lamb[:, 0], np.exp(log_F0), alpha, beta[:, 0], target_fill_rate,
+                                                          limit_fill_rate, ad_request_cum_prop_threshold)
+
+    for i, (ad_unit_name, df) in enumerate(units):
+        df = df.set_index('floor_price')
+        target_floor_price_limit_fill_rate, target_floor_price_limit_ad_request_threshold, target_floor_price_max_cpma, target_floor_price = \
+            df_target_floor_price.iloc[i][['cpma_weighted_limit_fill_rate', 'cpma_weighted_limit_ad_request_threshold', 'max_cpma_dual_model', 'target_fill_rate']]
 
         if do_plots and (N_i < N):
             if N_p_i == 0:
                 fig, ax = plt.subplots(figsize=(20, 16), ncols=2, nrows=N_p)
 
             df_plot = df.copy()
-            df_plot['pred_fill_rate'] = np.exp(fill_rate_regressor.predict(X))
-            df_plot['pred_fill_rate_pow'] = np.exp(pow_fill_rate_regressor.predict(X_ln))
-            df_plot['pred_fill_rate_pow_exp'] = np.exp(pow_exp_fill_rate_regressor.predict(X_ln_n))
-            df_plot['pred_fill_rate_exp_pow'] = np.exp(-np.exp(exp_pow_fill_rate_regressor.predict(X_ln_ln)))
-            df_plot['pred_fill_rate_exp_pow_2'] = np.exp(-np.exp(exp_pow_2_fill_rate_regressor.predict(X_ln_ln)))
-
-            df_plot['pred_cpm'] = cpm_regressor.predict(X_cpm)
             df_plot['pred_cpma'] = df_plot['pred_cpm'] * df_plot['pred_fill_rate']
 
             y_max = 1
@@ -719,18 +603,57 @@ def main_ad_unit_combined_model():
     if do_plots:
         pdf.close()
 
+def fit_regression(X, y, fit_intercept, fit_method, df, positive=True):
+    assert fit_method in ['weighted', 'request_limit']
+    if fit_method == 'weighted':
+        return LinearRegression(fit_intercept=fit_intercept, positive=positive).fit(X, y, sample_weight=df['requests'])
+    return LinearRegression(fit_intercept=fit_intercept, positive=positive).fit(X, y)
+
+
 def fit_model(X, y, fit_intercept, fit_method, df, positive=True):
 
     if np.isinf(X).any().any() or np.isinf(y).any():
         print('skipping because of inf')
         return np.ones(len(df)) * np.nan
 
-    assert fit_method in ['weighted', 'request_limit']
-    if fit_method == 'weighted':
-        reg = LinearRegression(fit_intercept=fit_intercept, positive=positive).fit(X, y, sample_weight=df['requests'])
-    else:
-        reg = LinearRegression(fit_intercept=fit_intercept, positive=positive).fit(X, y)
-    return reg.predict(X)
+    return fit_regression(X, y, fit_intercept, fit_method, df, positive).predict(X)
+
+
+def main_validate_batched_fits(ad_unit_count=1000, rtol=1e-6):
+    # the batched fits (including the non negative ones) against fit_model one ad unit at a time,
+    # on the cached compare_multiple data
+    repl_dict = {'ad_unit_count': ad_unit_count}
+    df_all = get_data('query_direct_targetting_multiple', f'compare_multiple_{ad_unit_count}', repl_dict=repl_dict,
+                      force_requery=False, columns=['ad_unit_name', 'floor_price', 'fill_rate', 'requests', 'cpm'])
+    units_ad = AdUnitGroups(df_all[df_all['fill_rate'] > 0])
+    units_ad = units_ad.filter(units_ad.df['floor_price'] <= 18)
+
+    results_list = []
+    for fit_method in ['weighted', 'request_limit']:
+        units = units_ad
+        if fit_method == 'request_limit':
+            units = units.below_request_prop(0.975)
+
+        for fit_intercept in [False, True]:
+            for family, pred in fit_families(units.df, units.codes, len(units), fit_intercept, fit_method).items():
+                col, transform, link = shared_targets[model_families[family]['target']]
+                max_rel_diff = 0
+                for i, (ad_unit_name, df) in enumerate(units):
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        X = family_features(family, df['floor_price'].values)
+                        y = transform(df[col].values)
+                    pred_ref = link(fit_model(X, y, fit_intercept, fit_method, df))
+                    pred_i = pred[units.rows(i)]
+                    assert (np.isnan(pred_ref) == np.isnan(pred_i)).all(), f'{ad_unit_name} {family}: fitted units differ'
+                    ok = ~np.isnan(pred_ref)
+                    if ok.any():
+                        max_rel_diff = max(max_rel_diff, (np.abs(pred_i[ok] - pred_ref[ok]) / np.maximum(np.abs(pred_ref[ok]), 1e-12)).max())
+                results_list.append({'fit_method': fit_method, 'fit_intercept': fit_intercept, 'family': family,
+                                     'max_rel_diff': max_rel_diff})
+
+    df_results = pd.DataFrame(results_list)
+    print(df_results)
+    assert (df_results['max_rel_diff'] < rtol).all(), 'batched fits differ from fit_model'
 
 
 def fill_rate_modelling():
@@ -747,51 +670,49 @@ def fill_rate_modelling():
     query_file = 'query_direct_targetting_multiple'
 
     print(f'doing: {query_file}')
-    df_all = get_data(query_file, f'compare_multiple_{ad_unit_count}', repl_dict=repl_dict, force_requery=False)
+    df_all = get_data(query_file, f'compare_multiple_{ad_unit_count}', repl_dict=repl_dict, force_requery=False,
+                      columns=['ad_unit_name', 'floor_price', 'fill_rate', 'requests', 'cpm'])
     ad_unit_names = df_all['ad_unit_name'].unique()
 
-    N_i = 0
     N_p_i = 0
     NN_p = 0
     if do_plots:
         pdf = PdfPages(f'plots_direct/{plotname}_{ad_unit_count}_pdf.pdf')
 
-    results_dict = {}
-    for ad_unit_name in ad_unit_names:
-        results_dict[ad_unit_name] = {}
-        df_ad = df_all[df_all['ad_unit_name'] == ad_unit_name]
-        df_ad = df_ad[df_ad['fill_rate'] > 0]
-        if len(df_ad) == 0:
-            continue
-
-        df_ad = df_ad[df_ad['floor_price'] <= 18]
-        for fm_i, fit_method in enumerate(['weighted', 'request_limit']):
-
-            df = df_ad.copy()
-            if fit_method == 'request_limit':
-                df = df[df['requests'].cumsum() / df['requests'].sum() < ad_request_cum_prop_threshold]
-
-            for fit_intercept in [False, True]:
-
-                df[f'cpm_model_{fit_method}_{fit_intercept}'] = fit_model(df[['floor_price']], df['cpm'], fit_intercept, fit_method, df)
-
-                df[f'fill_rate_exp_{fit_method}_{fit_intercept}'] = np.exp(fit_model(-df[['floor_price']], np.log(df['fill_rate']), fit_intercept, fit_method, df))
-
-                df[f'fill_rate_power_law_{fit_method}_{fit_intercept}'] = np.exp(fit_model(-np.log(df[['floor_price']]), np.log(df['fill_rate']), fit_intercept, fit_method, df))
+    # every ad unit is fitted at once, per fit method and intercept choice, then plotted one at a time
+    units_ad = AdUnitGroups(df_all[df_all['fill_rate'] > 0])
+    units_ad = units_ad.filter(units_ad.df['floor_price'] <= 18)
+    df_fits = {}
+    for fit_method in ['weighted', 'request_limit']:
+        units = units_ad
+        if fit_method == 'request_limit':
+            units = units.below_request_prop(ad_request_cum_prop_threshold)
 
-                df[f'fill_rate_combined_exp_power_law_{fit_method}_{fit_intercept}'] = np.exp(fit_model(-pd.concat([np.log(df[['floor_price']]), df[['floor_price']]], axis=1),
-                                                                np.log(df['fill_rate']), fit_intercept, fit_method, df))
+        # a copy per fit method, so one method's predictions aren't carried into the other's frame
+        units = AdUnitGroups(units.df.copy(), units.key, units.sort_col, presorted=True)
+        df = units.df
+        for fit_intercept in [False, True]:
+            for family, pred in fit_families(df, units.codes, len(units), fit_intercept, fit_method).items():
+                df[f'{family}_{fit_method}_{fit_intercept}'] = pred
 
-                df[f'fill_rate_exp_of_power_law_{fit_method}_{fit_intercept}'] = np.exp(-np.exp(fit_model(np.log(df[['floor_price']]), np.log(-np.log(df['fill_rate'])), fit_intercept, fit_method, df)))
+        cols = [c for c in df.columns if 'fill_rate' in c]
+        df_fits[fit_method] = (units, family_errors(df, units.codes, units.names, cols))
 
-            df = df.set_index('floor_price')
-            cols = [c for c in df.columns if 'fill_rate' in c]
-            df_error = df[cols].apply(lambda x: x - x['fill_rate'], axis=1)
+    results_weighted, results_request_limit = df_fits['weighted'][1], df_fits['request_limit'][1]
+    results_all = pd.concat([results_weighted, results_request_limit.drop(columns=results_weighted.columns, errors='ignore')],
+                            axis=1).reindex(ad_unit_names).rename_axis(None)
 
-            results_dict[ad_unit_name].update(dict(zip([f'{c}_mae' for c in df_error.columns], np.abs(df_error).mean().values)))
-            results_dict[ad_unit_name].update(dict(zip([f'{c}_mae_norm' for c in df_error.columns], (np.abs(df_error).mean() / df[cols].mean()).values)))
+    if do_plots:
+        plot_units = [n for n in ad_unit_names if n in df_fits['weighted'][1].index][:N_plot]
+        unit_index = {fit_method: dict(zip(units.names, range(len(units)))) for fit_method, (units, _) in df_fits.items()}
+        for ad_unit_name in plot_units:
+            for fm_i, fit_method in enumerate(['weighted', 'request_limit']):
+                if ad_unit_name not in unit_index[fit_method]:
+                    continue
+                df = df_fits[fit_method][0].unit(unit_index[fit_method][ad_unit_name]).set_index('floor_price')
+                cols = [c for c in df.columns if 'fill_rate' in c]
+                df_error = df[cols].apply(lambda x: x - x['fill_rate'], axis=1)
 
-            if do_plots and (N_i < N_plot):
                 if (N_p_i == 0) and (fm_i == 0):
                     fig, ax = plt.subplots(figsize=(24, 20), ncols=4, nrows=N_p)
 
@@ -805,18 +726,16 @@ def fill_rate_modelling():
                 if (fm_i == 0):
                     ax[N_p_i, fm_i * 2].set_ylabel(f'{NN_p+1}{N_p_i+1}: {ad_unit_name.split('/')[-1][:11]}')
 
-                if fm_i == 1:
-                    N_p_i += 1
-                    if N_p_i == N_p:
-                        fig.savefig(f'plots_direct/{plotname}_png_{ad_unit_count}_{NN_p}.png')
-                        pdf.savefig()
-                        NN_p += 1
-                        N_p_i = 0
+            N_p_i += 1
+            if N_p_i == N_p:
+                fig.savefig(f'plots_direct/{plotname}_png_{ad_unit_count}_{NN_p}.png')
+                pdf.savefig()
+                NN_p += 1
+                N_p_i = 0
 
     if do_plots:
         pdf.close()
 
-    results_all = pd.DataFrame(results_dict).transpose()
     results_all.to_csv(f'plots_direct/{plotname}_all_results_{ad_unit_count}.csv')
 
     results_summary = pd.concat([results_all.mean().to_frame('mean'), results_all.std().to_frame('std')], axis=1)
@@ -837,7 +756,6 @@ def fill_rate_modelling_selected():
 
     print(f'doing: {query_file}')
     df_all = get_data(query_file, f'compare_multiple_{ad_unit_count}', repl_dict=repl_dict, force_requery=False)
-    ad_unit_names = df_all['ad_unit_name'].unique()
 
     N_i = 0
     N_p_i = 0
@@ -845,32 +763,17 @@ def fill_rate_modelling_selected():
     if do_plots:
         pdf = PdfPages(f'plots_direct/{plotname}_{ad_unit_count}_pdf.pdf')
 
-    for ad_unit_name in ad_unit_names:
-        df_ad = df_all[df_all['ad_unit_name'] == ad_unit_name]
-        df_ad = df_ad[df_ad['fill_rate'] > 0]
-        if len(df_ad) == 0:
-            continue
+    units = AdUnitGroups(df_all[df_all['fill_rate'] > 0])
+    units = units.filter(units.df['floor_price'] <= 18)
+    fit_method = 'request_limit'
+    if fit_method == 'request_limit':
+        units = units.below_request_prop(ad_request_cum_prop_threshold)
 
-        df_ad = df_ad[df_ad['floor_price'] <= 18]
-        fit_method = 'request_limit'
-
-        df = df_ad.copy()
-        if fit_method == 'request_limit':
-            df = df[df['requests'].cumsum() / df['requests'].sum() < ad_request_cum_prop_threshold]
-
-        for fit_intercept in [False, True]:
-
-            df[f'cpm_model_{fit_method}_{fit_intercept}'] = fit_model(df[['floor_price']], df['cpm'], fit_intercept, fit_method, df)
-
-            df[f'fill_rate_exp_{fit_method}_{fit_intercept}'] = np.exp(fit_model(-df[['floor_price']], np.log(df['fill_rate']), fit_intercept, fit_method, df))
-
-            df[f'fill_rate_power_law_{fit_method}_{fit_intercept}'] = np.exp(fit_model(-np.log(df[['floor_price']]), np.log(df['fill_rate']), fit_intercept, fit_method, df))
-
-            df[f'fill_rate_combined_exp_power_law_{fit_method}_{fit_intercept}'] = np.exp(fit_model(-pd.concat([np.log(df[['floor_price']]), df[['floor_price']]], axis=1),
-                                                            np.log(df['fill_rate']), fit_intercept, fit_method, df))
-
-            df[f'fill_rate_exp_of_power_law_{fit_method}_{fit_intercept}'] = np.exp(-np.exp(fit_model(np.log(df[['floor_price']]), np.log(-np.log(df['fill_rate'])), fit_intercept, fit_method, df)))
+    for fit_intercept in [False, True]:
+        for family, pred in fit_families(units.df, units.codes, len(units), fit_intercept, fit_method).items():
+            units.df[f'{family}_{fit_method}_{fit_intercept}'] = pred
 
+    for ad_unit_name, df in units:
         df = df.set_index('floor_price')
         cols = ['fill_rate', 'fill_rate_combined_exp_power_law_request_limit_False', 'fill_rate_exp_request_limit_True',
                 'fill_rate_combined_exp_power_law_request_limit_True', 'fill_rate_exp_of_power_law_request_limit_True']
@@ -905,15 +808,14 @@ def fill_rate_modelling_raw():
 
     print(f'doing: {query_file}')
     df_all = get_data(query_file, f'compare_multiple_{ad_unit_count}', repl_dict=repl_dict, force_requery=False)
-    ad_unit_names = df_all['ad_unit_name'].unique()
+    units = AdUnitGroups(df_all)
+    floor_price_thresholds = units.floor_price_at_request_prop(ad_request_cum_prop_thresholds)
 
     N_i = 0
     N_p_i = 0
     NN_p = 0
     with PdfPages(f'plots_direct/{plotname}_pdf.pdf') as pdf:
-        for ad_unit_name in ad_unit_names:
-            df = df_all[df_all['ad_unit_name'] == ad_unit_name]
-
+        for i, (ad_unit_name, df) in enumerate(units):
             df = df.set_index('floor_price')
             if N_p_i == 0:
                 fig, ax = plt.subplots(figsize=(20, 16), ncols=1, nrows=N_p)
@@ -922,8 +824,7 @@ def fill_rate_modelling_raw():
             df[['requests']].plot(ax=ax[N_p_i], secondary_y=True)
 
             thresh_list = []
-            for thresh in ad_request_cum_prop_thresholds:
-                fp_thresh = df[df['requests'].cumsum() / df['requests'].sum() < thresh].index.max()
+            for thresh, fp_thresh in zip(ad_request_cum_prop_thresholds, floor_price_thresholds[i]):
                 thresh_list.append(df_vert_line(fp_thresh, 0, 1, f'requests_{thresh*100:0.1f}%, fp: {fp_thresh:0.2f}'))
             pd.concat(thresh_list).plot(ax=ax[N_p_i])
 
@@ -941,40 +842,23 @@ def target_floor_price_from_fill_rate(fill_rate, target_fill_rate):
         return np.nan
     return abs(fill_rate - target_fill_rate).idxmin()
 
-def main_ad_unit_combined_model_v2(target_fill_rate=0.7):
-    ad_unit_count = 1000
-    do_plots = True
-    N_p = 8
-    N = 40
-    plotname = f'compare_combined_model_v2_{target_fill_rate*100:0.0f}'
-
-    ad_request_cum_prop_threshold = 0.975
-
-    repl_dict = {'ad_unit_count': ad_unit_count}
-    query_file = 'query_direct_targetting_multiple'
-
-    print(f'doing: {query_file}')
-    df_all = get_data(query_file, f'compare_multiple_{ad_unit_count}', repl_dict=repl_dict, force_requery=False)
-    ad_unit_names = df_all['ad_unit_name'].unique()
-
-    N_i = 0
-    N_p_i = 0
-    NN_p = 0
-    if do_plots:
-        pdf = PdfPages(f'plots_direct/{plotname}_pdf.pdf')
+def combined_model_v2_fit(units, target_fill_rate, ad_request_cum_prop_threshold):
+    # the fits and target floor prices of main_ad_unit_combined_model_v2, with each unit's frame (indexed by floor
+    # price) for the plots
+    units = units.below_request_prop(ad_request_cum_prop_threshold)
+    # the fitted parameters go to the model store with the target floor prices
+    params = {}
+    for family in ['cpm_model', 'fill_rate_combined_exp_power_law', 'fill_rate_exp_of_power_law']:
+        coef, intercept, units.df[family] = fit_family(units.df, units.codes, len(units), family, True, 'request_limit')
+        for k in range(coef.shape[1]):
+            params[f'coef_{family}_{k}'] = coef[:, k]
+        params[f'intercept_{family}'] = intercept
+
+    cpma_weighted = units.cpma_weighted_floor_price(np.full(len(units), 100.0))[:, 0]
+
+    df_list = []
     target_floor_price_list = []
-    for ad_unit_name in ad_unit_names:
-        df = df_all[df_all['ad_unit_name'] == ad_unit_name]
-        df = df[df['fill_rate'] > 0]
-        if len(df) == 0:
-            continue
-
-        df = df[df['requests'].cumsum() / df['requests'].sum() < ad_request_cum_prop_threshold]
-
-        df[f'cpm_model'] = fit_model(df[['floor_price']], df['cpm'], True, 'request_limit', df)
-        df[f'fill_rate_combined_exp_power_law'] = np.exp(fit_model(-pd.concat([np.log(df[['floor_price']]), df[['floor_price']]], axis=1), np.log(df['fill_rate']), True,'request_limit', df))
-        df[f'fill_rate_exp_of_power_law'] = np.exp(-np.exp(fit_model(np.log(df[['floor_price']]), np.log(-np.log(df['fill_rate'])), True,'request_limit', df)))
-
+    for i, (ad_unit_name, df) in enumerate(units):
         x1 = np.log(df['floor_price'].values)
         y = np.log(-np.log(df['fill_rate'].values))
 
@@ -1007,16 +891,31 @@ def main_ad_unit_combined_model_v2(target_fill_rate=0.7):
 
         df = df.set_index('floor_price')
 
-        target_floor_price = {'cpma_weighted': calculate_target_floor_price(df, 100, 'cpma'),
+        target_floor_price = {'cpma_weighted': cpma_weighted[i],
                               'closed_form': target_floor_price}
         for model in ['combined_exp_power_law', 'exp_of_power_law']:
             df[f'cpma_{model}'] = df[f'fill_rate_{model}'] * df[f'cpm_model']
             target_floor_price[f'fill_rate_{model}'] = target_floor_price_from_fill_rate(df[f'fill_rate_{model}'], target_fill_rate)
             target_floor_price[f'cpma_{model}'] = df[f'cpma_{model}'].idxmax()
 
+        df_list.append(df)
         target_floor_price_list.append(target_floor_price)
 
-        if do_plots and (N_i < N):
+    return units, df_list, target_floor_price_list, params
+
+
+def combined_model_v2_units(units, first_unit, shard, target_fill_rate, ad_request_cum_prop_threshold):
+    # main_ad_unit_combined_model_v2's fits for the ad units of one shard (all of them with one worker)
+    units, _, target_floor_price_list, params = combined_model_v2_fit(units, target_fill_rate, ad_request_cum_prop_threshold)
+    return pd.concat([pd.DataFrame({'ad_unit_name': units.names}), pd.DataFrame(target_floor_price_list), pd.DataFrame(params)], axis=1)
+
+
+def combined_model_v2_plots(units, target_fill_rate, ad_request_cum_prop_threshold, plotname, N_p):
+    # the plotted units are refitted here rather than in the shards, so there is one pdf whatever the sharding
+    _, df_list, target_floor_price_list, _ = combined_model_v2_fit(units, target_fill_rate, ad_request_cum_prop_threshold)
+    with PdfPages(f'plots_direct/{plotname}_pdf.pdf') as pdf:
+        for N_i, (df, target_floor_price) in enumerate(zip(df_list, target_floor_price_list)):
+            N_p_i = N_i % N_p
             if N_p_i == 0:
                 fig, ax = plt.subplots(figsize=(20, 16), ncols=3, nrows=N_p)
 
@@ -1033,33 +932,85 @@ def main_ad_unit_combined_model_v2(target_fill_rate=0.7):
             fp = pd.concat([df_vert_line(v, 0, df[cols].max().max(), f'{k}: {v:0.2f}') for k, v in target_floor_price.items()])
             fp.plot(ax=ax[N_p_i, 2], legend=None)
 
-            N_p_i += 1
-            N_i += 1
-            if N_p_i == N_p:
-                fig.savefig(f'plots_direct/{plotname}_png_{NN_p}.png')
+            if N_p_i == N_p - 1:
+                fig.savefig(f'plots_direct/{plotname}_png_{N_i // N_p}.png')
                 pdf.savefig()
-                NN_p += 1
-                N_p_i = 0
 
-    if do_plots:
-        pdf.close()
 
-    df_target_floor_price = pd.DataFrame(target_floor_price_list)
+def main_ad_unit_combined_model_v2(target_fill_rate=0.7, workers=1, force_refit=False):
+    ad_unit_count = 1000
+    do_plots = True
+    N_p = 8
+    N = 40
+    plotname = f'compare_combined_model_v2_{target_fill_rate*100:0.0f}'
+
+    ad_request_cum_prop_threshold = 0.975
+
+    repl_dict = {'ad_unit_count': ad_unit_count}
+    query_file = 'query_direct_targetting_multiple'
+
+    print(f'doing: {query_file}')
+    df_all = get_data(query_file, f'compare_multiple_{ad_unit_count}', repl_dict=repl_dict, force_requery=False)
+
+    # only the ad units whose data changed since the last run are refitted, the rest come from the model store
+    units = AdUnitGroups(df_all[df_all['fill_rate'] > 0])
+    fingerprints = unit_fingerprints(units)
+    key = params_key(target_fill_rate=target_fill_rate, ad_request_cum_prop_threshold=ad_request_cum_prop_threshold)
+    store_name = f'{plotname}_{ad_unit_count}'
+    store = None if force_refit else load_model_store(store_name)
+    refit = units_to_refit(store, units.names, fingerprints, key)
+    print(f'refitting {refit.sum()} of {len(units)} ad units')
+
+    if refit.any():
+        df_refit = run_ad_unit_shards(units.filter(refit[units.codes]), combined_model_v2_units, workers=workers,
+                                      target_fill_rate=target_fill_rate,
+                                      ad_request_cum_prop_threshold=ad_request_cum_prop_threshold)
+        store = update_model_store(store, df_refit, units.names, fingerprints, key, refit)
+        save_model_store(store_name, store)
+
+    df_target_floor_price = pd.DataFrame({'ad_unit_name': units.names}).merge(store, on='ad_unit_name', how='inner')
+    df_target_floor_price = df_target_floor_price.drop(columns=['ad_unit_name', 'fingerprint', 'params_key'] +
+                                                       [c for c in df_target_floor_price.columns if c.startswith(('coef_', 'intercept_'))])
     df_target_floor_price.to_csv(f'plots_direct/{plotname}_target_floor_prices_{ad_unit_count}.csv', index=False)
 
+    if do_plots:
+        # the first N units, whether they were refitted or came from the model store
+        combined_model_v2_plots(units.filter(units.codes < N), target_fill_rate, ad_request_cum_prop_threshold, plotname, N_p)
+
     main_ad_unit_combined_model_v2_do_plots(f'{plotname}_target_floor_prices_{ad_unit_count}')
 
-def cum_plot(df, filename):
+def main_ad_unit_target_floor_price_grid(target_fill_rates=np.round(np.arange(0.5, 0.91, 0.05), 2)):
+    # the target floor price of every ad unit for each target fill rate and fill rate model, one row per unit and model
+    ad_unit_count = 1000
+    ad_request_cum_prop_threshold = 0.975
+
+    repl_dict = {'ad_unit_count': ad_unit_count}
+    query_file = 'query_direct_targetting_multiple'
+
+    print(f'doing: {query_file}')
+    df_all = get_data(query_file, f'compare_multiple_{ad_unit_count}', repl_dict=repl_dict, force_requery=False)
+
+    units = AdUnitGroups(df_all[df_all['fill_rate'] > 0]).below_request_prop(ad_request_cum_prop_threshold)
+    floor_price = units.df['floor_price'].values
+    floor_price_min = floor_price[units.offsets[:-1]]
+    floor_price_max = floor_price[units.offsets[1:] - 1]
 
-    x_list = []
-    for nm, x in df.items():
-        x = x[np.isfinite(x)]
-        x = x.sort_values()
-        x_list.append(pd.DataFrame(np.arange(len(x)) / (len(x) - 1), index=pd.Index(x.values), columns=[nm]))
+    df_list = []
+    for family in [f for f in model_families.keys() if family_column(f) == 'fill_rate']:
+        coef, intercept, _ = fit_family(units.df, units.codes, len(units), family, True, 'request_limit')
+        fp = target_floor_prices(family, coef, intercept, target_fill_rates, floor_price_min, floor_price_max)
+        df = pd.DataFrame(fp, columns=[f'{t:0.2f}' for t in target_fill_rates])
+        df.insert(0, 'model', family)
+        df.insert(0, 'ad_unit_name', units.names)
+        df_list.append(df)
 
-    df = pd.concat(x_list)
-    df = df.groupby(df.index).mean()
-    df = df.sort_index().ffill().bfill()
+    df_grid = pd.concat(df_list, ignore_index=True)
+    df_grid.to_csv(f'plots_direct/target_floor_price_grid_{ad_unit_count}.csv', index=False)
+    print(df_grid.groupby('model').median(numeric_only=True))
+
+def cum_plot(df, filename, points=2000):
+
+    df = merged_ecdf(df, points=points)
 
     fig, ax = plt.subplots(figsize=(12, 9))
     (100 * df).plot(xlim=[0, 2], ax=ax, ylabel='Cumulative percent of data_cache', xlabel='Target floor price',
@@ -1090,6 +1041,11 @@ def main_ad_unit_combined_model_v2_do_plots(filename):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1, help='processes to shard the ad units over')
+    parser.add_argument('--force-refit', action='store_true', help='refit every ad unit, ignoring the model store')
+    args = parser.parse_args()
+
     #main_base()
     #main()
 
@@ -1114,7 +1070,9 @@ if __name__ == "__main__":
 #    fill_rate_modelling()
 #    fill_rate_modelling_selected()
 
-    main_ad_unit_combined_model_v2()
+    main_ad_unit_combined_model_v2(workers=args.workers, force_refit=args.force_refit)
+
+#    main_ad_unit_target_floor_price_grid()
 
 #    main_ad_unit_combined_model_v2_do_plots('compare_combined_model_v2')
 
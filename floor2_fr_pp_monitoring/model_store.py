@@ -0,0 +1,75 @@
+import os, sys
+import hashlib
+import json
+import numpy as np
+import pandas as pd
+sys.path.append(os.path.join(sys.path[0], '..'))
+from utils.query_cache import atomic_write
+
+# the fitted parameters and target floor prices of each ad unit from the last run, with a fingerprint of the
+# data they were fitted to, so a rerun only refits the ad units whose data (or the run's parameters) changed:
+#   fingerprints = unit_fingerprints(units)
+#   store = load_model_store(name)
+#   refit = units_to_refit(store, units.names, fingerprints, key)
+#   ... fit units.filter(refit[units.codes]) ...
+#   store = update_model_store(store, df_refit, units.names, fingerprints, key, refit)
+store_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'model_store')
+
+# every column the per unit fits and target floor prices read
+fingerprint_columns = ['floor_price', 'requests', 'fill_rate', 'cpm', 'cpma']
+
+
+def unit_fingerprints(units, columns=fingerprint_columns):
+    # row count and a hash of each unit's sorted rows, one string per unit
+    values = [units.df[col].to_numpy(dtype=np.float64, na_value=np.nan) for col in columns]
+    fingerprints = []
+    for i in range(len(units)):
+        rows = units.rows(i)
+        h = hashlib.sha256()
+        for v in values:
+            h.update(np.ascontiguousarray(v[rows]).tobytes())
+        fingerprints.append(f'{rows.stop - rows.start}:{h.hexdigest()}')
+    return np.array(fingerprints, dtype=object)
+
+
+def params_key(**params):
+    # a change to any of the run's parameters invalidates every stored unit
+    return hashlib.sha256(json.dumps({k: f'{v}' for k, v in params.items()}, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def model_store_path(name):
+    return os.path.join(store_dir, f'{name}.parquet')
+
+
+def load_model_store(name):
+    path = model_store_path(name)
+    if not os.path.exists(path):
+        return None
+    return pd.read_parquet(path)
+
+
+def save_model_store(name, store):
+    os.makedirs(store_dir, exist_ok=True)
+    atomic_write(model_store_path(name), lambda f: store.to_parquet(f, index=False))
+
+
+def units_to_refit(store, names, fingerprints, key):
+    # true for units not in the store, or stored with another fingerprint or parameters
+    if store is None:
+        return np.ones(len(names), dtype=bool)
+    stored = store.set_index('ad_unit_name')
+    stored_fingerprints = stored['fingerprint'].reindex(names).values
+    stored_keys = stored['params_key'].reindex(names).values
+    return (stored_fingerprints != fingerprints) | (stored_keys != key)
+
+
+def update_model_store(store, df_refit, names, fingerprints, key, refit):
+    # the refitted rows (with an ad_unit_name column) replace the stored ones. every unit flagged for refit loses
+    # its stored row, even if it gave no refitted row, so no stale results are kept for it
+    df_refit = df_refit.copy()
+    df_refit['fingerprint'] = pd.Series(fingerprints, index=names).reindex(df_refit['ad_unit_name']).values
+    df_refit['params_key'] = key
+    if store is None:
+        return df_refit.reset_index(drop=True)
+    store = store[~store['ad_unit_name'].isin(names[refit])]
+    return pd.concat([store, df_refit], ignore_index=True)
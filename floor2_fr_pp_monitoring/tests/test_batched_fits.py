@@ -0,0 +1,85 @@
+import os, sys
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from main_direct_targetting import fit_model, fit_regression
+from fill_rate_models import model_families, shared_targets, family_features, fit_family
+from ad_unit_groups import AdUnitGroups
+
+# the batched positive=True fits against fit_model one ad unit at a time, on recorded ad units where the
+# non negative constraint is active, plus degenerate units (1, 2 and 3 rows, and one floor price only) whose
+# fit isn't unique: there only the predictions, not the coefficients, have to agree
+fixture_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'batched_fits_ad_units.csv')
+rtol = 1e-6
+atol = 1e-9
+
+
+def fixture_units(fit_method):
+    df = pd.read_csv(fixture_path)
+    units = AdUnitGroups(df[df['fill_rate'] > 0])
+    if fit_method == 'request_limit':
+        units = units.below_request_prop(0.975)
+    return units
+
+
+def unique_fit(X, fit_intercept):
+    # the least squares coefficients are unique when the (centred) design has full column rank, with the rank
+    # tolerance on the scale of the uncentred features so a constant column centres to rank 0
+    scale = max(1.0, np.abs(X).max())
+    if fit_intercept:
+        X = X - X.mean(axis=0)
+    return np.linalg.matrix_rank(X, tol=1e-9 * scale) == X.shape[1]
+
+
+@pytest.mark.parametrize('fit_method', ['weighted', 'request_limit'])
+@pytest.mark.parametrize('fit_intercept', [False, True])
+@pytest.mark.parametrize('family', list(model_families.keys()))
+def test_batched_fits_match_fit_model(family, fit_intercept, fit_method):
+    units = fixture_units(fit_method)
+    coef, intercept, pred = fit_family(units.df, units.codes, len(units), family, fit_intercept, fit_method)
+    col, transform, link = shared_targets[model_families[family]['target']]
+
+    for i, (ad_unit_name, df) in enumerate(units):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            X = family_features(family, df['floor_price'].values)
+            y = transform(df[col].values)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            pred_ref = link(fit_model(X, y, fit_intercept, fit_method, df))
+        pred_i = pred[units.rows(i)]
+
+        assert (np.isnan(pred_ref) == np.isnan(pred_i)).all(), f'{ad_unit_name}: fitted units differ'
+        if np.isnan(pred_ref).all():
+            assert np.isnan(coef[i]).all() and np.isnan(intercept[i])
+            continue
+        np.testing.assert_allclose(pred_i, pred_ref, rtol=rtol, atol=atol, err_msg=ad_unit_name)
+        assert (coef[i] >= 0).all(), f'{ad_unit_name}: negative coefficient'
+
+        if unique_fit(X, fit_intercept):
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                reg = fit_regression(X, y, fit_intercept, fit_method, df)
+            np.testing.assert_allclose(coef[i], reg.coef_, rtol=rtol, atol=atol, err_msg=ad_unit_name)
+            np.testing.assert_allclose(intercept[i], reg.intercept_, rtol=rtol, atol=atol, err_msg=ad_unit_name)
+
+
+def test_fixture_covers_active_constraints_and_degenerate_units():
+    # the unconstrained fit has a negative coefficient for some unit, so the positive fits are exercised,
+    # and some units can't be fitted uniquely
+    units = fixture_units('weighted')
+    negative = False
+    degenerate = False
+    for family in model_families.keys():
+        for fit_intercept in [False, True]:
+            coef, _, _ = fit_family(units.df, units.codes, len(units), family, fit_intercept, 'weighted', positive=False)
+            negative |= bool((coef < 0).any())
+            for _, df in units:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    X = family_features(family, df['floor_price'].values)
+                degenerate |= not unique_fit(X, fit_intercept)
+    assert negative and degenerate
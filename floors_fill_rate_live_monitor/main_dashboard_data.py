@@ -1,12 +1,13 @@
 import pandas as pd
 import matplotlib.pyplot as plt
-from google.cloud import bigquery
 import configparser
-from google.cloud import bigquery_storage
 import os, sys
 from matplotlib.backends.backend_pdf import PdfPages
 import datetime as dt
 from sklearn.linear_model import LinearRegression
+sys.path.append(os.path.join(sys.path[0], '..'))
+from utils.bq import run_query
+from utils.bq_executor import run_concurrently
 
 pd.set_option('display.max_columns', None)
 pd.set_option('display.width', 1000)
@@ -16,14 +17,21 @@ config = configparser.ConfigParser()
 config.read(config_path)
 
 project_id = "freestar-157323"
-client = bigquery.Client(project=project_id)
-bqstorageclient = bigquery_storage.BigQueryReadClient()
 
 
 def get_bq_data(query, replacement_dict={}):
     for k, v in replacement_dict.items():
         query = query.replace("{" + k + "}", str(v))
-    return client.query(query).result().to_dataframe(bqstorage_client=bqstorageclient, progress_bar_type='tqdm')
+    return run_query(project_id, query)
+
+def run_dashboard_queries(query_dashboard, repl_dict_list):
+    # the "create or replace" statement has to finish before the inserts into the same table can run concurrently
+    create_list = [r for r in repl_dict_list if r['create_or_insert_statement'].startswith('CREATE')]
+    insert_list = [r for r in repl_dict_list if not r['create_or_insert_statement'].startswith('CREATE')]
+    for repl_dict in create_list:
+        get_bq_data(query_dashboard, repl_dict)
+    run_concurrently(lambda repl_dict: get_bq_data(query_dashboard, repl_dict), insert_list,
+                     names=[repl_dict['ad_unit'] for repl_dict in insert_list])
 
 def main(recreate_raw_data=False):
 
@@ -48,38 +56,39 @@ def main(recreate_raw_data=False):
     if len(a_w_s) >= 4:
         title_extra += ' ' + a_w_s[1] + ' ' + a_w_s[3]
 
-    with PdfPages(f'plots/fill-rate_results_{title_extra.replace(' ', '_')}.pdf') as pdf:
-
-        first_row = True
-        for _, (ad_unit, domain, working, fill_rate_model_enabled_date) in ad_units.iterrows():
-
-            create_or_insert_statement = f"CREATE OR REPLACE TABLE `{results_tablename}` as" if first_row else f"insert into `{results_tablename}`"
-            first_row = False
+    repl_dict_list = []
+    first_row = True
+    for _, (ad_unit, domain, working, fill_rate_model_enabled_date) in ad_units.iterrows():
 
-            if (',' in ad_unit) or ('test' in ad_unit) or not working:
-                continue
+        create_or_insert_statement = f"CREATE OR REPLACE TABLE `{results_tablename}` as" if first_row else f"insert into `{results_tablename}`"
+        first_row = False
 
-            print(f"ad_unit: {ad_unit}")
+        if (',' in ad_unit) or ('test' in ad_unit) or not working:
+            continue
 
-            reference_ad_units_where = f"ad_unit_name like '{ad_unit.split('_')[0]}\\\\_%'"
-            for ad_unit_other in ad_units[ad_units['domain'] == domain]['ad_unit']:
-                reference_ad_units_where += f" and ad_unit_name != '{ad_unit_other}'"
+        reference_ad_units_where = f"ad_unit_name like '{ad_unit.split('_')[0]}\\\\_%'"
+        for ad_unit_other in ad_units[ad_units['domain'] == domain]['ad_unit']:
+            reference_ad_units_where += f" and ad_unit_name != '{ad_unit_other}'"
 
-            repl_dict = {'ad_unit': ad_unit,
-                         'reference_ad_units_where': reference_ad_units_where,
-                         'and_where': and_where,
-                         'create_or_insert_statement': create_or_insert_statement,
-                         'start_date': "2025-05-10",
-                         'fill_rate_model_enabled_date': dt.datetime.strptime(fill_rate_model_enabled_date, '%d/%m/%Y').strftime('%Y-%m-%d')}
+        repl_dict_list.append({'ad_unit': ad_unit,
+                               'reference_ad_units_where': reference_ad_units_where,
+                               'and_where': and_where,
+                               'create_or_insert_statement': create_or_insert_statement,
+                               'start_date': "2025-05-10",
+                               'fill_rate_model_enabled_date': dt.datetime.strptime(fill_rate_model_enabled_date, '%d/%m/%Y').strftime('%Y-%m-%d')})
 
-            df_reference_ad_units = get_bq_data(query_reference_ad_units, repl_dict)
-            print (df_reference_ad_units)
+    ad_unit_names = [repl_dict['ad_unit'] for repl_dict in repl_dict_list]
+    df_reference_ad_units_list = run_concurrently(lambda repl_dict: get_bq_data(query_reference_ad_units, repl_dict), repl_dict_list, names=ad_unit_names)
+    run_dashboard_queries(query_dashboard, repl_dict_list)
+    df_list = run_concurrently(lambda repl_dict: get_bq_data(query_plots, repl_dict), repl_dict_list, names=ad_unit_names)
 
-            get_bq_data(query_dashboard, repl_dict)
+    with PdfPages(f'plots/fill-rate_results_{title_extra.replace(' ', '_')}.pdf') as pdf:
 
+        for ad_unit, df_reference_ad_units, df in zip(ad_unit_names, df_reference_ad_units_list, df_list):
 
+            print(f"ad_unit: {ad_unit}")
+            print (df_reference_ad_units)
 
-            df = get_bq_data(query_plots, repl_dict)
             if not df.empty:
                 df_p = df.set_index('date').astype('float64')
                 plot_cols = ['floor_price', 'fill_rate', 'cpma', 'revenue']
@@ -106,6 +115,7 @@ def main_dashboard_only(results_tablename, recreate_raw_data=False, print_refere
 
     ad_units = pd.read_csv('fill-rate-ads.csv')
 
+    repl_dict_list = []
     first_row = True
     for _, (ad_unit, domain, working, fill_rate_model_enabled_date) in ad_units.iterrows():
 
@@ -115,24 +125,25 @@ def main_dashboard_only(results_tablename, recreate_raw_data=False, print_refere
         if (',' in ad_unit) or ('test' in ad_unit) or not working:
             continue
 
-        print(f"ad_unit: {ad_unit}")
-
         reference_ad_units_where = f"ad_unit_name like '{ad_unit.split('_')[0]}\\\\_%'"
         for ad_unit_other in ad_units[ad_units['domain'] == domain]['ad_unit']:
             reference_ad_units_where += f" and ad_unit_name != '{ad_unit_other}'"
 
-        repl_dict = {'ad_unit': ad_unit,
-                     'reference_ad_units_where': reference_ad_units_where,
-                     'create_or_insert_statement': create_or_insert_statement,
-                     'start_date': "2025-05-10",
-                     'fill_rate_model_enabled_date': dt.datetime.strptime(fill_rate_model_enabled_date,
-                                                                          '%d/%m/%Y').strftime('%Y-%m-%d')}
-
-        if print_reference_units:
-            df_reference_ad_units = get_bq_data(query_reference_ad_units, repl_dict)
+        repl_dict_list.append({'ad_unit': ad_unit,
+                               'reference_ad_units_where': reference_ad_units_where,
+                               'create_or_insert_statement': create_or_insert_statement,
+                               'start_date': "2025-05-10",
+                               'fill_rate_model_enabled_date': dt.datetime.strptime(fill_rate_model_enabled_date,
+                                                                                    '%d/%m/%Y').strftime('%Y-%m-%d')})
+
+    if print_reference_units:
+        df_reference_ad_units_list = run_concurrently(lambda repl_dict: get_bq_data(query_reference_ad_units, repl_dict),
+                                                      repl_dict_list, names=[repl_dict['ad_unit'] for repl_dict in repl_dict_list])
+        for repl_dict, df_reference_ad_units in zip(repl_dict_list, df_reference_ad_units_list):
+            print(f"ad_unit: {repl_dict['ad_unit']}")
             print(df_reference_ad_units)
 
-        get_bq_data(query_dashboard, repl_dict)
+    run_dashboard_queries(query_dashboard, repl_dict_list)
 
 
 def do_scatterplot(x, y, c, ax_):
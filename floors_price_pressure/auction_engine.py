@@ -0,0 +1,161 @@
+import numpy as np
+import pandas as pd
+
+# auctions of independent bidders, each with a bid distribution, cleared by a pluggable rule against a whole grid of
+# floor prices at once:
+#   bidders = [uniform_bidder(0.05, 0.05, 0.6), lognormal_bidder(-1, 0.5, 0.4), empirical_bidder(df['cpm'], 0.3)]
+#   cam_bids = draw_auction_bids(bidders, N, np.random.default_rng(seed))
+#   df = auction_outcomes(cam_bids, floor_prices, rule='second_price')
+# every rule gives totals over the auctions with the same keys, so chunks of auctions add up, and outcomes_from_sums
+# turns them into the cpma / fill_rate / cpma_accept_low_bids / fill_rate_accept_low_bids columns the plots use.
+# a bid of 0 is no bid.
+
+
+# bid distributions: name -> fn(rng, N, **params) giving N bids of one bidder
+bid_distributions = {}
+
+
+def register_bid_distribution(name, fn):
+    bid_distributions[name] = fn
+
+
+def uniform_bids(rng, N, low, low_to_high, prop):
+    # bids with probability prop, uniformly in [low, low + low_to_high]
+    bids = low + low_to_high * rng.random(N)
+    return np.where(rng.random(N) < prop, bids, 0)
+
+
+def lognormal_bids(rng, N, mu, sigma, prop):
+    bids = rng.lognormal(mu, sigma, N)
+    return np.where(rng.random(N) < prop, bids, 0)
+
+
+def empirical_bids(rng, N, quantiles, prop):
+    # inverse cdf sampling from quantiles at evenly spaced levels 0..1
+    bids = np.interp(rng.random(N), np.linspace(0, 1, len(quantiles)), quantiles)
+    return np.where(rng.random(N) < prop, bids, 0)
+
+
+register_bid_distribution('uniform', uniform_bids)
+register_bid_distribution('lognormal', lognormal_bids)
+register_bid_distribution('empirical', empirical_bids)
+
+
+def uniform_bidder(low, low_to_high, prop):
+    return ('uniform', {'low': low, 'low_to_high': low_to_high, 'prop': prop})
+
+
+def lognormal_bidder(mu, sigma, prop):
+    return ('lognormal', {'mu': mu, 'sigma': sigma, 'prop': prop})
+
+
+def empirical_bidder(values, prop, n_quantiles=101):
+    # from observed bids, e.g. a cpm column of a get_cached_data pull. non positive and non finite values are dropped
+    values = np.asarray(values, dtype=np.float64)
+    values = values[np.isfinite(values) & (values > 0)]
+    return ('empirical', {'quantiles': np.quantile(values, np.linspace(0, 1, n_quantiles)), 'prop': prop})
+
+
+def draw_auction_bids(bidders, N, rng=None):
+    # N auctions x C bidders
+    rng = np.random.default_rng() if rng is None else rng
+    return np.stack([bid_distributions[name](rng, N, **params) for name, params in bidders], axis=1)
+
+
+# clearing rules: name -> fn(sorted_bids, floor_prices, **params) giving the revenue and number of filled auctions at
+# each floor price, with sorted_bids each auction's bids in ascending order (N, C)
+clearing_rules = {}
+
+
+def register_clearing_rule(name, fn):
+    clearing_rules[name] = fn
+
+
+def suffix_totals(values, floor_prices):
+    # the number and sum of values >= each floor price
+    sorted_values = np.sort(values)
+    cum = np.r_[0, np.cumsum(sorted_values)]
+    idx = np.searchsorted(sorted_values, floor_prices, side='left')
+    return len(values) - idx, cum[-1] - cum[idx]
+
+
+def lowest_qualifying(sorted_bids, floor_prices):
+    # the lowest bid >= floor price wins and pays its bid. the j-th bid wins for the floor prices in (bid j - 1, bid j]:
+    # every bid is added to the floor prices it wins with a difference array over the floor price grid
+    N, C = sorted_bids.shape
+    F = len(floor_prices)
+    hi = np.searchsorted(floor_prices, sorted_bids, side='right')
+    lo = np.concatenate([np.zeros((N, 1), dtype=hi.dtype), hi[:, :-1]], axis=1)
+    revenue = np.bincount(lo.ravel(), weights=sorted_bids.ravel(), minlength=F + 1) - \
+        np.bincount(hi.ravel(), weights=sorted_bids.ravel(), minlength=F + 1)
+    filled = np.bincount(lo.ravel(), minlength=F + 1) - np.bincount(hi.ravel(), minlength=F + 1)
+    return {'revenue': np.cumsum(revenue)[:F], 'filled': np.cumsum(filled)[:F]}
+
+
+def first_price(sorted_bids, floor_prices):
+    # the highest bid wins if it is >= floor price and pays its bid
+    filled, revenue = suffix_totals(sorted_bids[:, -1], floor_prices)
+    return {'revenue': revenue, 'filled': filled}
+
+
+def second_price(sorted_bids, floor_prices):
+    # the highest bid wins if it is >= floor price and pays the larger of the second bid and the floor price:
+    # sum of max(b2, f) over b1 >= f is f (#b1 >= f - #b2 >= f) + sum of b2 over b2 >= f
+    filled, _ = suffix_totals(sorted_bids[:, -1], floor_prices)
+    second = sorted_bids[:, -2] if sorted_bids.shape[1] > 1 else np.zeros(len(sorted_bids))
+    second_filled, second_revenue = suffix_totals(second, floor_prices)
+    return {'revenue': floor_prices * (filled - second_filled) + second_revenue, 'filled': filled}
+
+
+def multi_tier(sorted_bids, floor_prices, tiers=(1.0, 1.5, 2.0)):
+    # second price against floor tiers floor_price x tiers: the highest bid wins if it clears the lowest tier and
+    # pays the larger of the second bid and the highest tier it clears. with hi_k the number of floor prices with
+    # floor_price x tier_k <= b1, tier k is the highest one cleared for the floor prices [hi_(k + 1), hi_k), which
+    # pay b2 below lo_k (floor_price x tier_k <= b2) and floor_price x tier_k from there. the b2 constant and the
+    # tier_k slope are added to the floor price grid with difference arrays, as in lowest_qualifying
+    tiers = np.sort(np.asarray(tiers, dtype=np.float64))
+    F = len(floor_prices)
+    first = sorted_bids[:, -1]
+    second = sorted_bids[:, -2] if sorted_bids.shape[1] > 1 else np.zeros(len(sorted_bids))
+    hi = [np.searchsorted(floor_prices * tier, first, side='right') for tier in tiers] + [np.zeros(len(first), dtype=np.int64)]
+    constant = np.zeros(F + 1)
+    slope = np.zeros(F + 1)
+    for k, tier in enumerate(tiers):
+        lo = np.maximum(np.searchsorted(floor_prices * tier, second, side='right'), hi[k + 1])
+        constant += np.bincount(hi[k + 1], weights=second, minlength=F + 1) - np.bincount(lo, weights=second, minlength=F + 1)
+        slope += tier * (np.bincount(lo, minlength=F + 1) - np.bincount(hi[k], minlength=F + 1))
+    filled = len(first) - np.cumsum(np.bincount(hi[0], minlength=F + 1))[:F]
+    return {'revenue': np.cumsum(constant)[:F] + np.cumsum(slope)[:F] * floor_prices, 'filled': filled}
+
+
+register_clearing_rule('lowest_qualifying', lowest_qualifying)
+register_clearing_rule('first_price', first_price)
+register_clearing_rule('second_price', second_price)
+register_clearing_rule('multi_tier', multi_tier)
+
+
+def auction_sums(cam_bids, floor_prices, rule='lowest_qualifying', **rule_params):
+    # totals over the auctions, which add up over chunks of auctions. with accept low bids, an auction with no bid
+    # >= floor price is filled by its highest bid, whatever the rule
+    floor_prices = np.asarray(floor_prices, dtype=np.float64)
+    sorted_bids = np.sort(cam_bids, axis=1)
+    sums = clearing_rules[rule](sorted_bids, floor_prices, **rule_params)
+    _, highest_revenue = suffix_totals(sorted_bids[:, -1], floor_prices)
+    return {'auctions': len(cam_bids),
+            'revenue': sums['revenue'],
+            'filled': sums['filled'],
+            'low_bid': sorted_bids[:, -1].sum() - highest_revenue}
+
+
+def outcomes_from_sums(sums, floor_prices):
+    N = sums['auctions']
+    cpma = sums['revenue'] / N
+    return pd.DataFrame({'cpma': cpma,
+                         'fill_rate': sums['filled'] / N,
+                         'cpma_accept_low_bids': cpma + sums['low_bid'] / N,
+                         'fill_rate_accept_low_bids': np.ones(len(cpma))},
+                        index=pd.Index(np.asarray(floor_prices, dtype=np.float64), name='floor_price'))
+
+
+def auction_outcomes(cam_bids, floor_prices, rule='lowest_qualifying', **rule_params):
+    return outcomes_from_sums(auction_sums(cam_bids, floor_prices, rule, **rule_params), floor_prices)
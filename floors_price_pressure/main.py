@@ -8,6 +8,9 @@ from google.cloud import bigquery_storage
 import os, sys
 import numpy as np
 import datetime
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from auction_engine import uniform_bidder, draw_auction_bids, auction_sums, outcomes_from_sums, auction_outcomes
 
 pd.set_option('display.max_columns', None)
 pd.set_option('display.width', 1000)
@@ -15,14 +18,24 @@ pd.set_option('display.width', 1000)
 np.set_printoptions(suppress=True, linewidth=10000)
 
 
-def main(force_recalc=False):
+def main(force_recalc=False, exact=False, N=100000, workers=1, seed=0, rule='lowest_qualifying', rule_params={}):
 
-    N = 100000
+    # the exact expectations don't depend on N, and are only for the lowest qualifying bid rule
+    assert (not exact) or (rule == 'lowest_qualifying')
+    run_name = 'exact' if exact else N
+    if rule != 'lowest_qualifying':
+        run_name = f'{run_name}_{rule}'
+    cam_bid_prop_offsets = np.arange(-0.6, 0.1, 0.1)
+    floor_prices = np.arange(0, 2, 0.002)
 
-    data_cache_filename = f'data_cache/results_list_{N}.pkl'
+    data_cache_filename = f'data_cache/results_list_{run_name}.pkl'
     if force_recalc or not os.path.exists(data_cache_filename):
+        if exact:
+            df_list = [exact_auction_outcomes(floor_prices, cam_bid_prop_offset) for cam_bid_prop_offset in cam_bid_prop_offsets]
+        else:
+            df_list = run_sim_sweep(cam_bid_prop_offsets, N, floor_prices, workers=workers, seed=seed, rule=rule, rule_params=rule_params)
+        results_list = [plot_sens(df, cam_bid_prop_offset, run_name) for df, cam_bid_prop_offset in zip(df_list, cam_bid_prop_offsets)]
         with open(data_cache_filename, 'wb') as f:
-            results_list = [run_sim_and_plot(cam_bid_prop_offset, N) for cam_bid_prop_offset in np.arange(-0.6, 0.1, 0.1)]
             pickle.dump(results_list, f)
 
     with open(data_cache_filename, 'rb') as f:
@@ -36,7 +49,7 @@ def main(force_recalc=False):
             x.plot(style='x-', ax=ax_, ylim=[-15, 0], ylabel='cpma_loss_perc')
 
     fig.suptitle('Optimal floor price setting using fill rate vs price pressure')
-    fig.savefig(f'plots/sensitivity_{N}.png')
+    fig.savefig(f'plots/sensitivity_{run_name}.png')
 
     f = 0
 
@@ -45,13 +58,23 @@ def main(force_recalc=False):
 
 def run_sim_and_plot(cam_bid_prop_offset,
                      N = 100000,
-                     floor_prices = np.arange(0, 2, 0.002)):
+                     floor_prices = np.arange(0, 2, 0.002),
+                     seed = None,
+                     exact = False):
+
+    run_name = 'exact' if exact else N
+    print(f'doing run_sim_and_plot with: cam_bid_prop_offset: {cam_bid_prop_offset:0.1f}, N: {run_name}')
 
-    print(f'doing run_sim_and_plot with: cam_bid_prop_offset: {cam_bid_prop_offset:0.1f}, N: {N}')
+    if exact:
+        df = exact_auction_outcomes(floor_prices, cam_bid_prop_offset)
+    else:
+        df = run_sim_grid(floor_prices, N, cam_bid_prop_offset, seed)
+    return plot_sens(df, cam_bid_prop_offset, run_name)
 
-    results_dict_list = [run_sim(fp, N, cam_bid_prop_offset) for fp in floor_prices]
 
-    df = pd.DataFrame(results_dict_list).set_index('floor_price')
+def plot_sens(df, cam_bid_prop_offset, run_name):
+    # the outcomes against floor price of one bid offset, plotted, and the cpma loss at a range of price
+    # pressures and fill rates
     df_y = pd.DataFrame(index=df.index)
     df_y['cpma_loss_perc'] = (df['cpma'] / df['cpma'].max() - 1) * 100
     df_y['price_pressure_perc'] = (df['cpma_accept_low_bids'] / df['cpma'] - 1) * 100
@@ -64,7 +87,7 @@ def run_sim_and_plot(cam_bid_prop_offset,
     fig, ax = plt.subplots(figsize=(12, 9))
     df.plot(ax=ax, title=f'bid_prop_offset: {cam_bid_prop_offset:0.1f}, optimal: floor_price: {opt_floor_price:0.2f}, pressure: {opt_pressure*100:0.1f}%, fill_rate: {opt_fill_rate*100:0.1f}%')
     df_y.plot(ax=ax, secondary_y=True, ylim=[-20, 20])
-    fig.savefig(f'plots/price_pressure_bid_prop_offset_{cam_bid_prop_offset*100:0.0f}_{N}.png')
+    fig.savefig(f'plots/price_pressure_bid_prop_offset_{cam_bid_prop_offset*100:0.0f}_{run_name}.png')
 
     df = pd.concat([df, df_y], axis=1)
 
@@ -79,79 +102,137 @@ def run_sim_and_plot(cam_bid_prop_offset,
             'fr_sens': fr_sens}
 
 
-def run_sim(
-    floor_price=1,
+# the campaigns' bid model: campaign c bids with probability cam_bid_prop[c] + offset, uniformly in
+# [cam_bid_low[c], cam_bid_low[c] + cam_bid_low_to_high[c]], and bids 0 otherwise
+cam_bid_low = [0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1]
+cam_bid_low_to_high = [0.05, 0.1, 0.1, 0.15, 0.15, 0.2, 0.2, 0.3, 0.4, 1, 1]
+cam_bid_prop = [1, 1, 0.9, 0.8, 0.75, 0.7, 0.7, 0.65, 0.6, 0.6, 0.5]
+
+
+def draw_bids(
     N = 100000,
     cam_bid_prop_offset = - 0.4,
-    cam_bid_low = [0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1],
-    cam_bid_low_to_high = [0.05, 0.1, 0.1, 0.15, 0.15, 0.2, 0.2, 0.3, 0.4, 0.5, 0.5],
-    cam_bid_prop = [1, 1, 0.9, 0.8, 0.75, 0.7, 0.65, 0.6, 0.55, 0.5, 0.4]
+    rng = None,
+    cam_bid_low = cam_bid_low,
+    cam_bid_low_to_high = cam_bid_low_to_high,
+    cam_bid_prop = cam_bid_prop
     ):
+    # N auctions x C campaigns, each campaign bidding uniformly in [low, low + low_to_high] with probability prop
+    # (plus the offset), 0 otherwise
 
     assert cam_bid_prop_offset >= - 0.6
     assert cam_bid_prop_offset <= 0.2
 
-    cam_bid_low = [0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1]
-    cam_bid_low_to_high = [0.05, 0.1, 0.1, 0.15, 0.15, 0.2, 0.2, 0.3, 0.4, 1, 1]
-    cam_bid_prop = [1, 1, 0.9, 0.8, 0.75, 0.7, 0.7, 0.65, 0.6, 0.6, 0.5]
+    assert len(cam_bid_low) == len(cam_bid_prop)
+    assert len(cam_bid_low) == len(cam_bid_low_to_high)
 
+    return draw_auction_bids([uniform_bidder(low, low_to_high, prop + cam_bid_prop_offset)
+                              for low, low_to_high, prop in zip(cam_bid_low, cam_bid_low_to_high, cam_bid_prop)], N, rng)
 
-#    print(f'running run_sim with floor_price={floor_price}')
 
-    C = len(cam_bid_prop)
-    assert len(cam_bid_low) == len(cam_bid_prop)
-    assert len(cam_bid_low) == len(cam_bid_low_to_high)
+def bid_cdf(y, low, low_to_high, prop, atom_at_zero=True):
+    # P(bid <= y) for each campaign (last axis), P(bid < y) with atom_at_zero=False
+    uniform = np.clip((y - low) / np.where(low_to_high > 0, low_to_high, 1), 0, 1)
+    uniform = np.where(low_to_high > 0, uniform, y >= low)
+    zero = (y >= 0) if atom_at_zero else (y > 0)
+    return (1 - prop) * zero + prop * uniform
 
-    cam_bid_low_A = np.array(cam_bid_low).reshape([1, C]).repeat(N, 0)
-    cam_bid_low_to_high_A = np.array(cam_bid_low_to_high).reshape([1, C]).repeat(N, 0)
-    cam_bid_prop_A = np.array(cam_bid_prop).reshape([1, C]).repeat(N, 0) + cam_bid_prop_offset
-    #accept_low_bids_prop = 0.1
-
-    cam_bids = cam_bid_low_to_high_A * np.random.random([N, C]) + cam_bid_low_A
-    cam_no_bids = np.random.random([N, C]) > cam_bid_prop_A
-    cam_bids[cam_no_bids] = 0
-    #accept_low_bids = np.random.random(N) <= accept_low_bids_prop
-
-    results_list = []
-    for n in range(N):
-     #   accept_low_bids_n = accept_low_bids[n]
-        bids = cam_bids[n, :]
-        bids_satisfying_floor_price = bids[bids >= floor_price]
-        if len(bids_satisfying_floor_price) > 0:
-            winning_bid = bids_satisfying_floor_price.min()
-            winning_bid_accept_low_bids = winning_bid
-            filled = 1
-            filled_accept_low_bids = 1
-        else:
-            winning_bid = 0
-            filled = 0
-      #      if accept_low_bids_n:
-
-            filled_accept_low_bids = 1
-            winning_bid_accept_low_bids = bids.max()
-            # else:
-            #     filled_accept_low_bids = 0
-            #     winning_bid_accept_low_bids = 0
-
-        results = {#'accept_low_bids': accept_low_bids_n,
-                   'winning_bid': winning_bid,
-                   'winning_bid_accept_low_bids': winning_bid_accept_low_bids,
-                   'filled_accept_low_bids': filled_accept_low_bids,
-                   'filled': filled}
-
-        results_list.append(results)
-
-#    df = pd.concat([pd.DataFrame(cam_bids), pd.DataFrame(results_list)], axis=1)
-    df = pd.DataFrame(results_list)
-   # df_accept_low_bids = df[df['accept_low_bids']]
-
-    return {'floor_price': floor_price,
-                    'cpma': df['winning_bid'].mean(),
-                    'fill_rate': df['filled'].mean(),
-                    'cpma_accept_low_bids': df['winning_bid_accept_low_bids'].mean(),
-                    'fill_rate_accept_low_bids': df['filled_accept_low_bids'].mean()}#,
-                    #'cpma_accept_low_bids_only': df_accept_low_bids['winning_bid_accept_low_bids'].mean(),
-                    #'fill_rate_accept_low_bids_only': df_accept_low_bids['filled_accept_low_bids'].mean()}
+
+def exact_auction_outcomes(
+    floor_prices = np.arange(0, 2, 0.002),
+    cam_bid_prop_offset = - 0.4,
+    cam_bid_low = cam_bid_low,
+    cam_bid_low_to_high = cam_bid_low_to_high,
+    cam_bid_prop = cam_bid_prop
+    ):
+    # the expectations auction_outcomes estimates, exactly, from the campaigns' bid cdfs F_c. with G_c(y) = P(f <= bid_c <= y)
+    # at floor price f, the lowest bid >= f is above y with probability prod_c (1 - G_c(y)), so
+    #   fill_rate = 1 - prod_c (1 - G_c(inf))
+    #   cpma = f fill_rate + int_f^inf [prod_c (1 - G_c(y)) - prod_c (1 - G_c(inf))] dy
+    # and an auction with no bid >= f is won by its highest bid, M, with P(M <= y) = prod_c F_c(y):
+    #   cpma_accept_low_bids = cpma + int_0^f [P(M < f) - P(M <= y)] dy
+    # between the ends of the campaigns' bid ranges the integrands are polynomials of degree C in y, so gauss legendre
+    # with C / 2 + 1 points per segment integrates them exactly, for every floor price at once
+    floor_prices = np.asarray(floor_prices, dtype=np.float64)
+    low = np.asarray(cam_bid_low, dtype=np.float64)
+    low_to_high = np.asarray(cam_bid_low_to_high, dtype=np.float64)
+    prop = np.clip(np.asarray(cam_bid_prop, dtype=np.float64) + cam_bid_prop_offset, 0, 1)
+    C = len(prop)
+    nodes, weights = np.polynomial.legendre.leggauss(C // 2 + 1)
+    breakpoints = np.unique(np.r_[low, low + low_to_high])
+    top = breakpoints[-1]
+
+    def integrate(integrand, lo, hi):
+        # int_lo^hi integrand(y) dy per floor price, lo and hi (F,), split at the breakpoints
+        edges = np.concatenate([lo[:, None], np.clip(breakpoints[None, :], lo[:, None], hi[:, None]), hi[:, None]], axis=1)
+        seg_lo, seg_hi = edges[:, :-1], edges[:, 1:]
+        y = seg_lo[:, :, None] + (seg_hi - seg_lo)[:, :, None] * (nodes + 1) / 2
+        return ((seg_hi - seg_lo)[:, :, None] / 2 * weights * integrand(y)).sum(axis=(1, 2))
+
+    f = floor_prices
+    lower = np.maximum(f, 0)
+    cdf_below_floor = bid_cdf(f[:, None], low, low_to_high, prop, atom_at_zero=False)
+    no_bid_above_floor = np.prod(cdf_below_floor, axis=1)
+    fill_rate = 1 - no_bid_above_floor
+    # 1 - G_c(y) = 1 - F_c(y) + F_c(f-), with y (F, S, Q) and the campaigns on a last axis
+    above_y = lambda y: np.prod(1 - bid_cdf(y[..., None], low, low_to_high, prop) + cdf_below_floor[:, None, None, :], axis=-1)
+    cpma = lower * fill_rate + integrate(lambda y: above_y(y) - no_bid_above_floor[:, None, None], lower, np.maximum(lower, top))
+
+    max_below_floor = np.prod(bid_cdf(np.maximum(f, 0)[:, None], low, low_to_high, prop, atom_at_zero=False), axis=1)
+    max_cdf = lambda y: np.prod(bid_cdf(y[..., None], low, low_to_high, prop), axis=-1)
+    low_bid = integrate(lambda y: max_below_floor[:, None, None] - max_cdf(y), np.zeros(len(f)), lower)
+
+    return pd.DataFrame({'cpma': cpma,
+                         'fill_rate': fill_rate,
+                         'cpma_accept_low_bids': cpma + low_bid,
+                         'fill_rate_accept_low_bids': np.ones(len(f))},
+                        index=pd.Index(floor_prices, name='floor_price'))
+
+
+def run_sim_grid(floor_prices=np.arange(0, 2, 0.002), N=100000, cam_bid_prop_offset=- 0.4, seed=None, rule='lowest_qualifying', **rule_params):
+    # every floor price against the same N auctions
+    return auction_outcomes(draw_bids(N, cam_bid_prop_offset, np.random.default_rng(seed)), floor_prices, rule, **rule_params)
+
+
+def chunk_sums(cam_bid_prop_offset, N, floor_prices, seed_seq, rule, rule_params):
+    return auction_sums(draw_bids(N, cam_bid_prop_offset, np.random.default_rng(seed_seq)), floor_prices, rule, **rule_params)
+
+
+def run_sim_sweep(cam_bid_prop_offsets, N=10000000, floor_prices=np.arange(0, 2, 0.002), chunk_size=500000, workers=1, seed=0,
+                  rule='lowest_qualifying', rule_params={}):
+    # run_sim_grid for each offset with N auctions drawn chunk_size at a time, so memory doesn't grow with N.
+    # every chunk has its own seed spawned from seed, and the chunks' sums are added in order, so the results
+    # are the same for any number of workers. returns a DataFrame of outcomes per offset
+    chunk_Ns = [min(chunk_size, N - start) for start in range(0, N, chunk_size)]
+    offset_seeds = np.random.SeedSequence(seed).spawn(len(cam_bid_prop_offsets))
+    tasks = [(cam_bid_prop_offset, chunk_N, floor_prices, chunk_seed, rule, rule_params)
+             for cam_bid_prop_offset, offset_seed in zip(cam_bid_prop_offsets, offset_seeds)
+             for chunk_N, chunk_seed in zip(chunk_Ns, offset_seed.spawn(len(chunk_Ns)))]
+    print(f'doing run_sim_sweep: {len(cam_bid_prop_offsets)} offsets x {len(chunk_Ns)} chunks of up to {chunk_size} auctions on {workers} workers')
+
+    if workers <= 1:
+        chunk_results = [chunk_sums(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunk_results = list(executor.map(chunk_sums, *zip(*tasks)))
+
+    df_list = []
+    for i in range(len(cam_bid_prop_offsets)):
+        sums = chunk_results[i * len(chunk_Ns)]
+        for chunk in chunk_results[i * len(chunk_Ns) + 1:(i + 1) * len(chunk_Ns)]:
+            sums = {k: sums[k] + chunk[k] for k in sums}
+        df_list.append(outcomes_from_sums(sums, floor_prices))
+    return df_list
+
+
+def run_sim(
+    floor_price=1,
+    N = 100000,
+    cam_bid_prop_offset = - 0.4,
+    seed = None
+    ):
+
+    return run_sim_grid([floor_price], N, cam_bid_prop_offset, seed).reset_index().iloc[0].to_dict()
 
 
 
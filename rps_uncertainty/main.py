@@ -1,13 +1,17 @@
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from google.cloud import bigquery
 import configparser
-from google.cloud import bigquery_storage
 import os, sys
 import datetime
 import pickle
 from matplotlib.backends.backend_pdf import PdfPages
+sys.path.append(os.path.join(sys.path[0], '..'))
+from utils.bq import run_query
+from utils.query_cache import get_cached_data
+from utils.bq_executor import run_concurrently
+from utils.day_partitions import create_window_table
+from session_buckets import SessionRevenue
 
 pd.set_option('display.max_columns', None)
 pd.set_option('display.width', 1000)
@@ -17,13 +21,11 @@ config = configparser.ConfigParser()
 config.read(config_path)
 
 project_id = "streamamp-qa-239417"
-client = bigquery.Client(project=project_id)
-bqstorageclient = bigquery_storage.BigQueryReadClient()
 
-def get_bq_data(query, replacement_dict={}):
+def get_bq_data(query, replacement_dict={}, result_type='dataframe', compact=False):
     for k, v in replacement_dict.items():
         query = query.replace("{"+k+"}", f'{v}')
-    return client.query(query).result().to_dataframe(bqstorage_client=bqstorageclient, progress_bar_type='tqdm')
+    return run_query(project_id, query, result_type, compact)
 
 def get_eventstream_session_data(last_date, days, force_recalc=False, session_data_type=''):
 
@@ -42,7 +44,7 @@ def get_eventstream_session_data(last_date, days, force_recalc=False, session_da
     if force_recalc:
         print(f'creating table: {tablename}')
         query = open(os.path.join(sys.path[0], query_file), "r").read()
-        get_bq_data(query, repl_dict)
+        create_window_table(project_id, query, repl_dict, get_bq_data)
 
     return tablename
 
@@ -62,26 +64,15 @@ def get_dtf_session_data(last_date, days, force_recalc=True, session_data_type='
     if force_recalc:
         print(f'creating table: {tablename}')
         query = open(os.path.join(sys.path[0], query_file), "r").read()
-        get_bq_data(query, repl_dict)
+        create_window_table(project_id, query, repl_dict, get_bq_data)
 
     return tablename
 
 
-def get_data_using_query(query, filename, index=None, force_calc=False, repl_dict={}):
-    data_cache_filename = f'data_cache/{filename}.pkl'
-    if not force_calc and os.path.exists(data_cache_filename):
-        print(f'found existing data file, loading: {data_cache_filename}')
-    else:
-        print(f'{datetime.datetime.now()}: querying to create file: {data_cache_filename}')
-        df = get_bq_data(query, repl_dict)
-        if index is not None:
-            df = df.set_index(index)
-
-        with open(data_cache_filename, 'wb') as f:
-            pickle.dump(df, f)
-
-    with open(data_cache_filename, 'rb') as f:
-        df = pickle.load(f)
+def get_data_using_query(query, filename, index=None, force_calc=False, repl_dict={}, compact=False):
+    df = get_cached_data(query, repl_dict, lambda q, r: get_bq_data(q, r, compact=compact), force_requery=force_calc, name=filename)
+    if index is not None:
+        df = df.set_index(index)
     return df
 
 def get_bidders(force_calc=False):
@@ -92,9 +83,16 @@ def get_mask_values(force_calc=False):
     query = 'select status, mask_value from `freestar-157323.ad_manager_dtf.lookup_mask` order by 2'
     return get_data_using_query(query, 'bidder_mask_values', 'status', force_calc=force_calc)
 
+def get_session_revenue(repl_dict, filename_filter_string, force_calc=False, seed=0):
+    # every session's date, mask and revenue in one (compact) pull, for SessionRevenue to bucket locally
+    query = open(os.path.join(sys.path[0], "query_get_session_revenue.sql"), "r").read()
+    df = get_data_using_query(query, f'session_revenue{filename_filter_string}', force_calc=force_calc,
+                              repl_dict=repl_dict, compact=True)
+    return SessionRevenue(df, seed=seed)
+
 def get_df_stats_and_df_hist_dict(last_date, days, number_of_buckets=1000, modifications=(""),
                                   force_calc_rps_uncertainty=False, force_recalc_session_data=False,
-                                  session_data_type='_dtf_split'):
+                                  session_data_type='_dtf_split', local_buckets=False):
     
     amazon_and_preGAM = ['amazon', 'preGAMAuction']
     amazon_and_preGAM_client = False
@@ -122,8 +120,7 @@ def get_df_stats_and_df_hist_dict(last_date, days, number_of_buckets=1000, modif
     df_bidders = get_bidders(force_calc=force_calc_rps_uncertainty)
     df_mask_values = get_mask_values(force_calc=force_calc_rps_uncertainty)
 
-    df_hist_dict = {}
-    stats_list = []
+    bidder_status_list = []
     for bidder, bidder_row in df_bidders.iterrows():
         for status, status_row in df_mask_values.iterrows():
             bidder_mask_list = list('.......................')
@@ -135,36 +132,57 @@ def get_df_stats_and_df_hist_dict(last_date, days, number_of_buckets=1000, modif
                     bidder_mask_list[df_bidders.loc[bidder_to_set_to_client]['position']-1] = str(df_mask_values.loc['client']['mask_value'])
 
             bidder_mask_list[bidder_row.position - 1] = str(status_row.mask_value)
-            repl_dict['bidder_mask'] = ''.join(bidder_mask_list)
-
-            session_count = get_data_using_query(
-                open(os.path.join(sys.path[0], "query_get_bidder_status_session_count.sql"), "r").read(),
-                f'bidder_status_session_count_{bidder}_{status}{filename_filter_string}',
-                force_calc=force_calc_rps_uncertainty, repl_dict=repl_dict).values[0, 0]
-
-            repl_dict['total_sessions'] = session_count
+            bidder_status_list.append((bidder, status, dict(repl_dict, bidder_mask=''.join(bidder_mask_list))))
 
-            df_list = []
-            for sessions_per_bucket in [20, 100, 500, 2500, 12500, 60000, 300000]:
-                if session_count < sessions_per_bucket * repl_dict['number_of_buckets'] / 20:
-                    continue
+    if local_buckets:
+        # one pull of the sessions, then every bidder x status and bucket size is counted and bucketed locally
+        sessions = get_session_revenue(repl_dict, filename_filter_string, force_calc=force_calc_rps_uncertainty)
+        session_counts = [sessions.session_count(bidder_status_repl_dict['bidder_mask'])
+                          for _, _, bidder_status_repl_dict in bidder_status_list]
+    else:
+        # every bidder x status (and then every bucket size) is independent, so the queries run concurrently
+        query_session_count = open(os.path.join(sys.path[0], "query_get_bidder_status_session_count.sql"), "r").read()
+        session_counts = run_concurrently(
+            lambda bidder, status, bidder_status_repl_dict: get_data_using_query(
+                query_session_count, f'bidder_status_session_count_{bidder}_{status}{filename_filter_string}',
+                force_calc=force_calc_rps_uncertainty, repl_dict=bidder_status_repl_dict).values[0, 0],
+            bidder_status_list, names=[f'session_count_{bidder}_{status}' for bidder, status, _ in bidder_status_list])
+
+    rps_job_list = []
+    for (bidder, status, bidder_status_repl_dict), session_count in zip(bidder_status_list, session_counts):
+        for sessions_per_bucket in [20, 100, 500, 2500, 12500, 60000, 300000]:
+            if session_count < sessions_per_bucket * repl_dict['number_of_buckets'] / 20:
+                continue
 
-                repl_dict['sessions_per_bucket'] = sessions_per_bucket
-                df = get_data_using_query(
-                    open(os.path.join(sys.path[0], "query_get_bidder_status_rps.sql"), "r").read(),
-                    f'rps_uncertainty_{bidder}_{status}_{sessions_per_bucket}_{repl_dict["number_of_buckets"]}{filename_filter_string}',
-                    force_calc=force_calc_rps_uncertainty, repl_dict=repl_dict)
+            rps_job_list.append((bidder, status, session_count, sessions_per_bucket,
+                                 dict(bidder_status_repl_dict, total_sessions=session_count, sessions_per_bucket=sessions_per_bucket)))
 
-                stats_list.append({'bidder': bidder, 'status': status, 'modification': filename_filter_string, 'session_count': session_count, 'sessions': sessions_per_bucket,
-                         'mean': df['bucket_rps'].mean(), 'std': df['bucket_rps'].std()})
+    if local_buckets:
+        # the jobs of a bidder x status are consecutive, so its prefix sums are only computed once
+        df_rps_list = [sessions.bucket_rps(rps_repl_dict['bidder_mask'], [sessions_per_bucket], number_of_buckets).rename(
+                           columns={sessions_per_bucket: 'bucket_rps'})
+                       for _, _, _, sessions_per_bucket, rps_repl_dict in rps_job_list]
+    else:
+        query_rps = open(os.path.join(sys.path[0], "query_get_bidder_status_rps.sql"), "r").read()
+        df_rps_list = run_concurrently(
+            lambda bidder, status, session_count, sessions_per_bucket, rps_repl_dict: get_data_using_query(
+                query_rps, f'rps_uncertainty_{bidder}_{status}_{sessions_per_bucket}_{repl_dict["number_of_buckets"]}{filename_filter_string}',
+                force_calc=force_calc_rps_uncertainty, repl_dict=rps_repl_dict),
+            rps_job_list, names=[f'rps_uncertainty_{job[0]}_{job[1]}_{job[3]}' for job in rps_job_list])
 
-                df_list.append(df[['bucket_rps']].rename(columns={'bucket_rps': sessions_per_bucket}))
+    df_hist_dict = {}
+    stats_list = []
+    for (bidder, status, session_count, sessions_per_bucket, _), df in zip(rps_job_list, df_rps_list):
+        stats_list.append({'bidder': bidder, 'status': status, 'modification': filename_filter_string, 'session_count': session_count, 'sessions': sessions_per_bucket,
+                 'mean': df['bucket_rps'].mean(), 'std': df['bucket_rps'].std()})
 
-            if len(df_list) == 0:
-                continue
+        hist_key = f'{bidder}-{status}'
+        if hist_key not in df_hist_dict:
+            df_hist_dict[hist_key] = {'session_count': session_count, 'modification': filename_filter_string, 'df_list': []}
+        df_hist_dict[hist_key]['df_list'].append(df[['bucket_rps']].rename(columns={'bucket_rps': sessions_per_bucket}))
 
-            df = pd.concat(df_list, axis=1)
-            df_hist_dict[f'{bidder}-{status}'] = {'session_count': session_count, 'modification': filename_filter_string, 'df': df}
+    for hist in df_hist_dict.values():
+        hist['df'] = pd.concat(hist.pop('df_list'), axis=1)
 
     df_stats = pd.DataFrame(stats_list)
     return df_stats, df_hist_dict, filename_filter_string
@@ -219,7 +237,8 @@ def main(last_date, days,
          force_recalc_session_data=False,
          number_of_buckets=1000,
          do_plots=False,
-         session_data_type='_dtf'):
+         session_data_type='_dtf',
+         local_buckets=False):
 
     df_stats_list = []
     #(name, additional and in where clause, amazon_and_preGAM_client)
@@ -235,7 +254,7 @@ def main(last_date, days,
         ("_US_desktop_678910_34567_US_desktop_apGc", US_desktop + client_server_count_and_modification(2, 2), True)]:
 
         df_stats, df_hist_dict, filename_filter_string = get_df_stats_and_df_hist_dict(last_date, days, number_of_buckets,
-            modifications, force_calc_rps_uncertainty, force_recalc_session_data, session_data_type)
+            modifications, force_calc_rps_uncertainty, force_recalc_session_data, session_data_type, local_buckets)
 
         if do_plots:
             with PdfPages(f'plots/bidder_status_rps_uncertainty_{number_of_buckets}{filename_filter_string}.pdf') as pdf:
@@ -286,5 +305,6 @@ if __name__ == "__main__":
 
     # main(last_date=datetime.date(2024, 8, 20), days=30, do_plots=False)
     # main(last_date=datetime.date(2024, 8, 20), days=30, session_data_type='_dtf_split_revenue')
+    # main(last_date=datetime.date(2024, 8, 20), days=30, session_data_type='_dtf_split_revenue', local_buckets=True)
     # main(last_date=datetime.date(2024, 8, 20), days=30, session_data_type='_evt_split_revenue', force_recalc_session_data=False)
     # main(last_date=datetime.date(2024, 8, 20), days=30, session_data_type='_evt', force_recalc_session_data=False)
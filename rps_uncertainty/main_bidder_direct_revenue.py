@@ -1,13 +1,14 @@
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from google.cloud import bigquery
 import configparser
-from google.cloud import bigquery_storage
 import os, sys
 import datetime
 import pickle
 from matplotlib.backends.backend_pdf import PdfPages
+sys.path.append(os.path.join(sys.path[0], '..'))
+from utils.bq import run_query
+from utils.query_cache import get_cached_data
 
 pd.set_option('display.max_columns', None)
 pd.set_option('display.width', 1000)
@@ -17,13 +18,11 @@ config = configparser.ConfigParser()
 config.read(config_path)
 
 project_id = "streamamp-qa-239417"
-client = bigquery.Client(project=project_id)
-bqstorageclient = bigquery_storage.BigQueryReadClient()
 
 def get_bq_data(query, replacement_dict={}):
     for k, v in replacement_dict.items():
         query = query.replace("{"+k+"}", f'{v}')
-    return client.query(query).result().to_dataframe(bqstorage_client=bqstorageclient, progress_bar_type='tqdm')
+    return run_query(project_id, query)
 
 def get_session_data(last_date, days, force_recalc=False, left_join=False):
 
@@ -47,20 +46,9 @@ def get_session_data(last_date, days, force_recalc=False, left_join=False):
     return tablename
 
 def get_data_using_query(query, filename, index=None, force_calc=False, repl_dict={}):
-    data_cache_filename = f'data_cache/wb_{filename}.pkl'
-    if not force_calc and os.path.exists(data_cache_filename):
-        print(f'found existing data file, loading: {data_cache_filename}')
-    else:
-        print(f'{datetime.datetime.now()}: querying to create file: {data_cache_filename}')
-        df = get_bq_data(query, repl_dict)
-        if index is not None:
-            df = df.set_index(index)
-
-        with open(data_cache_filename, 'wb') as f:
-            pickle.dump(df, f)
-
-    with open(data_cache_filename, 'rb') as f:
-        df = pickle.load(f)
+    df = get_cached_data(query, repl_dict, get_bq_data, force_requery=force_calc, name=filename)
+    if index is not None:
+        df = df.set_index(index)
     return df
 
 def get_bidders(force_calc=False):
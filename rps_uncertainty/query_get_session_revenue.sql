@@ -0,0 +1,4 @@
+select date, fs_clientservermask, revenue
+  from `streamamp-qa-239417.DAS_eventstream_session_data.{session_data_tablename}`
+  where fs_clientservermask is not null
+  {and_filter_string}
@@ -0,0 +1,67 @@
+import re
+import numpy as np
+import pandas as pd
+
+# every session's revenue pulled once (query_get_session_revenue.sql, with the modification's and_filter_string)
+# and bucketed locally, instead of a query_get_bidder_status_rps.sql job per bidder x status x bucket size, which
+# applies the same filter:
+#   sessions = SessionRevenue(df_sessions, seed=0)
+#   sessions.session_count(bidder_mask)
+#   df = sessions.bucket_rps(bidder_mask, [20, 100, 500], number_of_buckets=1000)     (one column per bucket size)
+# as in the query, the sessions are put in date order (random within a date) and a bucket is a run of
+# sessions_per_bucket consecutive matching sessions from a random start. the order is drawn once for all the
+# sessions, which is also a date then random order of the sessions matching any mask, and every bucket of every
+# size is the difference of two prefix sums of the matching sessions' revenue.
+
+
+class SessionRevenue:
+    def __init__(self, df, seed=None):
+        self.rng = np.random.default_rng(seed)
+
+        # the masks are regex matched once per distinct mask, code -1 (a null mask) never matches
+        masks = pd.Categorical(df['fs_clientservermask'])
+        self.masks = np.asarray(masks.categories, dtype=object)
+
+        # date then random order, sorting date code + a uniform fraction
+        date_codes = pd.factorize(df['date'], sort=True)[0]
+        order = np.argsort(date_codes + self.rng.random(len(df)))
+        self.mask_codes = masks.codes[order]
+        revenue = df['revenue'].to_numpy(dtype=np.float64, na_value=np.nan)[order]
+        # avg(revenue) skips null revenue
+        self.has_revenue = ~np.isnan(revenue)
+        self.revenue = np.where(self.has_revenue, revenue, 0)
+        self.cum_mask = None
+
+    def __len__(self):
+        return len(self.revenue)
+
+    def matches(self, bidder_mask):
+        # REGEXP_CONTAINS(fs_clientservermask, bidder_mask) for every session
+        pattern = re.compile(bidder_mask)
+        distinct_match = np.array([pattern.search(m) is not None for m in self.masks] + [False])
+        return distinct_match[self.mask_codes]
+
+    def session_count(self, bidder_mask):
+        return int(self.matches(bidder_mask).sum())
+
+    def prefix_sums(self, bidder_mask):
+        # revenue and non null revenue count summed over the matching sessions, kept for the last mask asked for
+        if self.cum_mask != bidder_mask:
+            match = self.matches(bidder_mask)
+            self.cum_revenue = np.r_[0, np.cumsum(self.revenue[match])]
+            self.cum_count = np.r_[0, np.cumsum(self.has_revenue[match])]
+            self.cum_mask = bidder_mask
+        return self.cum_revenue, self.cum_count
+
+    def bucket_rps(self, bidder_mask, sessions_per_bucket_list, number_of_buckets=1000):
+        # number_of_buckets bucket rps for each bucket size, starting at cast(rand() * (total - size) as int)
+        # (bigquery rounds) as the query does
+        cum_revenue, cum_count = self.prefix_sums(bidder_mask)
+        total_sessions = len(cum_revenue) - 1
+        bucket_rps = {}
+        for sessions_per_bucket in sessions_per_bucket_list:
+            starts = np.round(self.rng.random(number_of_buckets) * max(total_sessions - sessions_per_bucket, 0)).astype(np.int64)
+            ends = np.minimum(starts + sessions_per_bucket, total_sessions)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                bucket_rps[sessions_per_bucket] = 1000 * (cum_revenue[ends] - cum_revenue[starts]) / (cum_count[ends] - cum_count[starts])
+        return pd.DataFrame(bucket_rps)
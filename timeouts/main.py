@@ -1,13 +1,15 @@
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from google.cloud import bigquery
 import configparser
-from google.cloud import bigquery_storage
 import os, sys
 import datetime
 import pickle
 from matplotlib.backends.backend_pdf import PdfPages
+sys.path.append(os.path.join(sys.path[0], '..'))
+from utils.bq import run_query, stream_query
+from utils.stream_reducers import Histogram, reduce_batches
+from utils.query_cache import get_cached_data
 
 pd.set_option('display.max_columns', None)
 pd.set_option('display.width', 1000)
@@ -17,39 +19,33 @@ config = configparser.ConfigParser()
 config.read(config_path)
 
 project_id = "streamamp-qa-239417"
-client = bigquery.Client(project=project_id)
-bqstorageclient = bigquery_storage.BigQueryReadClient()
 
 def get_bq_data(query, replacement_dict={}):
     for k, v in replacement_dict.items():
         query = query.replace("{"+k+"}", f'{v}')
-    return client.query(query).result().to_dataframe(bqstorage_client=bqstorageclient, progress_bar_type='tqdm')
+    return run_query(project_id, query)
 
 def get_data(query_filename, data_cache_filename, force_requery=False, repl_dict = {}):
-    data_cache_filename_full = f'data_cache/{data_cache_filename}.pkl'
-
-    if not force_requery and os.path.exists(data_cache_filename_full):
-        print(f'found existing data file, loading {data_cache_filename_full}')
-        with open(data_cache_filename_full, 'rb') as f:
-            df = pickle.load(f)
-        return df
-
     query = open(os.path.join(sys.path[0], f"queries/{query_filename}.sql"), "r").read()
-    df = get_bq_data(query, repl_dict)
-
-    with open(data_cache_filename_full, 'wb') as f:
-        pickle.dump(df, f)
-    return df
+    return get_cached_data(query, repl_dict, get_bq_data, force_requery=force_requery, name=data_cache_filename)
 
 
-def main_pageview(force_requery=False):
+def main_pageview(force_requery=False, stream=False):
     max_duration = 60 * 60 # equals one hour
 
-    df_raw = get_data('pageview_duration', 'pageview_duration', force_requery)
-
-    duration = df_raw['duration_ms'].sort_values(inplace=False).values / 1000
-    duration[duration > max_duration] = max_duration
-    df = pd.Series(np.arange(len(duration)) / len(duration), index=pd.Index(duration))
+    if stream:
+        # one row per pageview is too much to hold in memory, and the plot only needs the cdf up to 5 secs,
+        # so the durations are binned to the millisecond as they stream in
+        query = open(os.path.join(sys.path[0], "queries/pageview_duration.sql"), "r").read()
+        histogram = Histogram('duration_ms', np.arange(0, 5000 + 1))
+        reduce_batches(stream_query(project_id, query), [histogram])
+        df = pd.Series(histogram.cdf(), index=pd.Index(histogram.bins[1:] / 1000))
+    else:
+        df_raw = get_data('pageview_duration', 'pageview_duration', force_requery)
+
+        duration = df_raw['duration_ms'].sort_values(inplace=False).values / 1000
+        duration[duration > max_duration] = max_duration
+        df = pd.Series(np.arange(len(duration)) / len(duration), index=pd.Index(duration))
 
     df_ = df.iloc[np.arange(0, len(df), 100)]
     j = 0
@@ -0,0 +1,120 @@
+import numpy as np
+import scipy
+
+# many small weighted least squares fits at once, one per group of rows (e.g. one per ad unit), giving the
+# same coefficients as LinearRegression(fit_intercept, positive).fit(X, y, sample_weight=w) on each group:
+#   codes, names = pd.factorize(df['ad_unit_name'])
+#   coef, intercept = batched_wls(X, y, w, codes, len(names))
+#   pred = batched_predict(X, coef, intercept, codes)
+# the normal equations of every group are built with bincount and solved in one batched call.
+
+# positive fits with up to this many features enumerate the active sets, more go through scipy nnls per group
+max_enumerated_features = 3
+
+
+def group_sums(values, codes, n_groups):
+    # sum of values (rows, ...) per group, shape (n_groups, ...)
+    values = np.asarray(values, dtype=np.float64)
+    flat = values.reshape(len(values), -1)
+    sums = np.stack([np.bincount(codes, weights=flat[:, k], minlength=n_groups) for k in range(flat.shape[1])], axis=1)
+    return sums.reshape((n_groups,) + values.shape[1:])
+
+
+def as_design(X):
+    X = np.asarray(X, dtype=np.float64)
+    return X.reshape(-1, 1) if X.ndim == 1 else X
+
+
+def finite_groups(X, y, codes, n_groups):
+    # like fit_model, a group with any non finite feature or target is not fitted
+    bad_rows = ~(np.isfinite(X).all(axis=1) & np.isfinite(y))
+    return np.bincount(codes, weights=bad_rows, minlength=n_groups) == 0
+
+
+def centred_system(X, y, w, codes, n_groups, fit_intercept):
+    # weighted means per group, then the rows with them removed, as sklearn does before solving
+    if fit_intercept:
+        w_sum = group_sums(w, codes, n_groups)
+        w_sum_safe = np.where(w_sum > 0, w_sum, 1)
+        X_mean = group_sums(X * w[:, None], codes, n_groups) / w_sum_safe[:, None]
+        y_mean = group_sums(y * w, codes, n_groups) / w_sum_safe
+        return X - X_mean[codes], y - y_mean[codes], X_mean, y_mean
+    p = X.shape[1]
+    return X, y, np.zeros((n_groups, p)), np.zeros(n_groups)
+
+
+def normal_equations(X, y, w, codes, n_groups):
+    # X'WX (n_groups, p, p) and X'Wy (n_groups, p)
+    Xw = X * w[:, None]
+    XtX = group_sums(Xw[:, :, None] * X[:, None, :], codes, n_groups)
+    Xty = group_sums(Xw * y[:, None], codes, n_groups)
+    return XtX, Xty
+
+
+def solve_normal_equations(XtX, Xty):
+    # pseudo inverse so a group with collinear or constant features gets the minimum norm solution, as lstsq does
+    return np.einsum('gij,gj->gi', np.linalg.pinv(XtX, rcond=1e-12, hermitian=True), Xty)
+
+
+def nnls_groups(X, y, w, codes, groups, coef):
+    # the non negative fits one group at a time, for more features than are worth enumerating
+    sqrt_w = np.sqrt(w)
+    for g in groups:
+        rows = np.flatnonzero(codes == g)
+        coef[g] = scipy.optimize.nnls(X[rows] * sqrt_w[rows, None], y[rows] * sqrt_w[rows])[0]
+    return coef
+
+
+def batched_nnls(XtX, Xty):
+    # exact non negative least squares from the normal equations, by trying every set of free coefficients:
+    # each set's unconstrained solution (the others held at zero) is a candidate, and the optimum is the
+    # candidate with no negative coefficient and the lowest residual sum of squares. 2^p solves per group
+    p = XtX.shape[1]
+    best_coef = np.zeros(Xty.shape)
+    best_objective = np.zeros(len(Xty))
+    for subset in range(1, 2 ** p):
+        free = np.array([(subset >> k) & 1 == 1 for k in range(p)])
+        # the fixed coefficients get an identity block so the system stays p x p
+        A = np.where(np.outer(free, free), XtX, 0) + np.diag(~free)
+        coef = np.where(free, solve_normal_equations(A, np.where(free, Xty, 0)), 0)
+        # residual sum of squares less the constant y'Wy
+        objective = np.einsum('gi,gij,gj->g', coef, XtX, coef) - 2 * (coef * Xty).sum(axis=1)
+        better = (coef >= 0).all(axis=1) & (objective < best_objective)
+        best_coef[better] = coef[better]
+        best_objective[better] = objective[better]
+    return best_coef
+
+
+def batched_wls(X, y, w, codes, n_groups, fit_intercept=True, positive=False):
+    # X (rows, p), y and w (rows,), codes the group of each row in 0..n_groups-1.
+    # returns coef (n_groups, p) and intercept (n_groups,), nan for groups with non finite data
+    X = as_design(X)
+    y = np.asarray(y, dtype=np.float64)
+    w = np.ones(len(y)) if w is None else np.asarray(w, dtype=np.float64)
+    codes = np.asarray(codes)
+
+    finite = finite_groups(X, y, codes, n_groups)
+    X = np.where(np.isfinite(X), X, 0)
+    y = np.where(np.isfinite(y), y, 0)
+
+    Xc, yc, X_mean, y_mean = centred_system(X, y, w, codes, n_groups, fit_intercept)
+    XtX, Xty = normal_equations(Xc, yc, w, codes, n_groups)
+    coef = solve_normal_equations(XtX, Xty)
+
+    if positive:
+        # only the groups whose unconstrained solution has a negative coefficient need the constrained fit
+        negative = np.flatnonzero(finite & (coef < 0).any(axis=1))
+        if X.shape[1] <= max_enumerated_features:
+            coef[negative] = batched_nnls(XtX[negative], Xty[negative])
+        else:
+            coef = nnls_groups(Xc, yc, w, codes, negative, coef)
+
+    intercept = y_mean - (X_mean * coef).sum(axis=1)
+    coef[~finite] = np.nan
+    intercept[~finite] = np.nan
+    return coef, intercept
+
+
+def batched_predict(X, coef, intercept, codes):
+    X = as_design(X)
+    return (X * coef[codes]).sum(axis=1) + intercept[codes]
@@ -0,0 +1,57 @@
+import time
+
+import utils.bq_clients
+from utils.bq_clients import get_client, get_bqstorage_client
+from utils.bq_results import result_to_data
+from utils.query_metrics import query_record, job_metrics, data_metrics, log_query_metrics
+from utils.query_guard import preflight
+
+
+def run_query(project_id, query, result_type='dataframe', compact=False, progress_bar_type='tqdm'):
+    # the one place the scripts' get_bq_data run a rendered query, so every query is checked and measured the same way
+    client = get_client(project_id)
+    guard = preflight(client, query)
+
+    start = time.time()
+    job = None
+    job_s = None
+    try:
+        job = client.query(query)
+        result = job.result()
+        job_s = time.time() - start
+        data = result_to_data(result, get_bqstorage_client(), result_type, compact, progress_bar_type=progress_bar_type)
+    except Exception as e:
+        log_query_metrics(query_record(query, 'bigquery', project_id=project_id, backend=utils.bq_clients.backend,
+                                       **(job_metrics(job) if job is not None else {}),
+                                       job_s=job_s if job_s is not None else time.time() - start,
+                                       error=f'{type(e).__name__}: {e}'))
+        raise
+
+    download_s = time.time() - start - job_s
+    log_query_metrics(query_record(query, 'bigquery', project_id=project_id, backend=utils.bq_clients.backend,
+                                   **job_metrics(job), **guard, job_s=job_s, download_s=download_s, result_type=result_type,
+                                   **data_metrics(data)))
+    return data
+
+
+def stream_query(project_id, query, max_queue_size=2):
+    # yields the result as pyarrow RecordBatches straight from the storage read api, so only a batch
+    # (plus max_queue_size read ahead) is in memory at a time. the metrics are logged once it is exhausted
+    client = get_client(project_id)
+    guard = preflight(client, query)
+
+    start = time.time()
+    job = client.query(query)
+    result = job.result()
+    job_s = time.time() - start
+
+    rows = 0
+    max_batch_bytes = 0
+    for batch in result.to_arrow_iterable(bqstorage_client=get_bqstorage_client(), max_queue_size=max_queue_size):
+        rows += batch.num_rows
+        max_batch_bytes = max(max_batch_bytes, batch.nbytes)
+        yield batch
+
+    log_query_metrics(query_record(query, 'bigquery', project_id=project_id, backend=utils.bq_clients.backend,
+                                   **job_metrics(job), **guard, job_s=job_s, download_s=time.time() - start - job_s,
+                                   result_type='stream', rows=rows, memory_bytes=max_batch_bytes))
@@ -0,0 +1,51 @@
+import threading
+
+# clients are created on first use and shared by every module and thread, so importing an analysis,
+# or running it purely from the query cache, never does credential discovery or opens a grpc channel
+
+
+def bigquery_client(project_id):
+    from google.cloud import bigquery
+    return bigquery.Client(project=project_id)
+
+
+def bigquery_storage_client():
+    from google.cloud import bigquery_storage
+    return bigquery_storage.BigQueryReadClient()
+
+
+# name -> (client factory taking a project_id, storage read client factory)
+backends = {'bigquery': (bigquery_client, bigquery_storage_client)}
+backend = 'bigquery'
+
+clients = {}
+bqstorage_clients = {}
+clients_lock = threading.Lock()
+
+
+def register_backend(name, client_factory, bqstorage_client_factory=lambda: None):
+    backends[name] = (client_factory, bqstorage_client_factory)
+
+
+def set_backend(name):
+    global backend
+    assert name in backends, f'unknown bigquery backend: {name}, registered: {", ".join(backends.keys())}'
+    with clients_lock:
+        backend = name
+        clients.clear()
+        bqstorage_clients.clear()
+
+
+def get_client(project_id):
+    key = (backend, project_id)
+    with clients_lock:
+        if key not in clients:
+            clients[key] = backends[backend][0](project_id)
+        return clients[key]
+
+
+def get_bqstorage_client():
+    with clients_lock:
+        if backend not in bqstorage_clients:
+            bqstorage_clients[backend] = backends[backend][1]()
+        return bqstorage_clients[backend]
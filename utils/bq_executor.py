@@ -0,0 +1,54 @@
+import time
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from google.api_core import exceptions
+
+# bigquery jobs spend their time waiting on the service, so threads are enough to overlap them
+max_concurrent_jobs = 8
+
+transient_errors = (exceptions.TooManyRequests, exceptions.InternalServerError, exceptions.BadGateway,
+                    exceptions.ServiceUnavailable, exceptions.GatewayTimeout, ConnectionError)
+
+
+def run_with_retries(fn, args, name, retries=3, retry_wait_s=5):
+    start = time.time()
+    for attempt in range(1, retries + 2):
+        try:
+            result = fn(*args)
+            return result, {'name': name, 'attempts': attempt, 'seconds': time.time() - start}
+        except transient_errors as e:
+            if attempt > retries:
+                raise
+            wait_s = retry_wait_s * 2 ** (attempt - 1)
+            print(f'{datetime.datetime.now()}: transient error for {name} (attempt {attempt}), retrying in {wait_s}s: {e}')
+            time.sleep(wait_s)
+
+
+def run_concurrently(fn, args_list, names=None, max_workers=None, retries=3, retry_wait_s=5, report=True):
+    # calls fn(*args) for every args in args_list, at most max_workers at a time,
+    # and returns the results in the order of args_list
+    if max_workers is None:
+        max_workers = max_concurrent_jobs
+    if names is None:
+        names = [str(args) for args in args_list]
+    args_list = [args if isinstance(args, tuple) else (args,) for args in args_list]
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(args_list)))) as executor:
+        futures = [executor.submit(run_with_retries, fn, args, name, retries, retry_wait_s)
+                   for args, name in zip(args_list, names)]
+        results_and_timings = [future.result() for future in futures]
+    wall_s = time.time() - start
+
+    results = [r for r, _ in results_and_timings]
+    if report and len(results_and_timings) > 0:
+        print_job_timings(pd.DataFrame([t for _, t in results_and_timings]), wall_s)
+    return results
+
+
+def print_job_timings(df_timings, wall_s):
+    print(df_timings.sort_values('seconds', ascending=False).head(20).to_string(index=False))
+    print(f'{len(df_timings)} jobs in {wall_s:0.1f}s wall time, {df_timings["seconds"].sum():0.1f}s summed job time, '
+          f'slowest job {df_timings["seconds"].max():0.1f}s, {(df_timings["attempts"] > 1).sum()} retried')
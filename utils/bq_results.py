@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# string columns with at most this share of distinct values are dictionary encoded
+max_dictionary_fraction = 0.5
+
+# rough cost of a python str in an object column on top of its utf-8 payload
+python_str_overhead_bytes = 49
+
+int_downcast_types = [pa.int8(), pa.int16(), pa.int32()]
+
+
+def object_dataframe_bytes(column):
+    # what to_dataframe() would cost for this column: 8 byte pointers plus one python str per value
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        lengths = pc.sum(pc.utf8_length(column)).as_py() or 0
+        return len(column) * (8 + python_str_overhead_bytes) + lengths
+    return column.nbytes
+
+
+def compact_column(column, downcast_floats=False):
+    column_type = column.type
+
+    if pa.types.is_string(column_type) or pa.types.is_large_string(column_type):
+        distinct = pc.count_distinct(column).as_py()
+        if len(column) == 0 or distinct > max_dictionary_fraction * len(column):
+            return column
+        for index_type in int_downcast_types:
+            if distinct <= np.iinfo(index_type.to_pandas_dtype()).max:
+                return pc.dictionary_encode(column).cast(pa.dictionary(index_type, column_type))
+        return pc.dictionary_encode(column)
+
+    if pa.types.is_integer(column_type) and column.null_count < len(column):
+        min_max = pc.min_max(column)
+        col_min, col_max = min_max['min'].as_py(), min_max['max'].as_py()
+        for int_type in int_downcast_types:
+            if int_type.bit_width >= column_type.bit_width:
+                break
+            info = np.iinfo(int_type.to_pandas_dtype())
+            if info.min <= col_min and col_max <= info.max:
+                return column.cast(int_type)
+        return column
+
+    if downcast_floats and pa.types.is_float64(column_type):
+        return column.cast(pa.float32(), safe=False)
+
+    return column
+
+
+def compact_arrow_table(table, downcast_floats=False, report=True):
+    columns = []
+    report_list = []
+    for name, column in zip(table.column_names, table.columns):
+        compacted = compact_column(column, downcast_floats)
+        columns.append(compacted)
+        report_list.append({'column': name,
+                            'type': str(compacted.type),
+                            'object_dataframe_bytes': object_dataframe_bytes(column),
+                            'compact_bytes': compacted.nbytes})
+
+    # one dictionary per column across all chunks, so the table can be written to the arrow ipc cache
+    compacted_table = pa.Table.from_arrays(columns, names=table.column_names).unify_dictionaries()
+    if report:
+        print_bytes_saved(pd.DataFrame(report_list))
+    return compacted_table
+
+
+def print_bytes_saved(df_report):
+    before = df_report['object_dataframe_bytes'].sum()
+    after = df_report['compact_bytes'].sum()
+    print(df_report.set_index('column'))
+    print(f'compact result: {after / 1024 ** 2:0.1f}MB vs {before / 1024 ** 2:0.1f}MB as an object dtype DataFrame, '
+          f'saved {(before - after) / 1024 ** 2:0.1f}MB ({(1 - after / before) * 100 if before > 0 else 0:0.0f}%)')
+
+
+def result_to_data(result, bqstorage_client, result_type='dataframe', compact=False, downcast_floats=False,
+                   progress_bar_type='tqdm'):
+    # result_type: 'dataframe' (numpy/object dtypes as before), 'arrow' (pyarrow.Table)
+    # or 'arrow_dataframe' (DataFrame backed by pd.ArrowDtype columns)
+    assert result_type in ['dataframe', 'arrow', 'arrow_dataframe']
+
+    if result_type == 'dataframe' and not compact:
+        return result.to_dataframe(bqstorage_client=bqstorage_client, progress_bar_type=progress_bar_type)
+
+    table = result.to_arrow(bqstorage_client=bqstorage_client, progress_bar_type=progress_bar_type)
+    if compact:
+        table = compact_arrow_table(table, downcast_floats)
+
+    if result_type == 'arrow':
+        return table
+    if result_type == 'arrow_dataframe':
+        return table.to_pandas(types_mapper=pd.ArrowDtype)
+    # dictionary columns come back as pandas categoricals
+    return table.to_pandas()
@@ -0,0 +1,88 @@
+import re
+import datetime
+import hashlib
+
+import pandas as pd
+
+from utils.bq_clients import get_client
+from utils.bq_executor import run_concurrently
+from utils.queries import render_query
+
+# rolling window queries take (processing_date, days_back_start, days_back_end) and cover the days
+# processing_date - days_back_start to processing_date - days_back_end inclusive. the window is built from
+# one result per day, each the same template run with processing_date = day + 1 and days_back 1 to 1,
+# so moving the window forward a day only runs the template for the new day.
+# each day's table id ends with a hash of its rendered query, so a changed template gets new day tables
+# instead of reusing ones built by the old sql. the window table keeps the template's OPTIONS (expiration).
+# sessions crossing utc midnight end up as one session per day.
+
+
+def window_dates(processing_date, days_back_start, days_back_end):
+    processing_date = pd.Timestamp(processing_date).date()
+    return [processing_date - datetime.timedelta(days=d) for d in range(int(days_back_start), int(days_back_end) - 1, -1)]
+
+
+def day_repl_dict(repl_dict, date):
+    return dict(repl_dict, processing_date=date + datetime.timedelta(days=1), days_back_start=1, days_back_end=1)
+
+
+def table_exists(project_id, table_id):
+    from google.api_core.exceptions import NotFound
+    try:
+        get_client(project_id).get_table(table_id)
+        return True
+    except NotFound:
+        return False
+
+
+create_table_pattern = r'CREATE\s+OR\s+REPLACE\s+TABLE\s+`([^`]+)`'
+
+
+def created_table_template(query):
+    m = re.search(create_table_pattern, query, re.I)
+    assert m is not None, 'the query must create a table: CREATE OR REPLACE TABLE `...{processing_date}...`'
+    return m.group(1)
+
+
+def created_table_options(query):
+    # the OPTIONS (...) clause following the created table's name, '' if there is none
+    m = re.search(create_table_pattern + r'\s*(OPTIONS\s*\()', query, re.I)
+    if m is None:
+        return ''
+    depth = 0
+    for i in range(m.end(2) - 1, len(query)):
+        depth += {'(': 1, ')': -1}.get(query[i], 0)
+        if depth == 0:
+            return query[m.start(2):i + 1]
+    assert False, 'unbalanced OPTIONS clause'
+
+
+def day_table(query, table_id_template, day_dict):
+    # the day's rendered query, creating a table whose id ends with a hash of that query
+    day_query = render_query(query, day_dict)
+    query_hash = hashlib.sha256(day_query.encode('utf-8')).hexdigest()[:12]
+    table_id = f'{render_query(table_id_template, day_dict)}_{query_hash}'
+    return re.sub(create_table_pattern, lambda m: f'CREATE OR REPLACE TABLE `{table_id}`', day_query, count=1, flags=re.I), table_id
+
+
+def create_window_table(project_id, query, repl_dict, fetch_data, force_recalc_days=False):
+    # query is the template creating the window's table, fetch_data the calling script's get_bq_data.
+    # the daily tables are created as needed, then unioned into the window table
+    table_id_template = created_table_template(query)
+    day_dicts = [day_repl_dict(repl_dict, date) for date in window_dates(repl_dict['processing_date'],
+                                                                          repl_dict['days_back_start'],
+                                                                          repl_dict['days_back_end'])]
+    day_tables = [day_table(query, table_id_template, day_dict) for day_dict in day_dicts]
+
+    missing = [(day_query, table_id) for day_query, table_id in day_tables
+               if force_recalc_days or not table_exists(project_id, table_id)]
+    print(f'{len(day_dicts) - len(missing)} of {len(day_dicts)} days already exist, creating {len(missing)}')
+    run_concurrently(lambda day_query: fetch_data(day_query, {}), [day_query for day_query, _ in missing],
+                     names=[table_id for _, table_id in missing])
+
+    window_table_id = render_query(table_id_template, repl_dict)
+    options = render_query(created_table_options(query), repl_dict)
+    union = '\nUNION ALL\n'.join([f'SELECT * FROM `{table_id}`' for _, table_id in day_tables])
+    fetch_data(f'CREATE OR REPLACE TABLE `{window_table_id}`\n{options}\nAS\n{union}', {})
+    return window_table_id
+
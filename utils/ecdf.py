@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+
+# the empirical cdfs of several columns on one merged grid of their values, as plotted to compare the
+# distributions of target floor prices from different approaches:
+#   df_cdf = merged_ecdf(df[['cpma_weighted', 'closed_form']], points=2000)
+#   (100 * df_cdf).plot()
+# each column's values are sorted once and the grid is looked up with searchsorted, instead of a frame per
+# column concatenated and grouped on the values.
+
+
+def column_ecdf(values, grid):
+    # i / (n - 1) for the i-th smallest value (tied values get their mean rank), carried forward to the grid
+    # points between values and back to the ones below the smallest
+    finite = values[np.isfinite(values)]
+    if len(finite) == 0:
+        return np.full(len(grid), np.nan)
+    distinct, counts = np.unique(finite, return_counts=True)
+    right = np.cumsum(counts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_rank = (2 * right - counts - 1) / 2 / (len(finite) - 1)
+    return mean_rank[np.maximum(np.searchsorted(distinct, grid, side='right') - 1, 0)]
+
+
+def merged_ecdf(df, points=None):
+    # one row per distinct finite value of any column (or about points of them, evenly spaced through the
+    # sorted values), one ecdf column per column of df
+    values = {nm: np.asarray(x, dtype=np.float64) for nm, x in df.items()}
+    grid = np.concatenate([x[np.isfinite(x)] for x in values.values()]) if values else np.zeros(0)
+    grid = np.unique(grid)
+    if (points is not None) and (len(grid) > points):
+        grid = grid[np.unique(np.linspace(0, len(grid) - 1, points).round().astype(np.int64))]
+    return pd.DataFrame({nm: column_ecdf(x, grid) for nm, x in values.items()}, index=pd.Index(grid))
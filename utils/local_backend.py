@@ -0,0 +1,350 @@
+import os
+import re
+import uuid
+import datetime
+import threading
+
+import pyarrow as pa
+
+# runs the bigquery sql templates against local parquet fixtures with duckdb, so a whole analysis
+# (query, pandas post processing, plotting) can be run and profiled without bigquery
+#
+# fixtures_dir holds one entry per bigquery table, named by its full table id:
+#   fixtures/freestar-157323.prod_eventstream.auction_end_raw.parquet
+#   fixtures/streamamp-qa-239417.Floors_2_0.floors_ad_unit_base/   (directory of parquet files, hive partitioning)
+#
+# the dialect translation covers what the templates here use, it is not a general bigquery emulator:
+# scripting (FOR, BEGIN/END), wildcard tables and the persistent udfs are not translated
+
+default_fixtures_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fixtures')
+
+# bigquery functions duckdb does not have under the same name
+macros = [
+    'CREATE OR REPLACE MACRO safe_divide(a, b) AS CASE WHEN b = 0 THEN NULL ELSE a / b END',
+    'CREATE OR REPLACE MACRO timestamp_millis(ms) AS epoch_ms(CAST(ms AS BIGINT))',
+    'CREATE OR REPLACE MACRO regexp_contains(s, pattern) AS regexp_matches(s, pattern)',
+    "CREATE OR REPLACE MACRO net_host(url) AS lower(regexp_extract(url, '^(?:[a-zA-Z]+://)?([^/:?#]+)', 1))",
+    "CREATE OR REPLACE MACRO net_reg_domain(url) AS regexp_extract(net_host(url), '([^.]+\\.[^.]+)$', 1)",
+]
+
+# bigquery column names that are keywords in duckdb
+reserved_identifiers = ['domain']
+
+# date parts duckdb will not take as a bare (no AS) column alias
+keyword_aliases = ['hour', 'minute', 'second', 'day', 'week', 'month', 'year']
+
+type_names = {'float64': 'DOUBLE', 'int64': 'BIGINT', 'bignumeric': 'DOUBLE', 'bool': 'BOOLEAN', 'bytes': 'BLOB'}
+
+connections = {}
+connections_lock = threading.Lock()
+
+
+def split_sql(sql):
+    # single pass over the sql: drops comments, makes every string literal a single quoted duckdb
+    # literal and turns `backtick` identifiers into "double quoted" ones
+    out = []
+    i = 0
+    n = len(sql)
+    while i < n:
+        c = sql[i]
+        if sql.startswith('--', i) or c == '#':
+            j = sql.find('\n', i)
+            i = n if j < 0 else j
+        elif sql.startswith('/*', i):
+            j = sql.find('*/', i + 2)
+            i = n if j < 0 else j + 2
+        elif c == '`':
+            j = sql.index('`', i + 1)
+            out.append('"' + sql[i + 1:j] + '"')
+            i = j + 1
+        elif c in 'rR' and i + 1 < n and sql[i + 1] in '\'"' and (i == 0 or not (sql[i - 1].isalnum() or sql[i - 1] == '_')):
+            value, i = read_string(sql, i + 1, raw=True)
+            out.append(quote_string(value))
+        elif c in '\'"':
+            value, i = read_string(sql, i, raw=False)
+            out.append(quote_string(value))
+        else:
+            out.append(c)
+            i += 1
+    return ''.join(out)
+
+
+def read_string(sql, i, raw):
+    quote = sql[i]
+    chars = []
+    i += 1
+    while sql[i] != quote:
+        if sql[i] == '\\':
+            if raw:
+                chars.append(sql[i:i + 2])
+            else:
+                chars.append({'n': '\n', 't': '\t'}.get(sql[i + 1], sql[i + 1]))
+            i += 2
+        else:
+            chars.append(sql[i])
+            i += 1
+    return ''.join(chars), i + 1
+
+
+def quote_string(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+def split_call_args(sql, start):
+    # sql[start:] follows the opening parenthesis of a call, returns the top level arguments and
+    # the index after the closing parenthesis
+    args = []
+    depth = 0
+    arg_start = start
+    i = start
+    while True:
+        c = sql[i]
+        if c == "'":
+            i = sql.index("'", i + 1)
+            while sql.startswith("''", i):
+                i = sql.index("'", i + 2)
+        elif c in '([':
+            depth += 1
+        elif c in ')]':
+            if depth == 0:
+                args.append(sql[arg_start:i].strip())
+                return [a for a in args if a != ''], i + 1
+            depth -= 1
+        elif c == ',' and depth == 0:
+            args.append(sql[arg_start:i].strip())
+            arg_start = i + 1
+        i += 1
+
+
+def interval(arg):
+    m = re.fullmatch(r'INTERVAL\s+(.+)\s+(\w+)', arg, re.I | re.S)
+    assert m is not None, f'expected INTERVAL <n> <part>, got: {arg}'
+    return f'INTERVAL ({m.group(1)}) {m.group(2)}'
+
+
+def date_part(arg):
+    return re.sub(r'\s+', '', arg).lower()
+
+
+def truncate(value, part):
+    part = date_part(part)
+    if part in ['week', 'week(sunday)']:
+        # bigquery weeks start on sunday, duckdb's date_trunc('week') on monday
+        return f"(date_trunc('day', {value}) - to_days(CAST(dayofweek({value}) AS INTEGER)))"
+    if part in ['isoweek', 'week(monday)']:
+        part = 'week'
+    return f"date_trunc('{part}', {value})"
+
+
+def approx_quantiles(args):
+    n = int(args[1])
+    return f'quantile_disc({args[0]}, [{", ".join(str(i / n) for i in range(n + 1))}])'
+
+
+def regexp_extract(args):
+    # bigquery returns the capture group if the pattern has one
+    has_group = re.search(r'(?<!\\)\((?!\?)', args[1]) is not None
+    return f'regexp_extract({args[0]}, {args[1]}, {1 if has_group else 0})'
+
+
+def generate_date_array(args):
+    step = interval(args[2]) if len(args) > 2 else 'INTERVAL 1 DAY'
+    return f'CAST(generate_series(CAST({args[0]} AS DATE), CAST({args[1]} AS DATE), {step}) AS DATE[])'
+
+
+def extract(args):
+    # bigquery numbers days of the week 1 (sunday) to 7, duckdb 0 to 6
+    if re.match(r'DAYOFWEEK\s+FROM\b', args[0], re.I):
+        return f'(1 + EXTRACT({args[0]}))'
+    return f'EXTRACT({args[0]})'
+
+
+def date_function(args):
+    if len(args) == 3:
+        return f'make_date({", ".join(args)})'
+    return f'CAST({args[0]} AS DATE)'
+
+
+function_rewrites = {
+    'in unnest': lambda args: f'IN (SELECT UNNEST({args[0]}))',
+    # bigquery coerces string literals, duckdb needs the cast to pick the operator
+    'date_sub': lambda args: f'CAST((CAST({args[0]} AS DATE) - {interval(args[1])}) AS DATE)',
+    'date_add': lambda args: f'CAST((CAST({args[0]} AS DATE) + {interval(args[1])}) AS DATE)',
+    'timestamp_sub': lambda args: f'(CAST({args[0]} AS TIMESTAMP) - {interval(args[1])})',
+    'timestamp_add': lambda args: f'(CAST({args[0]} AS TIMESTAMP) + {interval(args[1])})',
+    'timestamp_trunc': lambda args: truncate(args[0], args[1]),
+    'datetime_trunc': lambda args: truncate(args[0], args[1]),
+    'date_trunc': lambda args: f'CAST({truncate(args[0], args[1])} AS DATE)',
+    'timestamp_diff': lambda args: f"date_sub('{date_part(args[2])}', {args[1]}, {args[0]})",
+    'date_diff': lambda args: f"date_diff('{date_part(args[2])}', {args[1]}, {args[0]})",
+    'approx_quantiles': approx_quantiles,
+    'regexp_extract': regexp_extract,
+    'generate_date_array': generate_date_array,
+    'extract': extract,
+    'date': date_function,
+    'timestamp': lambda args: f'CAST({args[0]} AS TIMESTAMP)',
+    'safe_cast': lambda args: f'TRY_CAST({args[0]})',
+    # table OPTIONS (expiration_timestamp = ...) have no local meaning
+    'options': lambda args: '',
+}
+
+call_pattern = re.compile(r'\b(in\s+unnest|' + '|'.join(k for k in function_rewrites if ' ' not in k) + r')\s*\(', re.I)
+
+
+def rewrite_calls(sql):
+    out = []
+    pos = 0
+    while (m := call_pattern.search(sql, pos)) is not None:
+        args, end = split_call_args(sql, m.end())
+        args = [rewrite_calls(a) for a in args]
+        out.append(sql[pos:m.start()])
+        out.append(function_rewrites[re.sub(r'\s+', ' ', m.group(1).lower())](args))
+        pos = end
+    out.append(sql[pos:])
+    return ''.join(out)
+
+
+def inline_declares(sql):
+    # DECLARE x TYPE DEFAULT expr; becomes a literal substitution of x, the templates only use them as constants
+    declare_pattern = re.compile(r'\bDECLARE\s+(\w+)\s+(.+?)\s+DEFAULT\s*(.+?);', re.I | re.S)
+    while (m := declare_pattern.search(sql)) is not None:
+        name, type_name, value = m.groups()
+        if not type_name.lower().startswith('array'):
+            value = f'CAST({value} AS {type_names.get(type_name.lower(), type_name)})'
+        rest = re.sub(rf'(?<![\w."]){name}(?![\w"])', lambda _: f'({value})', sql[m.end():])
+        sql = sql[:m.start()] + rest
+    return sql
+
+
+def quote_keyword_alias(m):
+    if re.search(r'\b(INTERVAL\s+\S+|AS)\s*$', m.string[:m.start(2)], re.I):
+        return m.group(0)
+    return f'{m.group(1)} AS "{m.group(2)}"'
+
+
+def translate_sql(sql):
+    sql = split_sql(sql)
+    sql = inline_declares(sql)
+    # unquoted project.dataset.table ids, the project ids contain dashes
+    sql = re.sub(r'\b(FROM|JOIN|INTO|TABLE)\s+([\w-]+\.\w+\.\w+)\b', r'\1 "\2"', sql, flags=re.I)
+    sql = re.sub(r'\[\s*SAFE_OFFSET\s*\(|\[\s*OFFSET\s*\(', '[1 + (', sql, flags=re.I)
+    sql = re.sub(r'\[\s*(SAFE_)?ORDINAL\s*\(', '[(', sql, flags=re.I)
+    sql = re.sub(r'\*\s*EXCEPT\s*\(', '* EXCLUDE (', sql, flags=re.I)
+    sql = re.sub(r'\bAS\s+(' + '|'.join(type_names) + r')\b', lambda m: f'AS {type_names[m.group(1).lower()]}', sql, flags=re.I)
+    sql = re.sub(r'\bNET\.(HOST|REG_DOMAIN)\s*\(', lambda m: f'net_{m.group(1).lower()}(', sql, flags=re.I)
+    sql = re.sub(r'(?<![\w."\'])(' + '|'.join(reserved_identifiers) + r')(?![\w"\'])', r'"\1"', sql, flags=re.I)
+    sql = re.sub(r'([\w)\'])\s+(' + '|'.join(keyword_aliases) + r')\b(?=\s*(,|\n|\bFROM\b))', quote_keyword_alias, sql, flags=re.I)
+    sql = rewrite_calls(sql)
+    return sql
+
+
+def fixture_views(fixtures_dir):
+    views = []
+    for entry in sorted(os.listdir(fixtures_dir)):
+        path = os.path.join(fixtures_dir, entry)
+        if entry.endswith('.parquet'):
+            views.append((entry[:-len('.parquet')], f"read_parquet('{path}')"))
+        elif os.path.isdir(path):
+            views.append((entry, f"read_parquet('{path}/**/*.parquet', hive_partitioning = true)"))
+    return views
+
+
+def get_connection(fixtures_dir):
+    import duckdb
+    with connections_lock:
+        if fixtures_dir not in connections:
+            con = duckdb.connect()
+            for macro in macros:
+                con.execute(macro)
+            for name, source in fixture_views(fixtures_dir):
+                con.execute(f'CREATE VIEW "{name}" AS SELECT * FROM {source}')
+            connections[fixtures_dir] = con
+        return connections[fixtures_dir]
+
+
+class LocalRowIterator:
+    def __init__(self, table):
+        self.table = table
+        self.total_rows = table.num_rows
+
+    def to_arrow(self, **kwargs):
+        return self.table
+
+    def to_dataframe(self, **kwargs):
+        return self.table.to_pandas()
+
+    def to_arrow_iterable(self, **kwargs):
+        yield from self.table.to_batches(max_chunksize=100000)
+
+
+def fixture_bytes(fixtures_dir, translated_query):
+    # stands in for a dry run's bytes processed: the size of every fixture the query reads
+    total = 0
+    for entry in os.listdir(fixtures_dir):
+        name = entry[:-len('.parquet')] if entry.endswith('.parquet') else entry
+        if f'"{name}"' not in translated_query:
+            continue
+        path = os.path.join(fixtures_dir, entry)
+        if os.path.isdir(path):
+            total += sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+        else:
+            total += os.path.getsize(path)
+    return total
+
+
+class LocalQueryJob:
+    # the parts of google.cloud.bigquery.QueryJob the scripts use
+    def __init__(self, con, query, fixtures_dir, dry_run=False):
+        self.query = query
+        self.job_id = f'local_{uuid.uuid4().hex}'
+        self.translated_query = translate_sql(query)
+        self.created = self.started = datetime.datetime.now(datetime.timezone.utc)
+        self.table = pa.table({})
+        if not dry_run:
+            cursor = con.cursor()
+            cursor.execute(self.translated_query)
+            if cursor.description is not None:
+                self.table = cursor.fetch_arrow_table()
+            cursor.close()
+        self.ended = datetime.datetime.now(datetime.timezone.utc)
+        self.state = 'DONE'
+        self.dry_run = dry_run
+        self.cache_hit = False
+        self.total_bytes_processed = fixture_bytes(fixtures_dir, self.translated_query)
+        self.total_bytes_billed = 0
+        self.slot_millis = None
+        self.referenced_tables = []
+
+    def result(self, **kwargs):
+        return LocalRowIterator(self.table)
+
+    def to_dataframe(self, **kwargs):
+        return self.result().to_dataframe()
+
+    def to_arrow(self, **kwargs):
+        return self.result().to_arrow()
+
+
+class LocalClient:
+    def __init__(self, project_id, fixtures_dir=default_fixtures_dir):
+        self.project = project_id
+        self.fixtures_dir = fixtures_dir
+
+    def query(self, query, job_config=None, **kwargs):
+        dry_run = getattr(job_config, 'dry_run', False) is True
+        return LocalQueryJob(get_connection(self.fixtures_dir), query, self.fixtures_dir, dry_run)
+
+    def get_table(self, table_id):
+        from google.api_core.exceptions import NotFound
+        con = get_connection(self.fixtures_dir)
+        found = con.execute('SELECT count(*) FROM duckdb_tables() WHERE table_name = ?', [table_id]).fetchone()[0]
+        found += con.execute('SELECT count(*) FROM duckdb_views() WHERE view_name = ?', [table_id]).fetchone()[0]
+        if found == 0:
+            raise NotFound(f'Not found: Table {table_id}')
+        return table_id
+
+
+def register_local_backend(fixtures_dir=default_fixtures_dir, name='duckdb'):
+    from utils.bq_clients import register_backend
+    fixtures_dir = os.path.abspath(fixtures_dir)
+    register_backend(name, lambda project_id: LocalClient(project_id, fixtures_dir))
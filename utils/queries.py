@@ -0,0 +1,9 @@
+def render_query(query, replacement_dict={}, placeholder='{}'):
+    for k, v in replacement_dict.items():
+        query = query.replace(placeholder[0] + k + placeholder[1], f'{v}')
+    return query
+
+
+def used_replacements(query, replacement_dict={}, placeholder='{}'):
+    # only the keys that appear in the template change the rendered sql
+    return {k: v for k, v in replacement_dict.items() if placeholder[0] + k + placeholder[1] in query}
@@ -0,0 +1,252 @@
+import os
+import time
+import datetime
+import hashlib
+import json
+import tempfile
+import threading
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import utils.bq_clients
+from utils.queries import render_query, used_replacements
+from utils.query_metrics import query_record, data_metrics, log_query_metrics
+
+# one cache shared by every analysis, keyed by the rendered sql rather than a hand-written filename (and the
+# backend, so local duckdb results on fixtures are never a cache hit for a bigquery run)
+cache_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'query_cache')
+cache_max_bytes = 20 * 1024 ** 3
+
+cache_stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0, 'bytes_written': 0, 'bytes_evicted': 0}
+cache_stats_lock = threading.Lock()
+
+# get_cached_data is called from thread pools and several scripts share the cache directory, so any entry can
+# be evicted between looking for it and using it: a missing file is a miss (or already removed), never an error
+
+
+def count_cache_stats(**increments):
+    with cache_stats_lock:
+        for k, v in increments.items():
+            cache_stats[k] += v
+
+
+def query_cache_key(query, replacement_dict={}, placeholder='{}'):
+    rendered_query = render_query(query, replacement_dict, placeholder)
+    repl = json.dumps({k: f'{v}' for k, v in used_replacements(query, replacement_dict, placeholder).items()}, sort_keys=True)
+    # bigquery keys are left as they were, so the existing entries stay valid
+    backend = '' if utils.bq_clients.backend == 'bigquery' else f'\n{utils.bq_clients.backend}'
+    return hashlib.sha256(f'{rendered_query}\n{repl}{backend}'.encode('utf-8')).hexdigest()
+
+
+def cache_entry_path(key, ext='arrow'):
+    return os.path.join(cache_dir, f'{key}.{ext}')
+
+
+def atomic_write(path, write_fn, mode='wb'):
+    # returns the size of the file written
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            write_fn(f)
+            f.flush()
+            size = os.fstat(f.fileno()).st_size
+        os.replace(tmp_path, path)
+        return size
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def write_arrow_table(f, table):
+    with pa.ipc.new_file(f, table.schema) as writer:
+        writer.write_table(table)
+
+
+def load_cache_entry(key, columns=None, filters=None, as_arrow=False):
+    # filters use the pd.read_parquet form, e.g. [('ad_unit_name', 'in', ad_unit_names)]
+    path = cache_entry_path(key)
+    try:
+        # entries are uncompressed arrow ipc, so memory mapping them is zero copy and only the projected
+        # and filtered on columns (and, of the projected ones, the rows passing the filter) are materialised
+        table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+    except FileNotFoundError:
+        return None
+    result = select_table(table, columns, filters, as_arrow)
+
+    # mtime is the last use, so eviction drops the least recently used entries first
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    return result
+
+
+def select_table(table, columns=None, filters=None, as_arrow=False):
+    # the projection (plus the columns filtered on) first, so the filter only copies the columns asked for
+    if columns is not None:
+        clauses = [] if filters is None else [c for f in filters for c in (f if isinstance(f, list) else [f])]
+        table = table.select(list(dict.fromkeys(list(columns) + [c[0] for c in clauses])))
+    if filters is not None:
+        table = table.filter(pq.filters_to_expression(filters))
+    if columns is not None:
+        table = table.select(columns)
+    return table if as_arrow else table.to_pandas()
+
+
+def load_cache_meta(key):
+    try:
+        with open(cache_entry_path(key, 'json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def store_cache_entry(key, df, rendered_query, name=None, extra_meta={}):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_entry_path(key)
+    table = df if isinstance(df, pa.Table) else pa.Table.from_pandas(df)
+    size = atomic_write(path, lambda f: write_arrow_table(f, table))
+
+    meta = {'name': name,
+            'created': datetime.datetime.now().isoformat(),
+            'rows': len(df),
+            'bytes': size,
+            'query': rendered_query,
+            **extra_meta}
+    atomic_write(cache_entry_path(key, 'json'), lambda f: json.dump(meta, f, indent=2), mode='w')
+
+    count_cache_stats(writes=1, bytes_written=size)
+    evict_cache_entries(keep=key)
+
+
+def cache_entries():
+    if not os.path.exists(cache_dir):
+        return []
+
+    entries = []
+    for filename in os.listdir(cache_dir):
+        if not filename.endswith('.arrow'):
+            continue
+        try:
+            stat = os.stat(os.path.join(cache_dir, filename))
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, filename[:-len('.arrow')]))
+    return sorted(entries)
+
+
+def remove_cache_entry(key):
+    for ext in ['arrow', 'json']:
+        try:
+            os.remove(cache_entry_path(key, ext))
+        except FileNotFoundError:
+            pass
+
+
+def evict_cache_entries(max_bytes=None, keep=None):
+    if max_bytes is None:
+        max_bytes = cache_max_bytes
+
+    entries = cache_entries()
+    total_bytes = sum([size for _, size, _ in entries])
+    for _, size, key in entries:
+        if total_bytes <= max_bytes:
+            break
+        if key == keep:
+            continue
+        print(f'evicting query cache entry: {key}, {size / 1024 ** 2:0.1f}MB')
+        remove_cache_entry(key)
+        total_bytes -= size
+        count_cache_stats(evictions=1, bytes_evicted=size)
+
+
+def get_cached_data(query, replacement_dict, fetch_data, force_requery=False, name=None, placeholder='{}', quiet=False,
+                    columns=None, filters=None, as_arrow=False):
+    # fetch_data is the calling script's get_bq_data, called with the unrendered template as before
+    key = query_cache_key(query, replacement_dict, placeholder)
+
+    if not force_requery:
+        start = time.time()
+        df = load_cache_entry(key, columns, filters, as_arrow)
+        if df is not None:
+            count_cache_stats(hits=1)
+            log_query_metrics(query_record(render_query(query, replacement_dict, placeholder), 'query_cache',
+                                           cache_key=key, load_s=time.time() - start, **data_metrics(df)))
+            if not quiet:
+                print(f'found cached query result for {name}, loading {key}')
+            return df
+
+    count_cache_stats(misses=1)
+    print(f'{datetime.datetime.now()}: querying to create cache entry {key} for {name}')
+    df = fetch_data(query, replacement_dict)
+    if df is None:
+        return df
+
+    store_cache_entry(key, df, render_query(query, replacement_dict, placeholder), name)
+    if columns is not None or filters is not None or isinstance(df, pa.Table) != as_arrow:
+        # from the result in memory, the entry may already have been evicted by another thread
+        return select_table(df if isinstance(df, pa.Table) else pa.Table.from_pandas(df), columns, filters, as_arrow)
+    return df
+
+
+def get_cached_keyed_data(query, replacement_dict, fetch_data, key_col, keys, filter_name, force_requery=False, name=None,
+                          placeholder='{}', columns=None, max_age_hours=None):
+    # one cache entry for a query whose filter_name placeholder selects rows by key_col, e.g. where {ad_unit_filter},
+    # holding every key fetched so far. only the keys not in the entry yet are queried, in one query with
+    # key_col in (...), and added to it. returns the rows of the requested keys.
+    # an entry whose first keys were fetched more than max_age_hours ago is dropped and the requested keys queried
+    # afresh, so one result never mixes pulls further apart than that
+    keys = list(dict.fromkeys(keys))
+    base_dict = {k: v for k, v in replacement_dict.items() if k != filter_name}
+    key = query_cache_key(query, base_dict, placeholder)
+
+    start = time.time()
+    table = None if force_requery else load_cache_entry(key, as_arrow=True)
+    meta = load_cache_meta(key) if table is not None else {}
+    if 'keys' not in meta:
+        # an entry whose meta was evicted after it was loaded doesn't say which keys it holds
+        table = None
+    elif max_age_hours is not None:
+        keys_created = datetime.datetime.fromisoformat(meta.get('keys_created', meta['created']))
+        if datetime.datetime.now() - keys_created > datetime.timedelta(hours=max_age_hours):
+            print(f'cached query result for {name} is from {keys_created}, older than {max_age_hours} hours, requerying')
+            table = None
+            meta = {}
+    fetched = meta.get('keys', [])
+    fetched_set = set(fetched)
+    missing = [k for k in keys if k not in fetched_set]
+
+    if len(missing) == 0:
+        count_cache_stats(hits=1)
+        log_query_metrics(query_record(render_query(query, base_dict, placeholder), 'query_cache', cache_key=key,
+                                       load_s=time.time() - start, **data_metrics(table)))
+        print(f'found all {len(keys)} {key_col}s in cached query result for {name}, loading {key}')
+    else:
+        count_cache_stats(misses=1)
+        print(f'{datetime.datetime.now()}: {len(keys) - len(missing)} of {len(keys)} {key_col}s cached for {name}, '
+              f'querying {len(missing)} to add to cache entry {key}')
+        key_list = ', '.join([json.dumps(f'{k}') for k in missing])
+        df_new = fetch_data(query, dict(replacement_dict, **{filter_name: f'{key_col} in ({key_list})'}))
+        if isinstance(df_new, pa.Table):
+            df_new = df_new.to_pandas()
+        df = df_new if table is None else pd.concat([table.to_pandas(), df_new], ignore_index=True)
+        keys_created = meta.get('keys_created', meta.get('created', datetime.datetime.now().isoformat()))
+        store_cache_entry(key, df, render_query(query, base_dict, placeholder), name,
+                          extra_meta={'keys': fetched + missing, 'keys_created': keys_created})
+        table = pa.Table.from_pandas(df, preserve_index=False)
+
+    # from the table in memory, the entry may already have been evicted by another thread
+    return select_table(table, columns, [(key_col, 'in', keys)])
+
+
+def print_cache_stats():
+    lookups = cache_stats['hits'] + cache_stats['misses']
+    hit_rate = cache_stats['hits'] / lookups if lookups > 0 else 0
+    cache_bytes = sum([size for _, size, _ in cache_entries()])
+    print(f'query cache: {cache_stats["hits"]} hits, {cache_stats["misses"]} misses ({hit_rate * 100:0.1f}% hit rate), '
+          f'{cache_stats["writes"]} writes, {cache_stats["evictions"]} evictions, '
+          f'{cache_bytes / 1024 ** 3:0.2f}GB of {cache_max_bytes / 1024 ** 3:0.0f}GB used')
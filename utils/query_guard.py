@@ -0,0 +1,180 @@
+import os
+import re
+import configparser
+import threading
+import types
+
+# every rendered query is checked before it runs: unreplaced {placeholder}/<placeholder> tokens are an error,
+# then a dry run estimates the bytes scanned and whether the partitioned tables it reads are filtered on
+# their partition column in a WHERE clause (and, for a query reading one table, whether the estimate is less than
+# the whole table, as the dry run doesn't split its bytes by table). over budget queries are refused, asked about or only warned about, depending on mode.
+# settings can be overridden in the [query_guard] section of config.ini:
+#   [query_guard]
+#   mode = ask            (ask, refuse, warn or off, off skips the dry run)
+#   max_query_gb = 500
+#   max_run_gb = 2000
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+config_path = os.path.join(repo_dir, 'config.ini')
+
+guard_settings = {'mode': 'ask', 'max_query_gb': 500.0, 'max_run_gb': 2000.0}
+guard_modes = ['ask', 'refuse', 'warn', 'off']
+
+# {name} and <name>, but not regex quantifiers like \d{2} or types like ARRAY<DATE>
+placeholder_pattern = re.compile(r'\{[A-Za-z_]\w*\}|(?<!ARRAY)(?<!STRUCT)<[A-Za-z_]\w*>', re.I)
+
+# tokens that look like placeholders but are part of the sql, e.g. the {HB} in header bidding line item names
+literal_tokens = ['{HB}']
+
+run_estimated_bytes = 0
+run_lock = threading.Lock()
+table_partitions = {}
+
+
+class QueryGuardError(Exception):
+    pass
+
+
+def read_guard_settings(path=config_path):
+    config = configparser.ConfigParser()
+    config.read(path)
+    if config.has_section('query_guard'):
+        section = config['query_guard']
+        guard_settings['mode'] = section.get('mode', guard_settings['mode'])
+        guard_settings['max_query_gb'] = section.getfloat('max_query_gb', guard_settings['max_query_gb'])
+        guard_settings['max_run_gb'] = section.getfloat('max_run_gb', guard_settings['max_run_gb'])
+    assert guard_settings['mode'] in guard_modes, f'query_guard mode must be one of {guard_modes}'
+
+
+def set_query_guard(mode=None, max_query_gb=None, max_run_gb=None):
+    for k, v in {'mode': mode, 'max_query_gb': max_query_gb, 'max_run_gb': max_run_gb}.items():
+        if v is not None:
+            guard_settings[k] = v
+    assert guard_settings['mode'] in guard_modes, f'query_guard mode must be one of {guard_modes}'
+
+
+def unreplaced_placeholders(query):
+    # comments can mention placeholders without it mattering
+    query = re.sub(r'--[^\n]*', '', query)
+    return sorted(set(placeholder_pattern.findall(query)) - set(literal_tokens))
+
+
+def dry_run_job_config():
+    try:
+        from google.cloud import bigquery
+        return bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    except ImportError:
+        # the local backend only looks at these two attributes
+        return types.SimpleNamespace(dry_run=True, use_query_cache=False)
+
+
+def partition_column(table):
+    time_partitioning = getattr(table, 'time_partitioning', None)
+    if time_partitioning is not None:
+        return time_partitioning.field if time_partitioning.field is not None else '_PARTITION'
+    range_partitioning = getattr(table, 'range_partitioning', None)
+    if range_partitioning is not None:
+        return range_partitioning.field
+    return None
+
+
+def where_clauses(query):
+    # the text of every WHERE clause, up to the end of its (sub)query or the next clause at the same depth
+    query = re.sub(r'--[^\n]*|/\*.*?\*/', '', query, flags=re.S)
+    clauses = []
+    for m in re.finditer(r'\bWHERE\b', query, re.I):
+        depth = 0
+        end = len(query)
+        for t in re.finditer(r'[();]|\b(?:GROUP|ORDER|HAVING|QUALIFY|WINDOW|LIMIT|UNION|INTERSECT|EXCEPT)\b', query[m.end():], re.I):
+            token = t.group(0)
+            depth += {'(': 1, ')': -1}.get(token, 0)
+            if depth < 0 or (depth == 0 and token != ')' and token != '('):
+                end = m.end() + t.start()
+                break
+        clauses.append(query[m.end():end])
+    return clauses
+
+
+def filters_on(column, clauses):
+    # _PARTITION stands for the _PARTITIONTIME / _PARTITIONDATE pseudo columns
+    pattern = r'\b_PARTITION\w*' if column == '_PARTITION' else rf'\b{column}\b'
+    return any(re.search(pattern, clause, re.I) is not None for clause in clauses)
+
+
+def partition_report(client, job, query):
+    # a partitioned table is read in full unless a WHERE clause filters on its partition column. a query reading
+    # only that table and estimated at its whole size wasn't pruned, whatever the WHERE clauses say
+    table_refs = getattr(job, 'referenced_tables', None) or []
+    estimated_bytes = getattr(job, 'total_bytes_processed', None) or 0
+    clauses = where_clauses(query)
+    report = []
+    for table_ref in table_refs:
+        table_id = f'{table_ref.project}.{table_ref.dataset_id}.{table_ref.table_id}'
+        if table_id not in table_partitions:
+            table = client.get_table(table_ref)
+            table_partitions[table_id] = (partition_column(table), table.num_bytes)
+        column, num_bytes = table_partitions[table_id]
+        full_scan = len(table_refs) == 1 and bool(num_bytes) and estimated_bytes >= num_bytes
+        report.append({'table': table_id,
+                       'partition_column': column,
+                       'filtered': column is None or (filters_on(column, clauses) and not full_scan),
+                       'table_bytes': num_bytes})
+    return report
+
+
+def approve(query, problems):
+    mode = guard_settings['mode']
+    message = '\n'.join(problems)
+    if mode == 'warn':
+        print(f'query guard warning:\n{message}')
+        return
+    if mode == 'ask':
+        with run_lock:
+            print(f'query guard:\n{message}\n{query[:500]}')
+            answer = input('run it anyway? [y/N] ') if os.isatty(0) else 'n'
+        if answer.strip().lower() in ['y', 'yes']:
+            return
+    raise QueryGuardError(f'query refused by the query guard:\n{message}')
+
+
+def preflight(client, query):
+    global run_estimated_bytes
+
+    placeholders = unreplaced_placeholders(query)
+    if len(placeholders) > 0:
+        raise QueryGuardError(f'unreplaced placeholders {", ".join(placeholders)} in query:\n{query[:500]}')
+    if guard_settings['mode'] == 'off':
+        return {}
+
+    job = client.query(query, job_config=dry_run_job_config())
+    estimated_bytes = job.total_bytes_processed or 0
+    partitions = partition_report(client, job, query)
+    unfiltered = [p['table'] for p in partitions if not p['filtered']]
+
+    problems = []
+    if estimated_bytes > guard_settings['max_query_gb'] * 1024 ** 3:
+        problems.append(f'estimated {estimated_bytes / 1024 ** 3:0.1f}GB is over the per query budget of '
+                        f'{guard_settings["max_query_gb"]:0.0f}GB')
+    # the check and the reservation of the bytes happen together, so concurrent queries can't all pass the check
+    # and then overrun the budget between them. a refused query gives its reservation back
+    with run_lock:
+        run_bytes = run_estimated_bytes + estimated_bytes
+        run_estimated_bytes = run_bytes
+    if run_bytes > guard_settings['max_run_gb'] * 1024 ** 3:
+        problems.append(f'this run would reach {run_bytes / 1024 ** 3:0.1f}GB, over the per run budget of '
+                        f'{guard_settings["max_run_gb"]:0.0f}GB')
+    if len(unfiltered) > 0:
+        print(f'query guard: no partition filter on {", ".join(unfiltered)}')
+    if len(problems) > 0:
+        try:
+            approve(query, problems)
+        except QueryGuardError:
+            with run_lock:
+                run_estimated_bytes -= estimated_bytes
+            raise
+
+    print(f'query guard: {estimated_bytes / 1024 ** 3:0.2f}GB estimated, '
+          f'{run_bytes / 1024 ** 3:0.2f}GB this run')
+    return {'estimated_bytes': estimated_bytes, 'unfiltered_partitioned_tables': unfiltered}
+
+
+read_guard_settings()
@@ -0,0 +1,155 @@
+import os
+import re
+import sys
+import json
+import glob
+import hashlib
+import datetime
+import argparse
+import threading
+
+import pandas as pd
+import pyarrow as pa
+
+# every query run through utils.bq.run_query, and every query cache hit, appends one json line here,
+# report with: python utils/query_metrics.py
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+metrics_path = os.path.join(repo_dir, 'query_metrics', 'query_metrics.jsonl')
+metrics_lock = threading.Lock()
+
+# bigquery on-demand price, only used to put the report in dollars
+usd_per_tib = 6.25
+
+placeholder_pattern = re.compile(r'\{\w+\}|<\w+>')
+templates = None
+template_names = {}
+
+
+def sql_hash(query):
+    return hashlib.sha256(query.encode('utf-8')).hexdigest()
+
+
+def load_templates():
+    # every .sql file in the repo as a regex with its placeholders as wildcards, so a rendered query
+    # can be traced back to the template it came from
+    template_list = []
+    for path in glob.glob(os.path.join(repo_dir, '**', '*.sql'), recursive=True):
+        template = open(path, 'r').read()
+        chunks = placeholder_pattern.split(template)
+        pattern = '.*?'.join(re.escape(chunk) for chunk in chunks)
+        template_list.append((os.path.relpath(path, repo_dir), chunks[0], re.compile(pattern, re.S)))
+    return template_list
+
+
+def template_name(query):
+    global templates
+    key = sql_hash(query)
+    if key not in template_names:
+        if templates is None:
+            templates = load_templates()
+        matches = [name for name, prefix, pattern in templates
+                   if query.startswith(prefix) and pattern.fullmatch(query) is not None]
+        # the most specific template wins when one is a prefix of another
+        template_names[key] = max(matches, key=len) if len(matches) > 0 else None
+    return template_names[key]
+
+
+def data_metrics(data):
+    if data is None:
+        return {'rows': None, 'memory_bytes': None}
+    if isinstance(data, pa.Table):
+        return {'rows': data.num_rows, 'memory_bytes': data.nbytes}
+    return {'rows': len(data), 'memory_bytes': int(data.memory_usage(index=True, deep=True).sum())}
+
+
+def seconds_between(start, end):
+    if start is None or end is None:
+        return None
+    return (end - start).total_seconds()
+
+
+def job_metrics(job):
+    created = getattr(job, 'created', None)
+    started = getattr(job, 'started', None)
+    ended = getattr(job, 'ended', None)
+    return {'job_id': getattr(job, 'job_id', None),
+            'bytes_processed': getattr(job, 'total_bytes_processed', None),
+            'bytes_billed': getattr(job, 'total_bytes_billed', None),
+            'cache_hit': getattr(job, 'cache_hit', None),
+            'slot_ms': getattr(job, 'slot_millis', None),
+            'queue_s': seconds_between(created, started),
+            'run_s': seconds_between(started, ended)}
+
+
+def query_record(query, source, **metrics):
+    return {'time': datetime.datetime.now().isoformat(),
+            'script': os.path.basename(sys.argv[0]),
+            'source': source,
+            'template': template_name(query),
+            'sql_hash': sql_hash(query),
+            **metrics}
+
+
+def log_query_metrics(record):
+    os.makedirs(os.path.dirname(metrics_path), exist_ok=True)
+    line = json.dumps(record, default=str)
+    with metrics_lock:
+        with open(metrics_path, 'a') as f:
+            f.write(line + '\n')
+
+
+def load_query_metrics(path=None, since=None):
+    path = metrics_path if path is None else path
+    df = pd.read_json(path, lines=True, convert_dates=['time'])
+    if since is not None:
+        df = df[df['time'] >= pd.Timestamp(since)]
+    for col in ['cache_hit', 'bytes_billed', 'slot_ms', 'queue_s', 'job_s', 'download_s', 'rows', 'memory_bytes', 'error']:
+        if col not in df.columns:
+            df[col] = None
+    df['cache_hit'] = df['cache_hit'].fillna(False).astype(bool)
+    # queries built in python rather than read from a .sql file are grouped by script
+    df['template'] = df['template'].fillna('<inline> ' + df['script'])
+    return df
+
+
+def template_report(df):
+    df_bq = df[df['source'] == 'bigquery']
+    df_report = df_bq.groupby('template').agg(
+        queries=('sql_hash', 'size'),
+        distinct_queries=('sql_hash', 'nunique'),
+        bq_cache_hits=('cache_hit', 'sum'),
+        errors=('error', 'count'),
+        gb_billed=('bytes_billed', lambda x: x.sum() / 1024 ** 3),
+        slot_hours=('slot_ms', lambda x: x.sum() / 3600e3),
+        job_s=('job_s', 'sum'),
+        mean_job_s=('job_s', 'mean'),
+        max_queue_s=('queue_s', 'max'),
+        download_s=('download_s', 'sum'),
+        mean_rows=('rows', 'mean'),
+        max_memory_mb=('memory_bytes', lambda x: x.max() / 1024 ** 2))
+    df_report['usd'] = df_report['gb_billed'] / 1024 * usd_per_tib
+    df_report['total_s'] = df_report['job_s'] + df_report['download_s']
+    df_report['local_cache_hits'] = df[df['source'] == 'query_cache'].groupby('template').size()
+    df_report['local_cache_hits'] = df_report['local_cache_hits'].fillna(0).astype(int)
+    return df_report
+
+
+def print_report(df_report, top=20):
+    with pd.option_context('display.width', 250, 'display.max_columns', 30, 'display.float_format', '{:0.2f}'.format):
+        print('templates by bytes billed:')
+        print(df_report.sort_values('gb_billed', ascending=False).head(top))
+        print('\ntemplates by total latency (job + download):')
+        print(df_report.sort_values('total_s', ascending=False).head(top))
+    print(f'\n{df_report["queries"].sum()} queries, {df_report["gb_billed"].sum():0.1f}GB billed '
+          f'(${df_report["usd"].sum():0.2f}), {df_report["slot_hours"].sum():0.1f} slot hours, '
+          f'{df_report["total_s"].sum() / 3600:0.2f} hours waiting on bigquery')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', default=None)
+    parser.add_argument('--since', default=None, help='only queries on or after this date, e.g. 2025-01-31')
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+
+    print_report(template_report(load_query_metrics(args.path, args.since)), args.top)
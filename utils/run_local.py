@@ -0,0 +1,34 @@
+import os
+import sys
+import runpy
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.bq_clients import set_backend
+from utils.local_backend import register_local_backend, default_fixtures_dir
+
+# runs an analysis script with every query going to the local duckdb backend instead of bigquery:
+#   python utils/run_local.py rps_uncertainty/main.py --fixtures fixtures
+# the query cache entries are keyed on the backend as well, so local results never stand in for bigquery ones.
+# --cache-dir keeps them in another directory altogether
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('script')
+    parser.add_argument('--fixtures', default=default_fixtures_dir)
+    parser.add_argument('--cache-dir', default=None)
+    args, script_args = parser.parse_known_args()
+
+    register_local_backend(args.fixtures)
+    set_backend('duckdb')
+
+    if args.cache_dir is not None:
+        import utils.query_cache
+        utils.query_cache.cache_dir = os.path.abspath(args.cache_dir)
+
+    # the scripts find their sql and config relative to their own directory
+    script = os.path.abspath(args.script)
+    os.chdir(os.path.dirname(script))
+    sys.path.insert(0, os.path.dirname(script))
+    sys.argv = [script] + script_args
+    runpy.run_path(script, run_name='__main__')
@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+# reducers consume the record batches of utils.bq.stream_query one at a time, so an aggregate over a
+# result of any size needs memory for one batch plus the reducer's state:
+#   moments = Moments(['revenue'], by=['date'])
+#   reduce_batches(stream_query(project_id, query), [moments])
+#   moments.result()
+
+
+def column_values(batch, column):
+    values = batch.column(column).to_numpy(zero_copy_only=False).astype(np.float64)
+    return values[np.isfinite(values)]
+
+
+def reduce_batches(batches, reducers):
+    for batch in batches:
+        for reducer in reducers:
+            reducer.update(batch)
+    return reducers
+
+
+class Moments:
+    # count, sum and sum of squares per column (and per group if by is given): means, standard
+    # deviations and the uncertainty on the means, as group.mean(), group.std(), group.std() / sqrt(count)
+    def __init__(self, columns, by=None):
+        self.columns = list(columns)
+        self.by = [] if by is None else list(by)
+        self.shift = None
+        self.sums = None
+
+    def update(self, batch):
+        if batch.num_rows == 0:
+            return
+        df = pa.Table.from_batches([batch]).select(self.by + self.columns).to_pandas()
+        if self.shift is None:
+            # summing (x - shift) keeps the sum of squares from swamping the variance when the mean is large
+            self.shift = df[self.columns].mean().fillna(0)
+        x = df[self.columns] - self.shift
+        df_sums = pd.concat({'count': x.notna().astype(np.int64), 'sum': x, 'sumsq': x ** 2}, axis=1)
+        if len(self.by) > 0:
+            df_sums = df_sums.groupby([df[b] for b in self.by]).sum()
+        else:
+            df_sums = df_sums.sum().to_frame().T
+        self.sums = df_sums if self.sums is None else self.sums.add(df_sums, fill_value=0)
+
+    def result(self):
+        count = self.sums['count']
+        mean_shifted = self.sums['sum'] / count
+        var = (self.sums['sumsq'] - count * mean_shifted ** 2) / (count - 1)
+        std = np.sqrt(var.clip(lower=0))
+        return pd.concat({'count': count,
+                          'mean': mean_shifted + self.shift,
+                          'std': std,
+                          'mean_uncertainty': std / np.sqrt(count)}, axis=1)
+
+
+class Histogram:
+    # counts in fixed bins, plus everything below and above them so the cdf is over all values
+    def __init__(self, column, bins):
+        self.column = column
+        self.bins = np.asarray(bins, dtype=np.float64)
+        self.counts = np.zeros(len(self.bins) - 1, dtype=np.int64)
+        self.below = 0
+        self.above = 0
+
+    def update(self, batch):
+        x = column_values(batch, self.column)
+        self.counts += np.histogram(x, self.bins)[0]
+        self.below += int((x < self.bins[0]).sum())
+        self.above += int((x > self.bins[-1]).sum())
+
+    def count(self):
+        return self.below + int(self.counts.sum()) + self.above
+
+    def cdf(self):
+        # proportion of values up to each bin's right edge
+        return (self.below + np.cumsum(self.counts)) / max(self.count(), 1)
+
+
+class QuantileSketch:
+    # logarithmic buckets (as in DDSketch): any quantile is returned to within relative_accuracy of the
+    # exact value, using a few thousand counters however many values are seen
+    def __init__(self, column, relative_accuracy=0.01, min_value=1e-9):
+        self.column = column
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.min_value = min_value
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+
+    def add_to_buckets(self, buckets, x):
+        keys, counts = np.unique(np.ceil(np.log(x) / self.log_gamma).astype(np.int64), return_counts=True)
+        for k, c in zip(keys.tolist(), counts.tolist()):
+            buckets[k] = buckets.get(k, 0) + c
+
+    def update(self, batch):
+        x = column_values(batch, self.column)
+        self.add_to_buckets(self.positive, x[x > self.min_value])
+        self.add_to_buckets(self.negative, -x[x < -self.min_value])
+        self.zeros += int((np.abs(x) <= self.min_value).sum())
+
+    def merge(self, other):
+        for buckets, other_buckets in [(self.positive, other.positive), (self.negative, other.negative)]:
+            for k, c in other_buckets.items():
+                buckets[k] = buckets.get(k, 0) + c
+        self.zeros += other.zeros
+
+    def count(self):
+        return sum(self.positive.values()) + sum(self.negative.values()) + self.zeros
+
+    def quantiles(self, qs):
+        # buckets in increasing order of value: negatives by decreasing magnitude, zeros, positives
+        bucket_value = lambda k: 2 * self.gamma ** k / (self.gamma + 1)
+        negative_keys = sorted(self.negative.keys(), reverse=True)
+        positive_keys = sorted(self.positive.keys())
+        values = np.array([-bucket_value(k) for k in negative_keys] + [0.0] + [bucket_value(k) for k in positive_keys])
+        counts = np.array([self.negative[k] for k in negative_keys] + [self.zeros] + [self.positive[k] for k in positive_keys])
+        cum_counts = np.cumsum(counts)
+        ranks = np.asarray(qs, dtype=np.float64) * (cum_counts[-1] - 1)
+        return values[np.searchsorted(cum_counts, ranks, side='right')]